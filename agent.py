@@ -0,0 +1,137 @@
+import os
+import gzip
+import json
+import uuid
+import socket
+import logging
+import datetime
+import urllib.error
+import urllib.request
+# Settings
+import disk_stats_settings as dss
+
+logger = logging.getLogger()
+
+SPOOL_SUFFIX = '.json.gz'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+#================ Spool ================
+def host_name():
+    return dss.AGENT_HOST_NAME or socket.gethostname()
+
+def make_batch(disks_report=None, folders_report=None, date=None):
+    """Builds a batch from the records of the collectors reports
+
+    Arguments:
+        disks_report: The report of disk_stats.disk_stats
+        folders_report: The report of disk_stats.folders_stats
+        date: The date of the batch, now if None
+    Returns:
+        dict: The batch, as sent to the ingest service, None if there is no
+              record
+    """
+    data_points = []
+    folders = []
+    if disks_report is not None:
+        data_points = [[data_point.date.strftime(DATE_FORMAT), data_point.file_system.name,
+                        data_point.mount_point.path, data_point.size, data_point.used_space]
+                       for data_point in disks_report.data]
+    if folders_report is not None:
+        folders = [[folder.date.strftime(DATE_FORMAT), folder.path, folder.size]
+                   for folder in folders_report.data]
+    if not (data_points or folders):
+        return None
+    date = date or datetime.datetime.now()
+    return {'id': str(uuid.uuid4()), 'host': host_name(), 'date': date.strftime(DATE_FORMAT),
+            'data_points': data_points, 'folders': folders}
+
+def spooled():
+    """Returns the paths of the spooled batches, oldest first
+    """
+    try:
+        names = os.listdir(dss.AGENT_SPOOL_PATH)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(dss.AGENT_SPOOL_PATH, name)
+            for name in sorted(names) if name.endswith(SPOOL_SUFFIX)]
+
+def spool(disks_report=None, folders_report=None):
+    """Writes the records of the collectors reports in dss.AGENT_SPOOL_PATH
+    until they are pushed. The oldest batches are dropped beyond
+    dss.AGENT_MAX_SPOOLED.
+
+    Returns:
+        str: The id of the batch, None if there was no record
+    """
+    batch = make_batch(disks_report, folders_report)
+    if batch is None:
+        return None
+    os.makedirs(dss.AGENT_SPOOL_PATH, exist_ok=True)
+    # Named by date for the order, written aside so a push never reads it
+    # partially
+    name = '{0}-{1}{2}'.format(datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'),
+                               batch['id'], SPOOL_SUFFIX)
+    path = os.path.join(dss.AGENT_SPOOL_PATH, name)
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump(batch, f)
+    os.replace(path + '.tmp', path)
+    paths = spooled()
+    for old_path in paths[:max(0, len(paths) - dss.AGENT_MAX_SPOOLED)]:
+        logger.warning("Agent spool full, dropping {0}".format(old_path))
+        os.remove(old_path)
+    return batch['id']
+
+#================ Push ================
+def post(batches):
+    """Sends batches to dss.AGENT_INGEST_URL in one compressed request
+
+    Arguments:
+        batches: The batches of make_batch
+    Returns:
+        dict: The answer of the ingest service
+    Raises:
+        urllib.error.URLError, OSError: When the batches were not taken
+    """
+    body = gzip.compress(json.dumps({'batches': batches}).encode('utf-8'))
+    headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+    if dss.AGENT_TOKEN is not None:
+        headers['Authorization'] = 'Bearer {0}'.format(dss.AGENT_TOKEN)
+    request = urllib.request.Request(dss.AGENT_INGEST_URL, data=body, headers=headers,
+                                     method='POST')
+    with urllib.request.urlopen(request, timeout=dss.AGENT_TIMEOUT.total_seconds()) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+def push():
+    """Sends the spooled batches, dss.AGENT_BATCHES_PER_PUSH by request,
+    oldest first, and deletes them once taken. Stops at the first failure,
+    the remaining batches are sent by the next push. A batch sent again after
+    a lost answer is ignored by the ingest service.
+
+    Returns:
+        int: The number of batches sent
+    """
+    paths = spooled()
+    sent = 0
+    for i in range(0, len(paths), dss.AGENT_BATCHES_PER_PUSH):
+        chunk = paths[i:i+dss.AGENT_BATCHES_PER_PUSH]
+        batches = []
+        for path in chunk:
+            try:
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    batches.append(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.error("Dropping the unreadable batch {0} : {1}".format(path, e))
+                os.remove(path)
+        try:
+            answer = post(batches)
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            logger.error("Failed to push {0} batches to {1} : {2}".format(len(batches),
+                                                                         dss.AGENT_INGEST_URL, e))
+            break
+        for path in chunk:
+            if os.path.exists(path):
+                os.remove(path)
+        sent += len(batches)
+        logger.debug("Pushed {0} batches ({1} already received)".format(len(batches),
+                                                                        answer.get('duplicates', 0)))
+    return sent
@@ -0,0 +1,359 @@
+import os
+import time
+import fnmatch
+import logging
+import datetime
+import threading
+from collections import deque
+import psutil
+import disk_stats
+from disk_stats import db, AlertState
+# Settings
+import disk_stats_settings as dss
+
+logger = logging.getLogger()
+
+# The metrics of the rules read from statvfs, by their index in the values of
+# a sample
+SAMPLED_METRICS = {'used_percent': 0, 'free_bytes': 1, 'inodes_percent': 2}
+METRICS = tuple(SAMPLED_METRICS) + ('growth',)
+
+#================ Rules ================
+class Rule(object):
+    """A condition on a metric of the mounts, as declared in dss.ALERT_RULES.
+    An alert fires once the threshold has been crossed for duration, and is
+    cleared when the metric goes back past clear. In between, it stays as it
+    is, so a metric hovering around the threshold does not flap.
+
+    Attributes:
+        name: The name of the rule
+        metric: 'used_percent', 'free_bytes', 'inodes_percent' (of the inodes
+                used), or 'growth' (the bytes written by hour over window)
+        threshold: The value firing the alert
+        rising: Whether it fires above the threshold, else below
+        clear: The value clearing the alert
+        duration: The time the threshold must stay crossed, in seconds
+        window: The time the growth is measured over, in seconds
+        mounts: The fnmatch patterns of the mount points the rule applies to
+        devices: The fnmatch patterns of the devices it applies to
+    """
+    def __init__(self, name, metric, above=None, below=None, clear=None,
+                 duration=datetime.timedelta(0), window=datetime.timedelta(minutes=10),
+                 mounts=('*',), devices=('*',)):
+        if metric not in METRICS:
+            raise ValueError("Unknown metric {0} in the alert rule {1}".format(metric, name))
+        if (above is None) == (below is None):
+            raise ValueError("The alert rule {0} needs either above or below".format(name))
+        self.name = name
+        self.metric = metric
+        self.rising = above is not None
+        self.threshold = above if self.rising else below
+        self.clear = clear if clear is not None else self.threshold
+        if (self.clear > self.threshold) if self.rising else (self.clear < self.threshold):
+            raise ValueError("The alert rule {0} clears past its threshold".format(name))
+        self.duration = duration.total_seconds()
+        self.window = window.total_seconds()
+        self.mounts = tuple(mounts)
+        self.devices = tuple(devices)
+
+    def applies_to(self, mount_point, device):
+        return (any(fnmatch.fnmatchcase(mount_point, pattern) for pattern in self.mounts) and
+                any(fnmatch.fnmatchcase(device, pattern) for pattern in self.devices))
+
+    def triggered(self, value):
+        return value >= self.threshold if self.rising else value <= self.threshold
+
+    def cleared(self, value):
+        return value < self.clear if self.rising else value > self.clear
+
+    def format(self, value):
+        """Formats a value of the metric for the mails
+        """
+        if self.metric == 'growth':
+            return "{0}/h".format(disk_stats.sizeof_fmt(value))
+        if self.metric == 'free_bytes':
+            return disk_stats.sizeof_fmt(value)
+        return "{0:.1f}%".format(value)
+
+def load_rules():
+    """Builds the rules of dss.ALERT_RULES
+
+    Raises:
+        ValueError, TypeError: When a rule is not valid
+    """
+    return [Rule(**spec) for spec in dss.ALERT_RULES]
+
+#================ Windows ================
+class SlidingWindow(object):
+    """The used space of a mount over the last length seconds
+
+    Attributes:
+        length: The length of the window, in seconds
+        samples: The (time.monotonic() time, used space), oldest first
+    """
+    __slots__ = ('length', 'samples')
+
+    def __init__(self, length):
+        self.length = length
+        self.samples = deque()
+
+    def add(self, now, used):
+        samples = self.samples
+        samples.append((now, used))
+        while samples[0][0] < now - self.length:
+            samples.popleft()
+
+    def growth(self):
+        """Returns the growth over the window, in bytes by hour, None until
+        the samples span half of it
+        """
+        first, last = self.samples[0], self.samples[-1]
+        span = last[0] - first[0]
+        if span <= 0 or span < self.length/2:
+            return None
+        return (last[1] - first[1])*3600.0/span
+
+class _Watch(object):
+    """The state of a rule on a mount
+    """
+    __slots__ = ('rule', 'index', 'window', 'pending_since', 'alert_id')
+
+    def __init__(self, rule, window=None, alert_id=None):
+        self.rule = rule
+        self.index = SAMPLED_METRICS.get(rule.metric)
+        self.window = window
+        self.pending_since = None
+        self.alert_id = alert_id
+
+class _Mount(object):
+    """A sampled mount, its windows and the rules applying to it
+    """
+    __slots__ = ('path', 'device', 'windows', 'watches')
+
+    def __init__(self, path, device):
+        self.path = path
+        self.device = device
+        self.windows = {}
+        self.watches = []
+
+#================ Engine ================
+class AlertEngine(object):
+    """Samples the mounts with statvfs at each tick and evaluates the rules on
+    the samples. The windows and the pending conditions stay in memory, the
+    alerts are written in AlertState when they fire and clear, so that a
+    restarted engine goes on with them.
+
+    Attributes:
+        rules: The Rule list
+        mounts: The _Mount by mount point path
+    """
+    def __init__(self, rules=None):
+        self.rules = rules if rules is not None else load_rules()
+        self.mounts = {}
+        self._firing = None
+        self._next_refresh = 0
+
+    def load(self):
+        """Reads the alerts firing. Those of the rules no longer declared are
+        cleared.
+        """
+        AlertState.create_table(fail_silently=True)
+        names = {rule.name for rule in self.rules}
+        self._firing = {}
+        gone = []
+        for alert in AlertState.select().where(AlertState.cleared >> None):
+            if alert.rule in names:
+                self._firing[(alert.rule, alert.mount_point)] = alert.id
+            else:
+                gone.append(alert.id)
+        if gone:
+            (AlertState.update(cleared=datetime.datetime.now())
+                       .where(AlertState.id << gone).execute())
+
+    def watched_mounts(self):
+        """Lists the mounts to sample, dss.ALERT_MOUNTS or those of every
+        partition
+
+        Returns:
+            dict: The device by mount point path
+        """
+        devices = {}
+        for partition in psutil.disk_partitions(all=dss.ANALYSE_ALL_PARTITIONS):
+            if partition.device not in dss.EXCLUDED_DEVICES:
+                devices.setdefault(partition.mountpoint, partition.device)
+        if dss.ALERT_MOUNTS:
+            return {path: devices.get(path, path) for path in dss.ALERT_MOUNTS}
+        return devices
+
+    def refresh_mounts(self):
+        """Follows the mounts and unmounts. The mounts still there keep their
+        windows and states.
+        """
+        mounts = {}
+        for path, device in self.watched_mounts().items():
+            mount = self.mounts.get(path)
+            if mount is not None and mount.device == device:
+                mounts[path] = mount
+                continue
+            mount = _Mount(path, device)
+            for rule in self.rules:
+                if not rule.applies_to(path, device):
+                    continue
+                window = None
+                if rule.metric == 'growth':
+                    window = mount.windows.setdefault(rule.window, SlidingWindow(rule.window))
+                mount.watches.append(_Watch(rule, window, self._firing.pop((rule.name, path),
+                                                                           None)))
+            if mount.watches:
+                mounts[path] = mount
+        # The alerts of the mounts gone are taken back if they come back
+        for path, mount in self.mounts.items():
+            if mounts.get(path) is not mount:
+                self._firing.update(((watch.rule.name, path), watch.alert_id)
+                                    for watch in mount.watches if watch.alert_id is not None)
+        self.mounts = mounts
+        self._next_refresh = time.monotonic() + dss.ALERT_MOUNTS_REFRESH.total_seconds()
+
+    def evaluate(self, now):
+        """Samples the mounts and evaluates the rules
+
+        Arguments:
+            now: The time.monotonic() time of the sample
+        Returns:
+            list: The (fired, _Watch, _Mount, value) of the alerts which fired
+                  or cleared, fired being False when it cleared
+        """
+        transitions = []
+        for mount in self.mounts.values():
+            try:
+                vfs = os.statvfs(mount.path)
+            except OSError as e:
+                logger.debug("Failed to sample {0} : {1}".format(mount.path, e))
+                continue
+            if not vfs.f_blocks:
+                continue
+            used = (vfs.f_blocks - vfs.f_bfree)*vfs.f_frsize
+            values = (100.0*(vfs.f_blocks - vfs.f_bfree)/vfs.f_blocks,
+                      vfs.f_bavail*vfs.f_frsize,
+                      100.0*(vfs.f_files - vfs.f_ffree)/vfs.f_files if vfs.f_files else 0.0)
+            for window in mount.windows.values():
+                window.add(now, used)
+            for watch in mount.watches:
+                rule = watch.rule
+                value = values[watch.index] if watch.window is None else watch.window.growth()
+                if value is None:
+                    continue
+                if watch.alert_id is not None:
+                    if rule.cleared(value):
+                        transitions.append((False, watch, mount, value))
+                elif rule.triggered(value):
+                    if watch.pending_since is None:
+                        watch.pending_since = now
+                    if now - watch.pending_since >= rule.duration:
+                        transitions.append((True, watch, mount, value))
+                else:
+                    watch.pending_since = None
+        return transitions
+
+    def record(self, transitions):
+        """Writes the alerts which fired or cleared, in one transaction. The
+        states only change once written, so the next tick finds them again
+        if it fails.
+        """
+        date = datetime.datetime.now()
+        ids = []
+        with db.atomic():
+            for fired, watch, mount, value in transitions:
+                if fired:
+                    ids.append(AlertState.insert(rule=watch.rule.name, mount_point=mount.path,
+                                                 device=mount.device, value=value,
+                                                 fired=date).execute())
+                else:
+                    (AlertState.update(cleared=date)
+                               .where(AlertState.id == watch.alert_id).execute())
+                    ids.append(None)
+        for (fired, watch, mount, value), alert_id in zip(transitions, ids):
+            watch.alert_id = alert_id
+            watch.pending_since = None
+
+    def notify(self, transitions):
+        """Mails the alerts which fired or cleared, if dss.SEND_ALERTS
+        """
+        if not dss.SEND_ALERTS:
+            return
+        lines = [(dss.ALERT_FIRED_STRING if fired else dss.ALERT_CLEARED_STRING)
+                 .format(rule=watch.rule.name, metric=watch.rule.metric, device=mount.device,
+                         mount_point=mount.path, value=watch.rule.format(value))
+                 for fired, watch, mount, value in transitions]
+        try:
+            disk_stats.send_mail(dss.ALERT_ENGINE_SUBJECT, "\n".join(lines))
+        except Exception as e:
+            logger.error("Failed to send the alerts mail : {0}".format(e))
+
+    def tick(self):
+        """Samples the mounts, evaluates the rules and records and mails the
+        alerts which fired or cleared
+
+        Returns:
+            list: The transitions, as evaluate
+        """
+        if self._firing is None:
+            self.load()
+        now = time.monotonic()
+        if now >= self._next_refresh:
+            self.refresh_mounts()
+        transitions = self.evaluate(now)
+        if transitions:
+            self.record(transitions)
+            for fired, watch, mount, value in transitions:
+                logger.warning("Alert {0} {1} on {2} at {3}".format(watch.rule.name,
+                                                                    "fired" if fired else "cleared",
+                                                                    mount.path,
+                                                                    watch.rule.format(value)))
+            self.notify(transitions)
+        return transitions
+
+    def firing(self):
+        """Returns the alerts firing
+
+        Returns:
+            list: The (rule name, mount point, device)
+        """
+        return [(watch.rule.name, mount.path, mount.device)
+                for mount in self.mounts.values() for watch in mount.watches
+                if watch.alert_id is not None]
+
+#================ Main functions ================
+def main(once=False):
+    """Runs the alert engine every dss.ALERT_INTERVAL until SIGTERM
+
+    Arguments:
+        once: Only evaluate the rules once and print the alerts firing
+    """
+    disk_stats.init_database()
+    engine = AlertEngine()
+    if once:
+        engine.tick()
+        for rule, mount_point, device in engine.firing():
+            print("{0}\t{1}\t{2}".format(rule, mount_point, device))
+        return
+    # Imported here, only the service needs it
+    import signal
+    disk_stats.setup_logging()
+    logger.info("Starting disk_stats alert engine")
+    if dss.EMAIL_OUTBOX_PATH is not None:
+        disk_stats.mail_carrier = disk_stats.create_mail_carrier()
+        disk_stats.mail_carrier.start()
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+    while not stop.is_set():
+        try:
+            engine.tick()
+        except Exception as e:
+            logger.error("Alert engine failed : {0} ({1})".format(e, e.__class__))
+        stop.wait(dss.ALERT_INTERVAL.total_seconds())
+    if disk_stats.mail_carrier is not None:
+        disk_stats.mail_carrier.arreter()
+        disk_stats.mail_carrier.join(dss.DAEMON_SHUTDOWN_TIMEOUT.total_seconds())
+    logger.info("disk_stats alert engine stopped")
@@ -0,0 +1,73 @@
+"""Measures the cost of a tick of the alert engine, the statvfs sampling and
+the evaluation of the rules, on many mounts. The mounts are temporary
+directories, sampled with statvfs like real mount points.
+
+Usage: python benchmarks/bench_alerts.py [--mounts N] [--ticks N]
+Prints the results as JSON.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import tempfile
+import statistics
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import disk_stats_settings as dss
+import disk_stats
+import alerts
+
+RULES = ({'name': 'full', 'metric': 'used_percent', 'above': 90, 'clear': 85,
+          'duration': datetime.timedelta(minutes=1)},
+         {'name': 'almost full', 'metric': 'free_bytes', 'below': 1024**3},
+         {'name': 'inodes', 'metric': 'inodes_percent', 'above': 95},
+         {'name': 'filling', 'metric': 'growth', 'above': 10*1024**3,
+          'window': datetime.timedelta(minutes=10)})
+
+def bench(args):
+    with tempfile.TemporaryDirectory() as directory:
+        dss.DATABASE_PATH = os.path.join(directory, 'bench.sqlite')
+        dss.ALERT_RULES = RULES
+        dss.SEND_ALERTS = False
+        mounts = set()
+        for i in range(args.mounts):
+            path = os.path.join(directory, 'mount{0}'.format(i))
+            os.mkdir(path)
+            mounts.add(path)
+        dss.ALERT_MOUNTS = mounts
+        disk_stats.init_database()
+        engine = alerts.AlertEngine()
+        start = time.perf_counter()
+        engine.tick()
+        first_ms = (time.perf_counter() - start)*1000
+        ticks = []
+        evaluations = []
+        for _ in range(args.ticks):
+            start = time.perf_counter()
+            engine.tick()
+            ticks.append((time.perf_counter() - start)*1000)
+            start = time.perf_counter()
+            engine.evaluate(time.monotonic())
+            evaluations.append((time.perf_counter() - start)*1000)
+        # The sampling alone, for the share of the rules
+        paths = list(mounts)
+        start = time.perf_counter()
+        for _ in range(args.ticks):
+            for path in paths:
+                os.statvfs(path)
+        statvfs_ms = (time.perf_counter() - start)*1000/args.ticks
+        disk_stats.db.close()
+    return {'mounts': args.mounts, 'rules': len(RULES), 'ticks': args.ticks,
+            'first_tick_ms': round(first_ms, 2),
+            'tick_median_ms': round(statistics.median(ticks), 3),
+            'tick_max_ms': round(max(ticks), 3),
+            'evaluate_median_ms': round(statistics.median(evaluations), 3),
+            'statvfs_only_ms': round(statvfs_ms, 3),
+            'us_per_mount': round(statistics.median(ticks)*1000/args.mounts, 2)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mounts', type=int, default=500)
+    parser.add_argument('--ticks', type=int, default=200)
+    print(json.dumps(bench(parser.parse_args()), indent=2))
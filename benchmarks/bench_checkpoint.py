@@ -0,0 +1,78 @@
+"""Measures the cost of the checkpoints of the resumable folders scans: the
+time to save and load a scan pass stopped half way through a synthetic tree,
+and the size it takes in the database.
+
+Usage: python benchmarks/bench_checkpoint.py [--nodes N]
+Prints the results as JSON.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import disk_stats_settings as dss
+import disk_stats
+import scanner
+
+FANOUT = 10
+
+def make_state(root, count):
+    """Builds the ScanState of a scan of root which found count folders and
+    listed half of them
+    """
+    state = scanner.ScanState(root, scanner.ScanStats(scanner.Breakdown(1000, [86400])))
+    queue = [root]
+    position = 0
+    while len(state.nodes) < count:
+        parent = state.nodes[queue[position]]
+        position += 1
+        for i in range(FANOUT):
+            if len(state.nodes) >= count:
+                break
+            path = '{0}/d{1}'.format(parent.path, i)
+            state.nodes[path] = scanner.FolderNode(path, parent.path)
+            parent.children.append(path)
+            queue.append(path)
+    paths = list(state.nodes)
+    for path in paths[:count//2]:
+        state.nodes[path].files_size = random.randrange(1, 2**30)
+    state.stack = paths[count//2:]
+    state.seen_inodes = {(1, i) for i in range(count//100)}
+    return state
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, round((time.perf_counter() - start)*1000, 2)
+
+def bench(args):
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        dss.DATABASE_PATH = os.path.join(directory, 'bench.sqlite')
+        disk_stats.init_database()
+        disk_stats.FolderScanRun.create_table(fail_silently=True)
+        disk_stats.ScanCheckpoint.create_table(fail_silently=True)
+        scan_run = disk_stats.FolderScanRun.create(date=datetime.datetime.now(), full=True,
+                                                   rescanned=0, reused=0)
+        scan_pass = disk_stats.ScanPass(scan_run.id, scan_run.date, True, [])
+        scan_pass.state, build_ms = timed(make_state, directory, args.nodes)
+        with disk_stats.db.atomic():
+            _, save_ms = timed(disk_stats.save_checkpoint, scan_pass)
+        loaded, load_ms = timed(disk_stats.load_checkpoint)
+        size = (disk_stats.ScanCheckpoint.select(disk_stats.ScanCheckpoint.data)
+                                         .tuples().first()[0])
+        result = {'nodes': args.nodes, 'pending': len(scan_pass.state.stack),
+                  'build_ms': build_ms, 'save_ms': save_ms, 'load_ms': load_ms,
+                  'checkpoint_bytes': len(size),
+                  'resumed_nodes': len(loaded.state.nodes)}
+        disk_stats.db.close()
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=1000000)
+    print(json.dumps(bench(parser.parse_args()), indent=2))
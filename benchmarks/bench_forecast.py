@@ -0,0 +1,77 @@
+"""Measures the time to fit the growth of many series, on synthetic arrays
+and on a synthetic history in a temporary database.
+
+Usage: python benchmarks/bench_forecast.py [series ...]
+Prints the results as JSON.
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import tempfile
+import numpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import disk_stats_settings as dss
+import disk_stats
+import forecast
+
+DEFAULT_SERIES = (100, 1000, 3000)
+# One sample every 30 minutes over the longest window
+SAMPLE_INTERVAL = datetime.timedelta(minutes=30)
+
+def synthetic_arrays(series_count, now):
+    """Builds the samples of series growing at random rates
+    """
+    window = max(dss.FORECAST_WINDOWS).total_seconds()
+    points = int(window//SAMPLE_INTERVAL.total_seconds())
+    times = numpy.tile(now - window + numpy.arange(points)*SAMPLE_INTERVAL.total_seconds(),
+                       series_count)
+    series = numpy.repeat(numpy.arange(series_count), points)
+    rates = numpy.random.uniform(0, 1000, series_count)
+    values = rates[series]*(times - times[0]) + numpy.random.normal(0, 1e5, len(times))
+    return series, times, values
+
+def bench_arrays(series_count):
+    now = 1.6e9
+    series, times, values = synthetic_arrays(series_count, now)
+    windows = [window.total_seconds() for window in dss.FORECAST_WINDOWS]
+    start = time.perf_counter()
+    slopes = forecast.fit_growth(series, times, values, now, windows, dss.FORECAST_MIN_POINTS)
+    forecast.hours_to_full(slopes, numpy.full(series_count, 1e12))
+    return {'samples': len(times), 'fit_ms': round((time.perf_counter() - start)*1000, 2)}
+
+def bench_database(series_count):
+    now = datetime.datetime(2020, 1, 1)
+    series, times, values = synthetic_arrays(series_count, (now - forecast.EPOCH).total_seconds())
+    with tempfile.TemporaryDirectory() as directory:
+        dss.DATABASE_PATH = os.path.join(directory, 'bench.sqlite')
+        disk_stats.init_database()
+        for model in (disk_stats.FileSystem, disk_stats.MountPoint, disk_stats.DataPoint,
+                      disk_stats.FolderSizeHistory):
+            model.create_table(fail_silently=True)
+        with disk_stats.db.atomic():
+            cursor = disk_stats.db.get_cursor()
+            cursor.executemany('INSERT INTO "server_stats_filesystem" ("id", "name") VALUES (?, ?)',
+                               ((i + 1, '/dev/sd{0}'.format(i)) for i in range(series_count)))
+            cursor.executemany('INSERT INTO "server_stats_mountpoint" ("id", "path") VALUES (?, ?)',
+                               ((i + 1, '/mnt/{0}'.format(i)) for i in range(series_count)))
+            cursor.executemany('INSERT INTO "server_stats_datapoint" '
+                               '("size", "used_space", "file_system_id", "mount_point_id", "date") '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               ((2**50, int(value) + 2**40, int(index) + 1, int(index) + 1,
+                                 forecast.EPOCH + datetime.timedelta(seconds=float(seconds)))
+                                for index, seconds, value in zip(series, times, values)))
+        start = time.perf_counter()
+        device_forecasts, _ = forecast.forecast(now)
+        elapsed = time.perf_counter() - start
+        disk_stats.db.close()
+    return {'samples': len(times), 'forecasts': len(device_forecasts),
+            'forecast_ms': round(elapsed*1000, 2)}
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SERIES
+    results = [{'series': count, 'arrays': bench_arrays(count),
+                'database': bench_database(count)}
+               for count in counts]
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,83 @@
+"""Pushes the records of synthetic agents to an ingest service on localhost,
+and measures the throughput of the ingestion. Each batch is pushed a second
+time to check that the retries are ignored.
+
+Usage: python benchmarks/bench_ingest.py [--hosts N] [--runs N] [--devices N]
+                                         [--folders N]
+Prints the results as JSON.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import disk_stats_settings as dss
+import disk_stats
+import agent
+import ingest
+
+def reports(devices, folders, date):
+    """Builds the reports of a run of the collectors
+    """
+    disks_report = disk_stats.Report(data=[], errors=[], details={})
+    for i in range(devices):
+        disks_report.data.append(disk_stats.DataPoint(size=2**40, used_space=i*2**30, date=date,
+                                                      file_system=disk_stats.FileSystem(name='/dev/sd{0}'.format(i)),
+                                                      mount_point=disk_stats.MountPoint(path='/mnt/{0}'.format(i))))
+    folders_report = disk_stats.Report(data=[], errors=[], details={})
+    for i in range(folders):
+        folders_report.data.append(disk_stats.FolderSizeHistory(path='/data/{0}'.format(i),
+                                                                size=i*2**20, date=date))
+    return disks_report, folders_report
+
+def bench(args):
+    with tempfile.TemporaryDirectory() as directory:
+        dss.INGEST_DATABASE_PATH = os.path.join(directory, 'ingest.sqlite')
+        dss.INGEST_ADDRESS = '127.0.0.1'
+        dss.INGEST_PORT = 0
+        ingest.init_database()
+        server = ingest.serve()
+        dss.AGENT_INGEST_URL = 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+        start = datetime.datetime(2020, 1, 1)
+        pushed = 0
+        push_time = 0.0
+        for host in range(args.hosts):
+            dss.AGENT_HOST_NAME = 'host{0}'.format(host)
+            dss.AGENT_SPOOL_PATH = os.path.join(directory, 'spool{0}'.format(host))
+            for run in range(args.runs):
+                agent.spool(*reports(args.devices, args.folders,
+                                     start + datetime.timedelta(minutes=run)))
+            # Keep the batches to push them again
+            copies = {path: open(path, 'rb').read() for path in agent.spooled()}
+            begin = time.perf_counter()
+            pushed += agent.push()
+            push_time += time.perf_counter() - begin
+            for path, content in copies.items():
+                with open(path, 'wb') as f:
+                    f.write(content)
+            agent.push()
+        records = (ingest.HostDataPoint.select().count(), ingest.HostFolderSize.select().count())
+        report = ingest.report_text(start)
+        server.shutdown()
+        ingest.db.close()
+        result = {'hosts': args.hosts, 'batches': pushed,
+                  'loaded_batches': ingest.IngestedBatch.select().count(),
+                  'data_points': records[0], 'folders': records[1],
+                  'expected_records': args.hosts*args.runs*(args.devices + args.folders),
+                  'push_ms': round(push_time*1000, 2),
+                  'records_per_sec': round(sum(records)/push_time) if push_time else None,
+                  'report_lines': len(report.splitlines()) if report else 0}
+        ingest.db.close()
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hosts', type=int, default=200)
+    parser.add_argument('--runs', type=int, default=12,
+                        help="The runs of the collectors spooled by each host before a push")
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--folders', type=int, default=5)
+    print(json.dumps(bench(parser.parse_args()), indent=2))
@@ -0,0 +1,120 @@
+"""Measures the peak memory used to send a mail with an attachment, against
+the size of the attachment, when the message is built in memory (as
+gipkomail did before) and when it is streamed.
+
+The mails are sent to a minimal SMTP server run by the benchmark, which
+discards them. Each measurement runs in its own process.
+
+Usage: python benchmarks/bench_mail.py [size in MB ...]
+Prints the results as JSON.
+"""
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import threading
+import subprocess
+import socketserver
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_SIZES = (10, 50, 100)
+MODES = ('in_memory', 'streamed', 'streamed_gzip')
+
+class SMTPSink(socketserver.StreamRequestHandler):
+    """Accepts every mail and discards it
+    """
+    def handle(self):
+        self.wfile.write(b'220 sink\r\n')
+        for line in self.rfile:
+            command = line[:4].upper()
+            if command == b'DATA':
+                self.wfile.write(b'354 go\r\n')
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+                self.wfile.write(b'250 ok\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+def send_in_memory(path, port):
+    """The message building of gipkomail before the streaming
+    """
+    import smtplib
+    from email import encoders
+    from email.mime.base import MIMEBase
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+    msg = MIMEMultipart('mixed')
+    msg.attach(MIMEText('report'.encode('utf-8'), 'plain', 'utf-8'))
+    msg['From'] = 'bench@localhost'
+    msg['To'] = 'bench@localhost'
+    msg['Subject'] = 'bench'
+    part = MIMEBase('application', "octet-stream")
+    part.set_payload(open(path, "rb").read())
+    encoders.encode_base64(part)
+    part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(path))
+    msg.attach(part)
+    s = smtplib.SMTP('localhost', port)
+    s.sendmail('bench@localhost', ['bench@localhost'], msg.as_string())
+    s.quit()
+
+def send_streamed(path, port, compress):
+    import gipkomail
+    gipkomail.envoyer_message('localhost', 'bench@localhost', 'bench@localhost', 'bench',
+                              'report', files=[path], port=port, compresser=compress)
+
+def child(mode, path, port):
+    """Sends one mail and prints the peak RSS of the process, in KB
+    """
+    # Imports done before measuring the baseline
+    import smtplib, email.mime.multipart, gipkomail
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if mode == 'in_memory':
+        send_in_memory(path, port)
+    else:
+        send_streamed(path, port, mode == 'streamed_gzip')
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'baseline_kb': baseline, 'peak_kb': peak,
+                      'seconds': round(elapsed, 3)}))
+
+def write_attachment(path, size):
+    """Writes a log-like text file, so that gzip has something to do
+    """
+    line = b'2020-01-01 00:00:00 :: INFO :: Scanned /data/some/folder in 0.01s\n'
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            f.write(line*1024)
+            written += len(line)*1024
+
+def bench(size_mb, port):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'attachment.log')
+        write_attachment(path, size_mb*1024*1024)
+        result = {'size_mb': size_mb}
+        for mode in MODES:
+            output = subprocess.check_output([sys.executable, __file__, '--child', mode,
+                                              path, str(port)])
+            measure = json.loads(output.decode())
+            result[mode] = {'extra_rss_mb': round((measure['peak_kb'] - measure['baseline_kb'])/1024, 1),
+                            'seconds': measure['seconds']}
+    return result
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        sys.exit()
+    server = socketserver.ThreadingTCPServer(('localhost', 0), SMTPSink)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    results = [bench(size, server.server_address[1]) for size in sizes]
+    server.shutdown()
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,75 @@
+"""Measures the latency of the time range queries against the size of the
+history, with and without the composite indexes.
+
+Usage: python benchmarks/bench_queries.py [rows ...]
+Prints the results as JSON.
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import disk_stats_settings as dss
+import disk_stats
+import queries
+
+DEVICES = 20
+DEFAULT_ROWS = (10000, 100000, 1000000)
+QUERY_DAYS = 1
+
+def fill_history(rows, end):
+    """Fills DataPoint and FolderSizeHistory with one sample per minute and
+    per device (or folder) until end
+    """
+    per_device = rows//DEVICES
+    with disk_stats.db.atomic():
+        cursor = disk_stats.db.get_cursor()
+        for i in range(DEVICES):
+            file_system = disk_stats.FileSystem.create(name='/dev/sd{0}'.format(i))
+            mount_point = disk_stats.MountPoint.create(path='/mnt/{0}'.format(i))
+            cursor.executemany('INSERT INTO "server_stats_datapoint" '
+                               '("size", "used_space", "file_system_id", "mount_point_id", "date") '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               ((2**40, j*1024, file_system.id, mount_point.id,
+                                 end - datetime.timedelta(minutes=per_device-j))
+                                for j in range(per_device)))
+            cursor.executemany('INSERT INTO "server_stats_foldersizehistory" '
+                               '("path", "size", "date") VALUES (?, ?, ?)',
+                               (('/data/{0}'.format(i), j*1024,
+                                 end - datetime.timedelta(minutes=per_device-j))
+                                for j in range(per_device)))
+
+def time_query(function, *args):
+    start = time.perf_counter()
+    count = sum(1 for _ in function(*args))
+    return (time.perf_counter() - start)*1000, count
+
+def bench(rows):
+    with tempfile.TemporaryDirectory() as directory:
+        dss.DATABASE_PATH = os.path.join(directory, 'bench.sqlite')
+        disk_stats.init_database()
+        queries.migrate_database()
+        end = datetime.datetime(2020, 1, 1)
+        fill_history(rows, end)
+        start = end - datetime.timedelta(days=QUERY_DAYS)
+        result = {'rows': rows}
+        for indexed in (True, False):
+            if not indexed:
+                disk_stats.db.drop_index(disk_stats.DataPoint, ['file_system', 'date'])
+                disk_stats.db.drop_index(disk_stats.FolderSizeHistory, ['path', 'date'])
+            key = 'indexed' if indexed else 'not_indexed'
+            result[key] = {}
+            for name, function, args in (('usage_series', queries.usage_series, ('/dev/sd0', start, end)),
+                                         ('usage_series_hourly', queries.usage_series,
+                                          ('/dev/sd0', start, end, datetime.timedelta(hours=1))),
+                                         ('folder_series', queries.folder_series, ('/data/0', start, end))):
+                latency, count = time_query(function, *args)
+                result[key][name] = {'ms': round(latency, 2), 'points': count}
+        disk_stats.db.close()
+    return result
+
+if __name__ == "__main__":
+    rows = [int(arg) for arg in sys.argv[1:]] or DEFAULT_ROWS
+    print(json.dumps([bench(count) for count in rows], indent=2))
@@ -0,0 +1,151 @@
+"""Times a whole disk_stats run, collector by collector, on a synthetic
+folder tree and a temporary database with a pre-filled history, so that two
+versions of the code can be compared.
+
+Everything runs offline: psutil is replaced by synthetic partitions and the
+mails are rendered but not sent.
+
+Usage: python benchmarks/bench_run.py [--shape wide|deep|files] [--scale N]
+                                      [--history ROWS] [--partitions N]
+                                      [--runs N] [--forecast]
+Prints the results as JSON.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import psutil
+from collections import namedtuple
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import disk_stats_settings as dss
+import disk_stats
+import queries
+from bench_queries import fill_history
+
+# The shapes of the synthetic trees: (depth, folders by folder, files by
+# folder), the number of folders by folder is multiplied by the scale
+SHAPES = {'wide': (1, 1000, 20),
+          'deep': (200, 1, 5),
+          'files': (2, 10, 500)}
+FILE_CONTENT = b'x'*100
+
+#================ Stubs ================
+Partition = namedtuple('Partition', ('device', 'mountpoint', 'fstype', 'opts'))
+Usage = namedtuple('Usage', ('total', 'used', 'free', 'percent'))
+
+class FakePsutil(object):
+    """Synthetic partitions in place of the psutil functions used by
+    disk_stats
+    """
+    def __init__(self, count):
+        self.partitions = [Partition('/dev/sd{0}'.format(i), '/mnt/{0}'.format(i), 'ext4', 'rw')
+                           for i in range(count)]
+        self.calls = 0
+
+    def disk_partitions(self, all=False):
+        return self.partitions
+
+    def disk_usage(self, path):
+        self.calls += 1
+        # Between 50 and 99% used, so that some partitions are on alert
+        total = 2**40
+        used = total*(50 + self.calls % 50)//100
+        return Usage(total, used, total - used, 100.0*used/total)
+
+class MailRecorder(object):
+    """Records the mails in place of sending them
+    """
+    def __init__(self):
+        self.mails = 0
+        self.characters = 0
+
+    def __call__(self, subject, text):
+        self.mails += 1
+        self.characters += len(text)
+
+#================ Synthetic tree ================
+def make_tree(root, depth, folders, files):
+    """Creates a tree of folders, each with the same number of sub folders and
+    files
+
+    Returns:
+        (int, int): The number of folders and files created
+    """
+    created_folders, created_files = 1, 0
+    level = [root]
+    for current_depth in range(depth + 1):
+        next_level = []
+        for path in level:
+            for i in range(files):
+                with open(os.path.join(path, 'file_{0}'.format(i)), 'wb') as f:
+                    f.write(FILE_CONTENT)
+            created_files += files
+            if current_depth < depth:
+                for i in range(folders):
+                    child = os.path.join(path, 'folder_{0}'.format(i))
+                    os.mkdir(child)
+                    next_level.append(child)
+        created_folders += len(next_level)
+        level = next_level
+    return created_folders, created_files
+
+#================ Benchmark ================
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, round((time.perf_counter() - start)*1000, 2)
+
+def bench(args):
+    depth, folders, files = SHAPES[args.shape]
+    with tempfile.TemporaryDirectory() as directory:
+        tree = os.path.join(directory, 'tree')
+        os.mkdir(tree)
+        created_folders, created_files = make_tree(tree, depth, folders*args.scale, files)
+        dss.DATABASE_PATH = os.path.join(directory, 'bench.sqlite')
+        dss.WATCHED_PATH = {tree}
+        dss.SEND_ALERTS = True
+        dss.SEND_REPORTS = True
+        dss.FORECAST_ALERTS = args.forecast
+        dss.EMAIL_OUTBOX_PATH = None
+        disk_stats.BASE_DIR = directory
+        fake_psutil = FakePsutil(args.partitions)
+        psutil.disk_partitions = fake_psutil.disk_partitions
+        psutil.disk_usage = fake_psutil.disk_usage
+        mails = MailRecorder()
+        disk_stats.send_mail = mails
+        disk_stats.init_database()
+        queries.migrate_database()
+        _, fill_ms = timed(fill_history, args.history, disk_stats.datetime.datetime.now())
+        result = {'shape': args.shape, 'folders': created_folders, 'files': created_files,
+                  'history_rows': args.history, 'partitions': args.partitions,
+                  'fill_history_ms': fill_ms, 'runs': []}
+        for _ in range(args.runs):
+            disks_report, disk_ms = timed(disk_stats.disk_stats)
+            folders_report, folders_ms = timed(disk_stats.folders_stats)
+            # Always render the reports
+            if os.path.exists(os.path.join(directory, 'reports_info.pkl')):
+                os.remove(os.path.join(directory, 'reports_info.pkl'))
+            _, reports_ms = timed(disk_stats.send_reports, disks_report, folders_report)
+            errors = [str(e) for e in disks_report.errors + folders_report.errors]
+            result['runs'].append({'disk_stats_ms': disk_ms, 'folders_stats_ms': folders_ms,
+                                   'send_reports_ms': reports_ms, 'errors': errors})
+        result['mails'] = mails.mails
+        result['mail_characters'] = mails.characters
+        disk_stats.db.close()
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shape', choices=sorted(SHAPES), default='wide')
+    parser.add_argument('--scale', type=int, default=1,
+                        help="Multiplies the number of folders by folder")
+    parser.add_argument('--history', type=int, default=100000,
+                        help="The number of data points already in the database")
+    parser.add_argument('--partitions', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=2,
+                        help="The first run creates the folders rows, the next ones update them")
+    parser.add_argument('--forecast', action='store_true',
+                        help="Compute the forecast alerts in the reports (needs numpy)")
+    print(json.dumps(bench(parser.parse_args()), indent=2))
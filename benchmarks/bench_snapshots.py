@@ -0,0 +1,112 @@
+"""Measures the folder tree snapshots on a synthetic tree: the cost of
+recording the deltas at each scan, their size against full copies of the
+tree, and the latency of rebuilding a past tree and of diffing two scans.
+
+Usage: python benchmarks/bench_snapshots.py [--nodes N] [--runs N]
+                                            [--changed FRACTION]
+Prints the results as JSON.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+from collections import OrderedDict
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import disk_stats_settings as dss
+import disk_stats
+import queries
+import scanner
+
+FANOUT = 10
+ROOT = '/data'
+
+def make_tree(count):
+    """Builds the FolderNode of a tree of count folders, FANOUT sub folders by
+    folder, parents before their children
+    """
+    nodes = OrderedDict([(ROOT, scanner.FolderNode(ROOT))])
+    queue = [ROOT]
+    position = 0
+    while len(nodes) < count:
+        parent = nodes[queue[position]]
+        position += 1
+        for i in range(FANOUT):
+            if len(nodes) >= count:
+                break
+            path = '{0}/d{1}'.format(parent.path, i)
+            nodes[path] = scanner.FolderNode(path, parent.path)
+            nodes[path].files_size = random.randrange(1, 2**30)
+            parent.children.append(path)
+            queue.append(path)
+    return nodes
+
+def database_size():
+    page_count = disk_stats.db.execute_sql('PRAGMA page_count').fetchone()[0]
+    page_size = disk_stats.db.execute_sql('PRAGMA page_size').fetchone()[0]
+    return page_count*page_size
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, round((time.perf_counter() - start)*1000, 2)
+
+def bench(args):
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        dss.DATABASE_PATH = os.path.join(directory, 'bench.sqlite')
+        dss.FOLDER_SNAPSHOT_MIN_CHANGE = 0
+        disk_stats.init_database()
+        queries.migrate_database()
+        nodes, build_ms = timed(make_tree, args.nodes)
+        folder_ids = {}
+        paths = list(nodes)
+        result = {'nodes': len(nodes), 'rows_by_scan': 2*len(nodes), 'build_ms': build_ms,
+                  'runs': []}
+        start = datetime.datetime(2020, 1, 1)
+        for run in range(args.runs):
+            if run:
+                for path in random.sample(paths, int(len(paths)*args.changed)):
+                    nodes[path].files_size += random.randrange(-2**20, 2**20)
+            scanner.aggregate_sizes(nodes)
+            date = start + datetime.timedelta(days=run)
+            size_before = database_size()
+            with disk_stats.db.atomic():
+                scan_run = disk_stats.FolderScanRun.create(date=date, full=True, rescanned=0,
+                                                           reused=0)
+                _, save_ms = timed(disk_stats.save_folder_tree, nodes, folder_ids, date,
+                                   run_id=scan_run.id)
+                _, removed_ms = timed(disk_stats.save_removed_folders, scan_run.id, ROOT, date)
+            deltas = (disk_stats.FolderSizeDelta.select()
+                                .where(disk_stats.FolderSizeDelta.run == scan_run.id).count())
+            result['runs'].append({'run': scan_run.id, 'save_ms': save_ms,
+                                   'removed_ms': removed_ms, 'deltas': deltas,
+                                   'bytes_added': database_size() - size_before})
+        # The same save without the deltas, for their cost
+        with disk_stats.db.atomic():
+            _, plain_ms = timed(disk_stats.save_folder_tree, nodes, folder_ids, date)
+            disk_stats.db.rollback()
+        result['save_without_deltas_ms'] = plain_ms
+        middle = result['runs'][len(result['runs'])//2]['run']
+        tree, rebuild_ms = timed(queries.folder_tree, middle)
+        result['rebuild'] = {'run': middle, 'ms': rebuild_ms, 'folders': len(tree)}
+        subtree, rebuild_ms = timed(queries.folder_tree, middle, ROOT + '/d1')
+        result['rebuild_subtree'] = {'ms': rebuild_ms, 'folders': len(subtree)}
+        first, last = result['runs'][0]['run'], result['runs'][-1]['run']
+        changes, diff_ms = timed(queries.folder_tree_diff, first, last)
+        result['diff'] = {'runs': [first, last], 'ms': diff_ms, 'changes': len(changes)}
+        result['delta_rows'] = disk_stats.FolderSizeDelta.select().count()
+        result['full_copy_rows'] = args.runs*2*len(nodes)
+        disk_stats.db.close()
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=1000000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--changed', type=float, default=0.01,
+                        help="The fraction of the folders whose files change at each run")
+    print(json.dumps(bench(parser.parse_args()), indent=2))
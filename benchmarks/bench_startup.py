@@ -0,0 +1,70 @@
+"""Times the start of the command line tool, command by command, in fresh
+processes on a temporary database, and lists the heavy modules each of them
+imports. The import of disk_stats with the modules it used to import
+eagerly is timed for comparison.
+
+Usage: python benchmarks/bench_startup.py [--runs N]
+Prints the results as JSON.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+PACKAGE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = os.path.join(PACKAGE, 'disk_stats_cli.py')
+HEAVY_MODULES = ('peewee', 'psutil', 'gipkomail', 'smtplib', 'playhouse.migrate', 'throttling')
+SETTINGS = """from disk_stats_settings import *
+DATABASE_PATH = {database!r}
+LOG_FILE_PATH = {log!r}
+"""
+
+def run(arguments, environment):
+    """Runs a python process
+
+    Returns:
+        (float, list): Its duration in ms and the heavy modules it imported
+    """
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + arguments,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                             env=environment, check=True)
+    duration = (time.perf_counter() - start)*1000
+    imported = {line.rsplit('|', 1)[-1].strip()
+                for line in process.stderr.decode().splitlines() if line.startswith('import time')}
+    return duration, [name for name in HEAVY_MODULES if name in imported]
+
+def bench(args):
+    with tempfile.TemporaryDirectory() as directory:
+        settings = os.path.join(directory, 'settings.py')
+        with open(settings, 'w') as f:
+            f.write(SETTINGS.format(database=os.path.join(directory, 'bench.sqlite'),
+                                    log=os.path.join(directory, 'disk_stats.log')))
+        environment = dict(os.environ, PYTHONPATH=PACKAGE)
+        cases = [('eager_import', ['-c', 'import disk_stats, psutil, gipkomail, throttling; '
+                                         'from playhouse import migrate']),
+                 ('import_disk_stats', ['-c', 'import disk_stats']),
+                 ('help', [CLI, '--help'])]
+        cases.extend((command, [CLI, '--settings', settings] + command.split())
+                     for command in ('disk', 'query', 'query folders', 'report'))
+        # Records a first sample for the queries
+        run(cases[3][1], environment)
+        result = {'runs': args.runs, 'commands': {}}
+        for name, arguments in cases:
+            durations = []
+            for _ in range(args.runs):
+                duration, modules = run(arguments, environment)
+                durations.append(duration)
+            result['commands'][name] = {'median_ms': round(statistics.median(durations), 2),
+                                        'min_ms': round(min(durations), 2),
+                                        'heavy_modules': modules}
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    print(json.dumps(bench(parser.parse_args()), indent=2))
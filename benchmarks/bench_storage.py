@@ -0,0 +1,70 @@
+"""Measures the size of the disk usage history and the latency of a range
+scan, with the data points as rows and packed in blocks.
+
+Usage: python benchmarks/bench_storage.py [days ...]
+Prints the results as JSON.
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import disk_stats_settings as dss
+import disk_stats
+import queries
+import retention
+from bench_queries import DEVICES, fill_history
+
+DEFAULT_DAYS = (1, 7, 30)
+QUERY_DAYS = 1
+
+def database_size():
+    """Returns the size of the pages in use, in bytes
+    """
+    page_count = disk_stats.db.execute_sql('PRAGMA page_count').fetchone()[0]
+    free_pages = disk_stats.db.execute_sql('PRAGMA freelist_count').fetchone()[0]
+    page_size = disk_stats.db.execute_sql('PRAGMA page_size').fetchone()[0]
+    return (page_count - free_pages)*page_size
+
+def scan(start, end):
+    """Times a range scan of every device
+
+    Returns:
+        (float, int): The latency in milliseconds and the number of points
+    """
+    begin = time.perf_counter()
+    count = sum(1 for i in range(DEVICES)
+                for _ in queries.usage_series('/dev/sd{0}'.format(i), start, end))
+    return round((time.perf_counter() - begin)*1000, 2), count
+
+def bench(days):
+    with tempfile.TemporaryDirectory() as directory:
+        dss.DATABASE_PATH = os.path.join(directory, 'bench.sqlite')
+        disk_stats.init_database()
+        queries.migrate_database()
+        end = datetime.datetime(2020, 1, 1)
+        rows = days*24*60*DEVICES
+        fill_history(rows, end)
+        # Only the data points, the folders history is not packed
+        disk_stats.FolderSizeHistory.delete().execute()
+        disk_stats.db.execute_sql('VACUUM')
+        start = end - datetime.timedelta(days=QUERY_DAYS)
+        result = {'days': days, 'rows': rows}
+        ms, points = scan(start, end)
+        result['rows_table'] = {'bytes': database_size(), 'scan_ms': ms, 'points': points}
+        begin = time.perf_counter()
+        hours = retention.pack(end)
+        pack_ms = round((time.perf_counter() - begin)*1000, 2)
+        disk_stats.db.execute_sql('VACUUM')
+        ms, points = scan(start, end)
+        result['blocks'] = {'bytes': database_size(), 'scan_ms': ms, 'points': points,
+                            'hours': hours, 'pack_ms': pack_ms,
+                            'block_rows': disk_stats.DataPointBlock.select().count()}
+        disk_stats.db.close()
+    return result
+
+if __name__ == "__main__":
+    days = [int(arg) for arg in sys.argv[1:]] or DEFAULT_DAYS
+    print(json.dumps([bench(count) for count in days], indent=2))
@@ -0,0 +1,82 @@
+import sys
+import zlib
+import array
+import struct
+import datetime
+import itertools
+
+# Packs the data points of a file system on a mount point in compact blocks :
+# each column (dates, used space, size) is delta encoded, so that a regular
+# sampling gives long runs of identical small values, then the columns are
+# compressed together with zlib. The encoding is lossless.
+VERSION = 1
+# Version and number of points
+HEADER = struct.Struct('<BI')
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+def _deltas(values):
+    previous = 0
+    for value in values:
+        yield value - previous
+        previous = value
+
+def to_microseconds(date):
+    """Converts a naive datetime to microseconds since the epoch, without any
+    time zone conversion
+    """
+    delta = date - EPOCH
+    return (delta.days*86400 + delta.seconds)*1000000 + delta.microseconds
+
+def encode(dates, used_spaces, sizes):
+    """Packs data points in a block
+
+    Arguments:
+        dates: The datetime.datetime of the points
+        used_spaces: Their used space
+        sizes: Their size
+    Returns:
+        bytes
+    """
+    count = len(dates)
+    if not count == len(used_spaces) == len(sizes):
+        raise ValueError("The columns of a block must have the same length")
+    columns = array.array('q', _deltas([to_microseconds(date) for date in dates]))
+    columns.extend(_deltas(used_spaces))
+    columns.extend(_deltas(sizes))
+    if sys.byteorder == 'big':
+        columns.byteswap()
+    return HEADER.pack(VERSION, count) + zlib.compress(columns.tobytes())
+
+def decode_columns(data):
+    """Unpacks a block in columns
+
+    Arguments:
+        data: The bytes of encode
+    Returns:
+        (list, list, list): The dates, in microseconds since the epoch, the
+                            used spaces and the sizes
+    """
+    version, count = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError("Unknown block version {0}".format(version))
+    columns = array.array('q')
+    columns.frombytes(zlib.decompress(data[HEADER.size:]))
+    if sys.byteorder == 'big':
+        columns.byteswap()
+    return (list(itertools.accumulate(columns[:count])),
+            list(itertools.accumulate(columns[count:2*count])),
+            list(itertools.accumulate(columns[2*count:])))
+
+def decode(data):
+    """Unpacks a block in data points
+
+    Arguments:
+        data: The bytes of encode
+    Returns:
+        list: The (datetime.datetime, used space, size) of the points, in the
+              order they were encoded
+    """
+    times, used_spaces, sizes = decode_columns(data)
+    return [(EPOCH + time*MICROSECOND, used_space, size)
+            for time, used_space, size in zip(times, used_spaces, sizes)]
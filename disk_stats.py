@@ -1,35 +1,91 @@
-import psutil
 import peewee
 import os
+import time
+import zlib
 import datetime
 import logging
+import threading
 import logging.handlers
 import pickle
-import gipkomail
+import scanner
+import run_metrics
 # Settings
 import disk_stats_settings as dss
 from collections import namedtuple
 
 #================ Database info ================
-db = peewee.SqliteDatabase(dss.DATABASE_PATH)
-db.connect()
+# Initialized by init_database
+db = peewee.Proxy()
+# The ids of the FileSystem and MountPoint rows by name and path, kept between
+# the runs of the daemon
+file_system_ids = {}
+mount_point_ids = {}
+# Guards the ids above, shared by the collectors threads
+ids_lock = threading.Lock()
+
+#================ Mail info ================
+# The gipkomail.Facteur sending the outbox in the background, set by the
+# daemon
+mail_carrier = None
 
 #================ Logging settings ================
 logger = logging.getLogger()
-logger.setLevel(dss.LOGGING_LEVEL)
-formatter = logging.Formatter('%(asctime)s :: %(levelname)s :: %(message)s')
-file_handler = logging.handlers.WatchedFileHandler(dss.LOG_FILE_PATH)
-file_handler.setFormatter(formatter)
-file_handler.setLevel(dss.LOGGING_LEVEL)
-logger.addHandler(file_handler)
 
 #================ Other settings ================
-date_now = datetime.datetime.now()
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 DISK_REPORT_SEPARATOR = "+"+"-"*20+"+"+"-"*40+"+"+"-"*10+"+"+"-"*10+"+"
 DISK_REPORT_STRING = "|{device: <20}|{mount_point: <40}|{used_space: >10}|{size: >10}|"
+IO_REPORT_SEPARATOR = "+"+"-"*20+"+"+"-"*40+"+"+"-"*10+"+"+"-"*10+"+"+"-"*6+"+"+"-"*6+"+"
+IO_REPORT_STRING = "|{disk: <20}|{mount_point: <40}|{read: >10}|{write: >10}|{busy: >6}|{max_busy: >6}|"
 FOLDER_REPORT_SEPARATOR = "+"+"-"*60+"+"+"-"*10+"+"
 FOLDER_REPORT_STRING = "|{folder: <60}|{size: >10}|"
+TOP_FOLDER_REPORT_SEPARATOR = "+"+"-"*60+"+"+"-"*10+"+"+"-"*10+"+"
+TOP_FOLDER_REPORT_STRING = "|{folder: <60}|{size: >10}|{growth: >10}|"
+BREAKDOWN_REPORT_SEPARATOR = "+"+"-"*30+"+"+"-"*10+"+"+"-"*10+"+"
+BREAKDOWN_REPORT_STRING = "|{key: <30}|{size: >10}|{files: >10}|"
+# Parents are set when a row is created and never change since the path is
+# the key
+FOLDER_SIZE_UPSERT = ('INSERT INTO "server_stats_foldersize" '
+                      '("id", "path", "parent_id", "size", "date", "mtime", "ctime", '
+                      '"hardlinks") VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                      'ON CONFLICT ("path") DO UPDATE '
+                      'SET "size" = excluded."size", "date" = excluded."date", '
+                      '"mtime" = excluded."mtime", "ctime" = excluded."ctime", '
+                      '"hardlinks" = excluded."hardlinks"')
+# The same, keeping in "snapshot_size" the size of the last delta of the
+# folder, the last parameter being the minimum change of a delta
+FOLDER_SIZE_SNAPSHOT_UPSERT = ('INSERT INTO "server_stats_foldersize" '
+                               '("id", "path", "parent_id", "size", "date", "mtime", "ctime", '
+                               '"hardlinks", "snapshot_size") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                               'ON CONFLICT ("path") DO UPDATE '
+                               'SET "size" = excluded."size", "date" = excluded."date", '
+                               '"mtime" = excluded."mtime", "ctime" = excluded."ctime", '
+                               '"hardlinks" = excluded."hardlinks", '
+                               '"snapshot_size" = CASE WHEN "snapshot_size" IS NULL '
+                               'OR abs(excluded."size" - "snapshot_size") > ? '
+                               'THEN excluded."size" ELSE "snapshot_size" END')
+# Run before the upsert: (run id, folder id, size, folder id, size, minimum
+# change)
+FOLDER_SIZE_DELTA_INSERT = ('INSERT INTO "server_stats_foldersizedelta" '
+                            '("run_id", "folder_id", "size") SELECT ?, ?, ? '
+                            'WHERE NOT EXISTS (SELECT 1 FROM "server_stats_foldersize" '
+                            'WHERE "id" = ? AND "snapshot_size" IS NOT NULL '
+                            'AND abs("snapshot_size" - ?) <= ?)')
+# The folders of a tree not seen by a scan are gone: (run id, first path,
+# last path excluded, date of the scan)
+FOLDER_SIZE_REMOVED_INSERT = ('INSERT INTO "server_stats_foldersizedelta" '
+                              '("run_id", "folder_id", "size") '
+                              'SELECT ?, "id", NULL FROM "server_stats_foldersize" '
+                              'WHERE "path" >= ? AND "path" < ? AND "date" != ? '
+                              'AND "snapshot_size" IS NOT NULL')
+FOLDER_SIZE_REMOVED_UPDATE = ('UPDATE "server_stats_foldersize" SET "snapshot_size" = NULL '
+                              'WHERE "path" >= ? AND "path" < ? AND "date" != ? '
+                              'AND "snapshot_size" IS NOT NULL')
+DATA_POINT_INSERT = ('INSERT INTO "server_stats_datapoint" '
+                     '("size", "used_space", "file_system_id", "mount_point_id", "date") '
+                     'VALUES (?, ?, ?, ?, ?)')
+FOLDER_SIZE_PATH_INDEX = ('CREATE UNIQUE INDEX IF NOT EXISTS "server_stats_foldersize_path" '
+                          'ON "server_stats_foldersize" ("path")')
 
 #================ ORM classes ================
 class FileSystem(peewee.Model):
@@ -79,6 +135,139 @@ class DataPoint(peewee.Model):
     class Meta:
         database = db
         db_table = 'server_stats_datapoint'
+        # For the time range queries and the rollups
+        indexes = ((('file_system', 'date'), False),
+                   (('mount_point', 'date'), False),
+                   (('date',), False))
+
+class DataPointRollup(peewee.Model):
+    """Summarizes the data points of a file system on a mount point over a
+    period. Only the subclasses have a table.
+
+    Attributes:
+        size: The last size of the file system in the period
+        used_space: The last used space in the period
+        min_used_space: The minimum used space in the period
+        max_used_space: The maximum used space in the period
+        avg_used_space: The average used space in the period
+        count: The number of data points summarized
+        file_system: The file system (Foreign key on FileSystem)
+        mount_point: The mount point of the file system (Foreign key on
+                     MountPoint)
+        date: The start of the period
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    size = peewee.BigIntegerField(db_column='size')
+    used_space = peewee.BigIntegerField(db_column='used_space')
+    min_used_space = peewee.BigIntegerField(db_column='min_used_space')
+    max_used_space = peewee.BigIntegerField(db_column='max_used_space')
+    avg_used_space = peewee.BigIntegerField(db_column='avg_used_space')
+    count = peewee.IntegerField(db_column='count')
+    file_system = peewee.ForeignKeyField(db_column='file_system_id', rel_model=FileSystem)
+    mount_point = peewee.ForeignKeyField(db_column='mount_point_id', rel_model=MountPoint)
+    date = peewee.DateTimeField(db_column='date')
+
+    class Meta:
+        database = db
+        indexes = ((('file_system', 'date'), False),
+                   (('mount_point', 'date'), False),
+                   (('date',), False))
+
+class HourlyDataPoint(DataPointRollup):
+    """Summarizes the data points of an hour
+    """
+    class Meta:
+        db_table = 'server_stats_hourlydatapoint'
+
+class DailyDataPoint(DataPointRollup):
+    """Summarizes the data points of a day
+    """
+    class Meta:
+        db_table = 'server_stats_dailydatapoint'
+
+class DataPointBlock(peewee.Model):
+    """Packs the data points of a file system on a mount point over an hour,
+    encoded by the blocks module
+
+    Attributes:
+        file_system: The file system (Foreign key on FileSystem)
+        mount_point: The mount point of the file system (Foreign key on
+                     MountPoint)
+        date: The start of the hour
+        count: The number of data points in the block
+        data: The encoded data points
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    file_system = peewee.ForeignKeyField(db_column='file_system_id', rel_model=FileSystem)
+    mount_point = peewee.ForeignKeyField(db_column='mount_point_id', rel_model=MountPoint)
+    date = peewee.DateTimeField(db_column='date')
+    count = peewee.IntegerField(db_column='count')
+    data = peewee.BlobField(db_column='data')
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_datapointblock'
+        indexes = ((('file_system', 'date'), False),
+                   (('mount_point', 'date'), False),
+                   (('date',), False))
+
+class IODisk(peewee.Model):
+    """Represents a disk of the I/O counters in the database, and the file
+    system and mount point it was last seen on
+
+    Attributes:
+        name: The name of the disk in the kernel counters (as sda1 or dm-0)
+        file_system: The file system on the disk (Foreign key on FileSystem),
+                     None if not mounted
+        mount_point: A mount point of the file system (Foreign key on
+                     MountPoint), None if not mounted
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    name = peewee.CharField(db_column='name', max_length=128, unique=True)
+    file_system = peewee.ForeignKeyField(db_column='file_system_id', rel_model=FileSystem,
+                                         null=True)
+    mount_point = peewee.ForeignKeyField(db_column='mount_point_id', rel_model=MountPoint,
+                                         null=True)
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_iodisk'
+
+class IOSample(peewee.Model):
+    """The I/O throughput of a disk between two readings of its counters
+
+    Attributes:
+        disk: The disk (Foreign key on IODisk)
+        date: The date of the second reading
+        duration: The time between the readings, in seconds
+        read_bytes: The bytes read by second
+        write_bytes: The bytes written by second
+        read_ops: The reads by second
+        write_ops: The writes by second
+        utilization: The fraction of the time the disk was busy, None if the
+                     platform does not tell
+        read_latency: The mean time of a read, in milliseconds, None without
+                      reads
+        write_latency: The mean time of a write, in milliseconds, None without
+                       writes
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    disk = peewee.ForeignKeyField(db_column='disk_id', rel_model=IODisk)
+    date = peewee.DateTimeField(db_column='date')
+    duration = peewee.FloatField(db_column='duration')
+    read_bytes = peewee.BigIntegerField(db_column='read_bytes')
+    write_bytes = peewee.BigIntegerField(db_column='write_bytes')
+    read_ops = peewee.FloatField(db_column='read_ops')
+    write_ops = peewee.FloatField(db_column='write_ops')
+    utilization = peewee.FloatField(db_column='utilization', null=True)
+    read_latency = peewee.FloatField(db_column='read_latency', null=True)
+    write_latency = peewee.FloatField(db_column='write_latency', null=True)
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_iosample'
+        indexes = ((('disk', 'date'), False),
+                   (('date',), False))
 
 class FolderSize(peewee.Model):
     """Stores the size of a folder
@@ -88,12 +277,24 @@ class FolderSize(peewee.Model):
         path: The path of the folder
         size: The size of the folder
         date: The date of the last measurement
+        mtime: The modification time of the folder at the last measurement,
+               in nanoseconds (None for the virtual files folders)
+        ctime: The change time of the folder at the last measurement, in
+               nanoseconds (None for the virtual files folders)
+        snapshot_size: The size of the last FolderSizeDelta of the folder,
+                       None if it has none or is gone
+        hardlinks: The number of files with several links in the folder at
+                   the last measurement (None for the virtual files folders)
     """
     id = peewee.PrimaryKeyField(db_column='id')
-    path = peewee.CharField(max_length=256, db_column='path')
+    path = peewee.CharField(max_length=256, db_column='path', unique=True)
     parent = peewee.ForeignKeyField('self', db_column='parent_id', null=True)
     size = peewee.BigIntegerField(db_column='size')
     date = peewee.DateTimeField(db_column='date')
+    mtime = peewee.BigIntegerField(db_column='mtime', null=True)
+    ctime = peewee.BigIntegerField(db_column='ctime', null=True)
+    snapshot_size = peewee.BigIntegerField(db_column='snapshot_size', null=True)
+    hardlinks = peewee.IntegerField(db_column='hardlinks', null=True)
 
     class Meta:
         database = db
@@ -116,44 +317,637 @@ class FolderSizeHistory(peewee.Model):
     class Meta:
         database = db
         db_table = 'server_stats_foldersizehistory'
+        # For the time range queries
+        indexes = ((('path', 'date'), False),)
+
+class FolderScanRun(peewee.Model):
+    """Stores how a folders scan went
+
+    Attributes:
+        date: The date of the scan
+        full: Whether every folder was listed
+        rescanned: The number of folders listed
+        reused: The number of unchanged folders taken from the previous scan
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    date = peewee.DateTimeField(db_column='date')
+    full = peewee.BooleanField(db_column='full')
+    rescanned = peewee.IntegerField(db_column='rescanned')
+    reused = peewee.IntegerField(db_column='reused')
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_folderscanrun'
+
+class FolderSizeDelta(peewee.Model):
+    """Stores the size of a folder at a scan when it changed by more than
+    dss.FOLDER_SNAPSHOT_MIN_CHANGE since its previous delta, so that the tree
+    of any scan can be rebuilt from the deltas of the scans up to it
+
+    Attributes:
+        run: The scan (Foreign key on FolderScanRun)
+        folder: The folder (Foreign key on FolderSize)
+        size: The size of the folder, None if it was gone
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    run = peewee.ForeignKeyField(db_column='run_id', rel_model=FolderScanRun)
+    folder = peewee.ForeignKeyField(db_column='folder_id', rel_model=FolderSize)
+    size = peewee.BigIntegerField(db_column='size', null=True)
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_foldersizedelta'
+        # For the last delta of each folder up to a scan
+        indexes = ((('folder', 'run'), True),)
+
+class TopFolderSize(peewee.Model):
+    """Stores a folder of the top lists of a folders scan
+
+    Attributes:
+        run: The scan (Foreign key on FolderScanRun)
+        ranking: 'largest' or 'growing'
+        rank: The position of the folder in its list, from 1
+        path: The path of the folder
+        size: The size of the folder
+        growth: The change of its size since the previous scan, None if it
+                was not known
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    run = peewee.ForeignKeyField(db_column='run_id', rel_model=FolderScanRun)
+    ranking = peewee.CharField(db_column='ranking', max_length=16)
+    rank = peewee.IntegerField(db_column='rank')
+    path = peewee.CharField(max_length=256, db_column='path')
+    size = peewee.BigIntegerField(db_column='size')
+    growth = peewee.BigIntegerField(db_column='growth', null=True)
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_topfoldersize'
+
+class FolderBreakdown(peewee.Model):
+    """Stores the bytes and files of a watched folder for a key of a
+    dimension at a full folders scan
+
+    Attributes:
+        run: The scan (Foreign key on FolderScanRun)
+        path: The watched folder
+        dimension: 'uid', 'gid', 'extension' or 'age'
+        key: The owner or group id, the extension without its dot ('' for
+             none), the age bucket, or 'other' for the keys not kept
+        size: The size of its files
+        files: The number of its files
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    run = peewee.ForeignKeyField(db_column='run_id', rel_model=FolderScanRun)
+    path = peewee.CharField(max_length=256, db_column='path')
+    dimension = peewee.CharField(db_column='dimension', max_length=16)
+    key = peewee.CharField(db_column='key', max_length=64)
+    size = peewee.BigIntegerField(db_column='size')
+    files = peewee.BigIntegerField(db_column='files')
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_folderbreakdown'
+
+class ScanCheckpoint(peewee.Model):
+    """Stores where an unfinished folders scan pass stopped, see
+    resume_folders_scan
+
+    Attributes:
+        run: The scan (Foreign key on FolderScanRun)
+        date: The date the checkpoint was saved
+        data: The ScanPass, pickled and compressed
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    run = peewee.ForeignKeyField(db_column='run_id', rel_model=FolderScanRun)
+    date = peewee.DateTimeField(db_column='date')
+    data = peewee.BlobField(db_column='data')
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_scancheckpoint'
+
+class AlertState(peewee.Model):
+    """Stores an alert of the alert engine, from when it fires until it is
+    cleared
+
+    Attributes:
+        rule: The name of the rule
+        mount_point: The path of the mount point
+        device: The file system mounted on it
+        value: The value of the metric when the alert fired
+        fired: The date the alert fired
+        cleared: The date it was cleared, None while it fires
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    rule = peewee.CharField(db_column='rule', max_length=64)
+    mount_point = peewee.CharField(db_column='mount_point', max_length=256)
+    device = peewee.CharField(db_column='device', max_length=256)
+    value = peewee.FloatField(db_column='value')
+    fired = peewee.DateTimeField(db_column='fired')
+    cleared = peewee.DateTimeField(db_column='cleared', null=True)
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_alertstate'
+        # For the alerts firing
+        indexes = ((('cleared',), False),)
+
+class RunMetrics(peewee.Model):
+    """Stores what a collector run did and how long it took
+
+    Attributes:
+        collector: The name of the collector
+        date: The start of the run
+        wall_time: The duration of the run, in seconds
+        cpu_time: The CPU time of the process during the run, in seconds
+        dirs: The number of directories listed
+        files: The number of files counted
+        bytes: The size of the files counted
+        scandir_calls: The number of directories read
+        stat_calls: The number of stat calls
+        db_statements: The number of SQL statements executed
+        mails: The number of mails sent or queued
+        errors: The number of errors
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    collector = peewee.CharField(db_column='collector', max_length=32)
+    date = peewee.DateTimeField(db_column='date')
+    wall_time = peewee.FloatField(db_column='wall_time')
+    cpu_time = peewee.FloatField(db_column='cpu_time')
+    dirs = peewee.BigIntegerField(db_column='dirs')
+    files = peewee.BigIntegerField(db_column='files')
+    bytes = peewee.BigIntegerField(db_column='bytes')
+    scandir_calls = peewee.BigIntegerField(db_column='scandir_calls')
+    stat_calls = peewee.BigIntegerField(db_column='stat_calls')
+    db_statements = peewee.BigIntegerField(db_column='db_statements')
+    mails = peewee.IntegerField(db_column='mails')
+    errors = peewee.IntegerField(db_column='errors')
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_runmetrics'
+        indexes = ((('collector', 'date'), False),)
+
+class RunStage(peewee.Model):
+    """Stores the time spent in a stage of a collector run
+
+    Attributes:
+        run: The run (Foreign key on RunMetrics)
+        stage: The name of the stage
+        wall_time: The time spent in the stage, in seconds
+        cpu_time: The CPU time of the process during the stage, in seconds
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    run = peewee.ForeignKeyField(db_column='run_id', rel_model=RunMetrics)
+    stage = peewee.CharField(db_column='stage', max_length=32)
+    wall_time = peewee.FloatField(db_column='wall_time')
+    cpu_time = peewee.FloatField(db_column='cpu_time')
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_runstage'
 
-Report = namedtuple('Report', ('data', 'errors'))
+Report = namedtuple('Report', ('data', 'errors', 'details'))
+
+#================ Setup functions ================
+def init_database(pooled=False):
+    """Opens the database at dss.DATABASE_PATH
+
+    Arguments:
+        pooled: Use a pool of connections shared by the threads of the
+                process, instead of a single connection opened now
+    """
+    # Applied on every new connection. A new database is created with
+    # incremental auto vacuum, so that retention.vacuum can free its pages
+    pragmas = [('auto_vacuum', 'incremental')]
+    if dss.SQLITE_TUNING:
+        pragmas.extend(dss.SQLITE_TUNING_PRAGMAS)
+    if pooled:
+        # The collectors of the daemon write at the same time : the readers
+        # must not block the writers, and a writer waits for the others
+        # rather than failing
+        names = {name for name, value in pragmas}
+        pragmas.extend(pragma for pragma in (('journal_mode', 'wal'),
+                                             ('busy_timeout',
+                                              int(dss.DAEMON_BUSY_TIMEOUT.total_seconds()*1000)))
+                       if pragma[0] not in names)
+    with ids_lock:
+        file_system_ids.clear()
+        mount_point_ids.clear()
+    if pooled:
+        # Imported here, only the daemon needs it
+        from playhouse.pool import PooledSqliteDatabase
+        database = PooledSqliteDatabase(dss.DATABASE_PATH, pragmas=pragmas,
+                                        max_connections=dss.DAEMON_MAX_CONNECTIONS,
+                                        stale_timeout=None, check_same_thread=False)
+        db.initialize(database)
+    else:
+        database = peewee.SqliteDatabase(dss.DATABASE_PATH, pragmas=pragmas)
+        db.initialize(database)
+        db.connect()
+
+def setup_logging():
+    """Sends the logs to dss.LOG_FILE_PATH
+    """
+    logger.setLevel(dss.LOGGING_LEVEL)
+    formatter = logging.Formatter('%(asctime)s :: %(levelname)s :: %(message)s')
+    file_handler = logging.handlers.WatchedFileHandler(dss.LOG_FILE_PATH)
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(dss.LOGGING_LEVEL)
+    logger.addHandler(file_handler)
 
 #================ Tool functions ================
-def folder_stats(path, parent=None):
-    """Computes the size of a folder and its children, recursivly.
-    Updates the database.
+def add_missing_columns(model):
+    """Adds to the table of a model the columns created after it
+
+    Arguments:
+        model: The peewee model
+    """
+    # Imported here, only needed once by database
+    from playhouse import migrate
+    table = model._meta.db_table
+    columns = {column.name for column in db.get_columns(table)}
+    migrator = migrate.SqliteMigrator(db)
+    operations = [migrator.add_column(table, field.db_column, field)
+                  for field in model._meta.sorted_fields
+                  if field.db_column not in columns]
+    if operations:
+        logger.info("Adding columns to {table}".format(table=table))
+        migrate.migrate(*operations)
+
+def add_missing_indexes(model):
+    """Creates the indexes of a model declared after its table was created
+
+    Arguments:
+        model: The peewee model
+    """
+    table = model._meta.db_table
+    existing = {index.name for index in db.get_indexes(table)}
+    for fields, unique in model._meta.indexes:
+        columns = [model._meta.fields[field].db_column for field in fields]
+        if db.compiler().index_name(table, columns) not in existing:
+            logger.info("Adding index on {table} {columns}".format(table=table,
+                                                                   columns=columns))
+            db.create_index(model, fields, unique)
+
+def save_run_metrics(metrics):
+    """Stops a run_metrics recorder and writes what it recorded in the
+    database, if enabled
+
+    Arguments:
+        metrics: The run_metrics recorder of the run
+    """
+    metrics.stop()
+    if not metrics.enabled:
+        return
+    logger.info("Run metrics of {0}".format(metrics))
+    try:
+        RunMetrics.create_table(fail_silently=True)
+        RunStage.create_table(fail_silently=True)
+        with db.atomic():
+            run = RunMetrics.create(collector=metrics.collector, date=metrics.date,
+                                    wall_time=metrics.wall_time, cpu_time=metrics.cpu_time,
+                                    **metrics.counters)
+            if metrics.stages:
+                RunStage.insert_many([{'run': run.id, 'stage': name, 'wall_time': wall,
+                                       'cpu_time': cpu}
+                                      for name, (wall, cpu) in metrics.stages.items()]).execute()
+    except Exception as e:
+        logger.error("Failed to save run metrics : {0} ({1})".format(e, e.__class__))
+
+def get_id(model, field, value, ids, new_ids):
+    """Returns the id of the row of a model having a value, creating the row
+    if needed
+
+    Arguments:
+        model: The peewee model
+        field: The unique field of the model holding the value
+        value: The value
+        ids: The ids of the committed rows by value
+        new_ids: The ids found by the transaction of the calling thread by
+                 value, updated with the row, to add to ids with
+                 remember_ids once committed
+    Returns:
+        int
+    """
+    # The lock only guards the ids: a thread waiting for the write lock of
+    # the database must not hold it
+    with ids_lock:
+        row_id = ids.get(value)
+    if row_id is None:
+        row_id = new_ids.get(value)
+    if row_id is None:
+        row_id = model.select(model.id).where(field == value).scalar()
+        if row_id is None:
+            try:
+                # A savepoint, so that only the insert is rolled back
+                with db.atomic():
+                    row_id = model.insert(**{field.name: value}).execute()
+            except peewee.IntegrityError:
+                # Inserted by another thread since, the value is unique
+                row_id = model.select(model.id).where(field == value).scalar()
+        new_ids[value] = row_id
+    return row_id
+
+def remember_ids(ids, new_ids):
+    """Adds the ids found by get_id to the ids of the committed rows, once
+    the transaction is committed: the rows of a rolled back transaction are
+    gone.
+    """
+    with ids_lock:
+        ids.update(new_ids)
+
+def load_folder_ids():
+    """Loads the id of every folder already in the database
+
+    Returns:
+        dict: The FolderSize ids by path
+    """
+    return dict(FolderSize.select(FolderSize.path, FolderSize.id).tuples())
+
+def save_folder_tree(nodes, folder_ids, date_now, parent_id=None, top=None, run_id=None):
+    """Writes a scanned tree and its virtual files folders in the database,
+    by chunks of dss.FOLDER_SIZE_CHUNK_SIZE rows.
+    The ids of existing rows, and so the parents, are kept.
+
+    Arguments:
+        nodes: The FolderNode by path, parents before their children
+        folder_ids: The FolderSize ids by path, updated with the new rows
+        date_now: The date of the measurement
+        parent_id: The id of the parent of the root of the tree
+        top: A scanner.TopFolders to add the folders to, their growth is
+             found against the sizes of the chunk before it is written
+        run_id: The id of the FolderScanRun to record the FolderSizeDelta of
+                the changed folders for, None to record none
+    """
+    date = FolderSize.date.db_value(date_now)
+    next_id = max(folder_ids.values()) + 1 if folder_ids else 1
+    # The folders new in a tree already scanned grew from nothing
+    root_known = next(iter(nodes)) in folder_ids
+    rows = []
+    depths = {}
+    # The path and depth of the folders for top, by id
+    top_folders = {}
+    for node in nodes.values():
+        node_parent_id = folder_ids[node.parent] if node.parent is not None else parent_id
+        # Virtual folder for all the files at this level
+        file_folder_path = os.path.join(node.path, dss.FILE_VIRTUAL_FOLDER_NAME)
+        for path in (node.path, file_folder_path):
+            if path not in folder_ids:
+                folder_ids[path] = next_id
+                next_id += 1
+        rows.append((folder_ids[node.path], node.path, node_parent_id,
+                     node.size, date, node.mtime, node.ctime, node.hardlinks))
+        rows.append((folder_ids[file_folder_path], file_folder_path,
+                     folder_ids[node.path], node.files_size, date, None, None, None))
+        if top is not None:
+            depth = depths[node.path] = depths[node.parent] + 1 if node.parent in depths else 0
+            top_folders[folder_ids[node.path]] = (node.path, depth)
+    cursor = db.get_cursor()
+    min_change = dss.FOLDER_SNAPSHOT_MIN_CHANGE
+    for i in range(0, len(rows), dss.FOLDER_SIZE_CHUNK_SIZE):
+        chunk = rows[i:i+dss.FOLDER_SIZE_CHUNK_SIZE]
+        # One transaction per chunk, a savepoint if the caller holds one
+        with db.atomic():
+            if top is not None:
+                chunk_ids = [row[0] for row in chunk if row[0] in top_folders]
+                previous_sizes = dict(FolderSize.select(FolderSize.id, FolderSize.size)
+                                                .where(FolderSize.id << chunk_ids)
+                                                .tuples())
+                for row in chunk:
+                    if row[0] not in top_folders:
+                        continue
+                    path, depth = top_folders[row[0]]
+                    previous_size = previous_sizes.get(row[0])
+                    if previous_size is not None:
+                        growth = row[3] - previous_size
+                    else:
+                        growth = row[3] if root_known else None
+                    top.add(path, depth, row[3], growth)
+            if run_id is None:
+                cursor.executemany(FOLDER_SIZE_UPSERT, chunk)
+                continue
+            # The deltas are found against the sizes before the upsert
+            cursor.executemany(FOLDER_SIZE_DELTA_INSERT,
+                               ((run_id, row[0], row[3], row[0], row[3], min_change)
+                                for row in chunk))
+            cursor.executemany(FOLDER_SIZE_SNAPSHOT_UPSERT,
+                               (row + (row[3], min_change) for row in chunk))
+
+def save_removed_folders(run_id, path, date_now):
+    """Records the deltas of the folders of a tree gone since its previous
+    scan
+
+    Arguments:
+        run_id: The id of the FolderScanRun
+        path: The root of the tree, just saved
+        date_now: The date of the scan
+    """
+    prefix = path if path.endswith(os.sep) else path + os.sep
+    # Every path below the root sorts between these two
+    params = (prefix, prefix[:-1] + chr(ord(os.sep) + 1), FolderSize.date.db_value(date_now))
+    db.execute_sql(FOLDER_SIZE_REMOVED_INSERT, (run_id,) + params)
+    db.execute_sql(FOLDER_SIZE_REMOVED_UPDATE, params)
+
+def save_top_folders(scan_run, top):
+    """Writes the top lists of a scan in the database
+
+    Arguments:
+        scan_run: The saved FolderScanRun of the scan
+        top: The scanner.TopFolders of the scan
+    """
+    rows = [{'run': scan_run.id, 'ranking': ranking, 'rank': rank, 'path': folder.path,
+             'size': folder.size, 'growth': folder.growth}
+            for ranking, folders in (('largest', top.largest()),
+                                     ('growing', top.fastest_growing()))
+            for rank, folder in enumerate(folders, 1)]
+    if rows:
+        TopFolderSize.insert_many(rows).execute()
+
+def save_breakdown(run_id, path, breakdown):
+    """Writes the breakdown of a watched folder in the database, its
+    dss.FOLDER_BREAKDOWN_MAX_KEYS largest keys by dimension
+
+    Arguments:
+        run_id: The id of the FolderScanRun of the scan
+        path: The watched folder
+        breakdown: Its scanner.Breakdown
     """
-    folder_size = None
-    # We want only one row by path
+    rows = [(run_id, path, dimension, str(key), size, files)
+            for dimension in breakdown.DIMENSIONS
+            for key, size, files in breakdown.top(dimension, dss.FOLDER_BREAKDOWN_MAX_KEYS)]
+    for i in range(0, len(rows), dss.FOLDER_SIZE_CHUNK_SIZE):
+        FolderBreakdown.insert_many([dict(zip(('run', 'path', 'dimension', 'key', 'size', 'files'),
+                                              row))
+                                     for row in rows[i:i+dss.FOLDER_SIZE_CHUNK_SIZE]]).execute()
+
+def breakdown_key_name(dimension, key):
+    """Names an owner or a group id for the report
+    """
+    # Imported here, only the reports need the names
+    import pwd
+    import grp
+    try:
+        if dimension == 'uid' and key != scanner.Breakdown.OTHER:
+            return pwd.getpwuid(key).pw_name
+        if dimension == 'gid' and key != scanner.Breakdown.OTHER:
+            return grp.getgrgid(key).gr_name
+    except KeyError:
+        pass
+    if dimension == 'extension' and key == '':
+        return '(none)'
+    return str(key)
+
+class ScanPass(object):
+    """A pass of the folders scan over the watched paths, which can span
+    several runs
+
+    Attributes:
+        run_id: The id of its FolderScanRun
+        date: The date of the pass, that of its first run, used for all its
+              rows
+        full: Whether every folder is listed
+        pending: The watched paths not scanned yet
+        state: The scanner.ScanState of the path being scanned, None
+               between two paths
+        sizes: The size of the watched paths scanned, by path
+        breakdowns: Their scanner.Breakdown by path, for the report
+        top: The scanner.TopFolders of the pass, None to not keep them
+    """
+    def __init__(self, run_id, date, full, pending, top=None):
+        self.run_id = run_id
+        self.date = date
+        self.full = full
+        self.pending = list(pending)
+        self.state = None
+        self.sizes = {}
+        self.breakdowns = {}
+        self.top = top
+
+    @property
+    def done(self):
+        return self.state is None and not self.pending
+
+def load_checkpoint():
+    """Loads the unfinished scan pass of a previous run
+
+    Returns:
+        ScanPass: The pass, None if there is none or it can not be read
+    """
+    checkpoint = ScanCheckpoint.select().order_by(ScanCheckpoint.id.desc()).first()
+    if checkpoint is None:
+        return None
     try:
-        folder_size = FolderSize.get(path=path)
-    except FolderSize.DoesNotExist:
-        folder_size = FolderSize.create(path=path, parent=parent,
-                                        size=0, date=date_now)
-    # Compute actual size
-    path_size = 0
-    base_path, folders, files = next(os.walk(path))
-    path_size += sum(folder_stats(os.path.join(base_path, folder),
-                                   folder_size) for folder in folders)
-    file_size = sum(os.path.getsize(os.path.join(base_path, file_)) for
-                                     file_ in files)
-
-    path_size += file_size
-    # Create model
-    folder_size.size = path_size
-    folder_size.save()
-    # Create virtual folder for all the files at this level
-    file_folder = None
-    file_folder_path = os.path.join(base_path, dss.FILE_VIRTUAL_FOLDER_NAME)
+        return pickle.loads(zlib.decompress(bytes(checkpoint.data)))
+    except Exception as e:
+        logger.warning("Ignoring the scan checkpoint of {0} : {1}".format(checkpoint.date, e))
+        return None
+
+def save_checkpoint(scan_pass):
+    """Replaces the saved scan pass, in the transaction of the rows it
+    accounts for
+
+    Arguments:
+        scan_pass: The ScanPass, None once it is done
+    """
+    ScanCheckpoint.delete().execute()
+    if scan_pass is not None:
+        data = zlib.compress(pickle.dumps(scan_pass, pickle.HIGHEST_PROTOCOL))
+        ScanCheckpoint.create(run=scan_pass.run_id, date=datetime.datetime.now(), data=data)
+
+def load_previous_folders():
+    """Loads what the previous scans found about the folders, for the
+    incremental scans.
+    The folders not updated by the same scan as their parent are gone and
+    are ignored.
+
+    Returns:
+        dict: The scanner.PreviousFolder by path
+    """
+    rows = {}
+    files_sizes = {}
+    children = {}
+    query = FolderSize.select(FolderSize.id, FolderSize.path, FolderSize.parent,
+                              FolderSize.size, FolderSize.date, FolderSize.mtime,
+                              FolderSize.ctime, FolderSize.hardlinks)
+    for row in query.tuples():
+        rows[row[0]] = row
+    for id_, path, parent_id, size, date, mtime, ctime, hardlinks in rows.values():
+        parent = rows.get(parent_id)
+        if parent is None or parent[4] != date:
+            continue
+        if os.path.basename(path) == dss.FILE_VIRTUAL_FOLDER_NAME:
+            files_sizes[parent[1]] = size
+        else:
+            children.setdefault(parent[1], []).append(path)
+    return {path: scanner.PreviousFolder(mtime, ctime, files_sizes[path],
+                                         children.get(path, []), hardlinks)
+            for id_, path, parent_id, size, date, mtime, ctime, hardlinks in rows.values()
+            if mtime is not None and path in files_sizes}
+
+def is_full_scan_due():
+    """Tells if the next folders scan must list every folder
+
+    Returns:
+        bool
+    """
+    if not dss.INCREMENTAL_SCAN:
+        return True
+    last_full_scan = (FolderScanRun.select(peewee.fn.MAX(FolderScanRun.id))
+                                   .where(FolderScanRun.full == True).scalar())
+    if last_full_scan is None:
+        return True
+    runs_since = FolderScanRun.select().where(FolderScanRun.id > last_full_scan).count()
+    return runs_since + 1 >= dss.FULL_SCAN_EVERY
+
+def scan_folders(paths, previous=None, breakdown=None, profiler=None):
+    """Computes the size of folders and their children with the scanner, in
+    parallel if dss.SCAN_WORKERS is more than 1.
+
+    Arguments:
+        paths: The paths of the folders to scan
+        previous: The scanner.PreviousFolder by path, for an incremental scan
+        breakdown: An empty scanner.Breakdown, copied for each folder, to
+                   count their files by key in ScanStats.breakdown
+        profiler: A run_metrics.Profiler to profile the scans with, dumped
+                  once they are done. Only the serial scan is profiled, no
+                  stats are written for a parallel one.
+    Yields:
+        (str, dict, ScanStats): The path of a folder, the FolderNode of its
+                                tree and the scan statistics, as soon as it is
+                                scanned
+    """
+    # Imported here, like psutil, only the scans need them
+    import throttling
+    throttle = throttling.scan_throttle(paths)
+    scan_folder = scanner.scan_folder
+    if profiler is not None:
+        scan_folder = profiler.wrap(scan_folder)
+    if dss.SCAN_WORKERS > 1:
+        if profiler is not None:
+            logger.warning("The workers of the parallel scan are not profiled, "
+                           "set SCAN_WORKERS to 1 to profile the scan")
+            profiler = None
+        parallel_scanner = scanner.ParallelScanner(dss.SCAN_WORKERS,
+                                                   dss.SCAN_WORKERS_PER_DEVICE,
+                                                   previous, throttle=throttle,
+                                                   on_start=throttling.lower_thread_priority,
+                                                   breakdown=breakdown)
+        results = parallel_scanner.scan(paths)
+    else:
+        results = ((path,) + throttling.run_with_lower_priority(
+                       scan_folder, path, previous=previous, throttle=throttle,
+                       stats=scanner.ScanStats(breakdown.empty() if breakdown is not None
+                                               else None))
+                   for path in paths)
     try:
-        file_folder = FolderSize.get(path=file_folder_path)
-    except FolderSize.DoesNotExist:
-        file_folder = FolderSize.create(path=file_folder_path,
-                                        parent=folder_size, size=file_size,
-                                        date=date_now)
-    file_folder.save()
-    return path_size
+        for path, nodes, stats in results:
+            logger.info("Scanned {path} : {stats}".format(path=path, stats=stats))
+            yield path, nodes, stats
+    finally:
+        if profiler is not None:
+            profiler.dump()
 
 SIZE_UNITS = ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']
 def sizeof_fmt(size, suffix="o"):
@@ -174,7 +968,219 @@ def sizeof_fmt(size, suffix="o"):
         size /= 1024
     return result
 
+def forecast_alerts():
+    """Projects when the devices will be full from their history
+
+    Returns:
+        list: The (key in the reports dictionary, alert line) of the devices
+              and watched folders projected to fill their device within
+              dss.FORECAST_HOURS_FOR_ALERT
+    """
+    alerts = []
+    try:
+        # Imported here, numpy is only needed for the forecasts
+        import forecast
+        device_forecasts, folder_forecasts = forecast.forecast()
+    except Exception as e:
+        logger.error("Failed to compute forecasts : {0} ({1})".format(e, e.__class__))
+        return alerts
+    for device in device_forecasts:
+        if device.hours <= dss.FORECAST_HOURS_FOR_ALERT:
+            alerts.append(("forecast " + device.device,
+                           dss.DISK_FORECAST_ALERT_STRING.format(device=device.device,
+                                                                 mount_point=device.mount_point,
+                                                                 hours=int(device.hours))))
+    for folder in folder_forecasts:
+        if folder.hours <= dss.FORECAST_HOURS_FOR_ALERT:
+            alerts.append(("forecast " + folder.folder,
+                           dss.FOLDER_FORECAST_ALERT_STRING.format(folder=folder.folder,
+                                                                   mount_point=folder.mount_point,
+                                                                   rate=sizeof_fmt(folder.rate*3600),
+                                                                   hours=int(folder.hours))))
+    return alerts
+
+def create_mail_carrier():
+    """Creates the gipkomail.Facteur sending the mails queued in
+    dss.EMAIL_OUTBOX_PATH
+
+    Returns:
+        gipkomail.Facteur: Not started
+    """
+    # Imported here, with the mail stack, only to send mails
+    import gipkomail
+    connection = gipkomail.ConnexionSMTP(dss.EMAIL_SERVER, dss.EMAIL_PORT,
+                                         dss.EMAIL_USER_NAME, dss.EMAIL_PASSWORD)
+    return gipkomail.Facteur(gipkomail.BoiteEnvoi(dss.EMAIL_OUTBOX_PATH), connection,
+                             taille_lot=dss.EMAIL_BATCH_SIZE,
+                             delai=dss.EMAIL_RETRY_DELAY.total_seconds(),
+                             delai_max=dss.EMAIL_RETRY_MAX_DELAY.total_seconds(),
+                             tentatives_max=dss.EMAIL_MAX_ATTEMPTS,
+                             journal=logger)
+
+def io_report_lines(start, end):
+    """Formats the I/O of the disks over a time range as a table
+
+    Arguments:
+        start: The start of the range
+        end: The end of the range
+    Returns:
+        list: The lines of the table, empty without samples
+    """
+    # Imported here, it needs the models of this module
+    import queries
+    summaries = queries.io_summary(start, end)
+    if not summaries:
+        return []
+    percentage = lambda value: "{0:.0f}%".format(100*value) if value is not None else "-"
+    lines = [IO_REPORT_SEPARATOR,
+             IO_REPORT_STRING.format(disk="disk", mount_point="mount point", read="read/s",
+                                     write="write/s", busy="busy", max_busy="max"),
+             IO_REPORT_SEPARATOR]
+    for summary in summaries:
+        lines.append(IO_REPORT_STRING.format(disk=summary.device or summary.disk,
+                                             mount_point=summary.mount_point or "",
+                                             read=sizeof_fmt(summary.read_bytes),
+                                             write=sizeof_fmt(summary.write_bytes),
+                                             busy=percentage(summary.utilization),
+                                             max_busy=percentage(summary.max_utilization)))
+    lines.append(IO_REPORT_SEPARATOR)
+    lines.append("")
+    return lines
+
+def send_mail(subject, text):
+    """Sends a mail to dss.EMAIL_TO, or queues it in dss.EMAIL_OUTBOX_PATH if
+    set
+
+    Arguments:
+        subject: The subject of the mail
+        text: The plain text content of the mail
+    """
+    # Imported here, with the mail stack, only to send mails
+    import gipkomail
+    if dss.EMAIL_OUTBOX_PATH is None:
+        gipkomail.envoyer_message(dss.EMAIL_SERVER, dss.EMAIL_FROM, dss.EMAIL_TO,
+                                  subject, text, dss.EMAIL_USER_NAME,
+                                  dss.EMAIL_PASSWORD, port=dss.EMAIL_PORT)
+    else:
+        outbox = gipkomail.BoiteEnvoi(dss.EMAIL_OUTBOX_PATH)
+        outbox.ajouter(dss.EMAIL_FROM, dss.EMAIL_TO, subject, text)
+        if mail_carrier is not None:
+            mail_carrier.reveiller()
+
+def report_lines(disks_report, folders_report, start, date_now):
+    """Renders the report of the collectors runs
+
+    Arguments:
+        disks_report: The Report of disk_stats
+        folders_report: The Report of folders_stats
+        start: The start of the I/O summary
+        date_now: Its end
+    Returns:
+        list of str: The lines of the report, empty if there is nothing to
+                     report
+    """
+    reports_lines = []
+    # Disks report
+    if disks_report.data:
+        # Table header
+        reports_lines.append(DISK_REPORT_SEPARATOR)
+        reports_lines.append(DISK_REPORT_STRING.format(device="device",
+                                                       mount_point="mount point",
+                                                       used_space="used space",
+                                                       size="size"))
+        reports_lines.append(DISK_REPORT_SEPARATOR)
+        for disk in disks_report.data:
+            reports_lines.append(DISK_REPORT_STRING.format(device=disk.file_system.name,
+                                                          mount_point=disk.mount_point.path,
+                                                          used_space=sizeof_fmt(disk.used_space),
+                                                          size=sizeof_fmt(disk.size)))
+        # Table footer and vertical space
+        reports_lines.append(DISK_REPORT_SEPARATOR)
+        reports_lines.append("")
+    if disks_report.errors:
+        reports_lines.append(dss.DISK_REPORT_ERROR_STRING.format(error=disks_report.errors[0]))
+        reports_lines.append("")
+    # I/O report, since the previous report
+    if dss.IO_STATS:
+        try:
+            reports_lines.extend(io_report_lines(start, date_now))
+        except Exception as e:
+            logger.error("Failed to summarize the I/O : {0} ({1})".format(e, e.__class__))
+    # Folders report
+    if folders_report.data:
+        # Table header
+        reports_lines.append(FOLDER_REPORT_SEPARATOR)
+        reports_lines.append(FOLDER_REPORT_STRING.format(folder="folder",
+                                                         size="size"))
+        reports_lines.append(FOLDER_REPORT_SEPARATOR)
+        for folder in folders_report.data:
+            reports_lines.append(FOLDER_REPORT_STRING.format(folder=folder.path,
+                                                             size=sizeof_fmt(folder.size)))
+        # Table footer and vertical space
+        reports_lines.append(FOLDER_REPORT_SEPARATOR)
+        reports_lines.append("")
+    top = folders_report.details.get('top_folders')
+    if top is not None:
+        for title, folders in ((dss.FOLDER_REPORT_LARGEST_STRING, top.largest()),
+                               (dss.FOLDER_REPORT_GROWING_STRING, top.fastest_growing())):
+            if not folders:
+                continue
+            reports_lines.append(title.format(count=len(folders)))
+            reports_lines.append(TOP_FOLDER_REPORT_SEPARATOR)
+            reports_lines.append(TOP_FOLDER_REPORT_STRING.format(folder="folder", size="size",
+                                                                 growth="growth"))
+            reports_lines.append(TOP_FOLDER_REPORT_SEPARATOR)
+            for folder in folders:
+                growth = ""
+                if folder.growth is not None:
+                    growth = ("+" if folder.growth > 0 else "") + sizeof_fmt(folder.growth)
+                reports_lines.append(TOP_FOLDER_REPORT_STRING.format(folder=folder.path,
+                                                                     size=sizeof_fmt(folder.size),
+                                                                     growth=growth))
+            reports_lines.append(TOP_FOLDER_REPORT_SEPARATOR)
+            reports_lines.append("")
+    for path, breakdown in folders_report.details.get('breakdowns', {}).items():
+        for dimension in breakdown.DIMENSIONS:
+            # The age buckets are all listed, in their order
+            if dimension == 'age':
+                labels = breakdown.age_labels(breakdown.age_limits)
+                rows = sorted(breakdown.top(dimension),
+                              key=lambda row: labels.index(row[0]))
+            else:
+                rows = breakdown.top(dimension, dss.FOLDER_BREAKDOWN_REPORTED)
+            if not rows:
+                continue
+            reports_lines.append(dss.FOLDER_REPORT_BREAKDOWN_STRING.format(folder=path,
+                                                                           dimension=dimension))
+            reports_lines.append(BREAKDOWN_REPORT_SEPARATOR)
+            reports_lines.append(BREAKDOWN_REPORT_STRING.format(key=dimension, size="size",
+                                                                files="files"))
+            reports_lines.append(BREAKDOWN_REPORT_SEPARATOR)
+            for key, size, files in rows:
+                reports_lines.append(BREAKDOWN_REPORT_STRING.format(key=breakdown_key_name(dimension, key),
+                                                                    size=sizeof_fmt(size),
+                                                                    files=files))
+            reports_lines.append(BREAKDOWN_REPORT_SEPARATOR)
+            reports_lines.append("")
+    scan_run = folders_report.details.get('scan_run')
+    if scan_run is not None:
+        reports_lines.append(dss.FOLDER_REPORT_SCAN_STRING.format(rescanned=scan_run.rescanned,
+                                                                  reused=scan_run.reused,
+                                                                  scan="Full" if scan_run.full else "Incremental"))
+        reports_lines.append("")
+    if folders_report.errors:
+        reports_lines.append(dss.FOLDER_REPORT_ERRROR_STRING.format(error=folders_report.errors[0]))
+        reports_lines.append("")
+    return reports_lines
+
 def send_reports(disks_report, folders_report):
+    """Sends the alerts and the report if they are due
+
+    Returns:
+        The run_metrics recorder of the run
+    """
+    metrics = run_metrics.start('send_reports')
+    date_now = datetime.datetime.now()
     reports_dict = {}
     reports_dict_file = os.path.join(BASE_DIR, 'reports_info.pkl')
     # Load reports dict
@@ -199,15 +1205,23 @@ def send_reports(disks_report, folders_report):
                 alerts_lines.append(dss.DISK_ALERT_STRING.format(device=disk.file_system.name,
                                                                   mount_point=disk.mount_point.path,
                                                                   use_percentage=int(use_percentage)))
+        if dss.FORECAST_ALERTS:
+            with metrics.stage('forecast'):
+                forecasts = forecast_alerts()
+            for key, line in forecasts:
+                date_last_alert = reports_dict.get(key, date_now-2*dss.ALERTS_INTERVAL)
+                if date_now-date_last_alert >= dss.ALERTS_INTERVAL:
+                    devices_on_alert.append(key)
+                    alerts_lines.append(line)
         if alerts_lines:
             text = "\n".join(alerts_lines)
             try:
-                gipkomail.EnvoyerMessage(dss.EMAIL_SERVER, dss.EMAIL_FROM,
-                                         dss.EMAIL_TO, dss.DISK_ALERT_SUBJECT,
-                                         text, dss.EMAIL_USER_NAME,
-                                         dss.EMAIL_PASSWORD)
+                with metrics.stage('mail'):
+                    send_mail(dss.DISK_ALERT_SUBJECT, text)
+                metrics.count('mails')
             except Exception as e:
                 logger.error("Failed to send alert mail : {e}".format(e=e))
+                metrics.count('errors')
         # Update reports dictionary
         for device in devices_on_alert:
             reports_dict[device] = date_now
@@ -215,118 +1229,316 @@ def send_reports(disks_report, folders_report):
     date_last_report = reports_dict.get("report", date_now-2*dss.REPORTS_INTERVAL)
     can_send_report = date_now-date_last_report > dss.REPORTS_INTERVAL
     if dss.SEND_REPORTS and can_send_report:
-        reports_lines = []
-        # Disks report
-        if disks_report.data:
-            # Table header
-            reports_lines.append(DISK_REPORT_SEPARATOR)
-            reports_lines.append(DISK_REPORT_STRING.format(device="device",
-                                                           mount_point="mount point",
-                                                           used_space="used space",
-                                                           size="size"))
-            reports_lines.append(DISK_REPORT_SEPARATOR)
-            for disk in disks_report.data:
-                reports_lines.append(DISK_REPORT_STRING.format(device=disk.file_system.name,
-                                                              mount_point=disk.mount_point.path,
-                                                              used_space=sizeof_fmt(disk.used_space),
-                                                              size=sizeof_fmt(disk.size)))
-            # Table footer and vertical space
-            reports_lines.append(DISK_REPORT_SEPARATOR)
-            reports_lines.append("")
-        if disks_report.errors:
-            reports_lines.append(dss.DISK_REPORT_ERROR_STRING.format(error=disks_report.errors[0]))
-            reports_lines.append("")
-        # Folders report
-        if folders_report.data:
-            # Table header
-            reports_lines.append(FOLDER_REPORT_SEPARATOR)
-            reports_lines.append(FOLDER_REPORT_STRING.format(folder="folder",
-                                                             size="size"))
-            reports_lines.append(FOLDER_REPORT_SEPARATOR)
-            for folder in folders_report.data:
-                reports_lines.append(FOLDER_REPORT_STRING.format(folder=folder.path,
-                                                                 size=sizeof_fmt(folder.size)))
-            # Table footer and vertical space
-            reports_lines.append(FOLDER_REPORT_SEPARATOR)
-            reports_lines.append("")
-        if folders_report.errors:
-            reports_lines.append(dss.FOLDER_REPORT_ERRROR_STRING.format(error=folders_report.errors[0]))
-            reports_lines.append("")
+        # With the I/O since the previous report
+        reports_lines = report_lines(disks_report, folders_report,
+                                     max(date_last_report, date_now-dss.REPORTS_INTERVAL),
+                                     date_now)
         # Send report
         if reports_lines:
             # Update reports dictionary
             reports_dict["report"] = date_now
             text = "\n".join(reports_lines)
             try:
-                gipkomail.EnvoyerMessage(dss.EMAIL_SERVER, dss.EMAIL_FROM,
-                                         dss.EMAIL_TO, dss.REPORT_SUBJECT,
-                                         text, dss.EMAIL_USER_NAME,
-                                         dss.EMAIL_PASSWORD)
+                with metrics.stage('mail'):
+                    send_mail(dss.REPORT_SUBJECT, text)
+                metrics.count('mails')
             except Exception as e:
                 logger.error("Failed to send report mail : {e}".format(e=e))
+                metrics.count('errors')
     # Save reports dict
     try:
         with open(reports_dict_file, 'wb') as f:
             pickle.dump(reports_dict, f)
     except Exception as e:
         logger.error("Failed to save reports dictionary : {e}".format(e=e))
+        metrics.count('errors')
+    save_run_metrics(metrics)
+    return metrics
+
+def resume_folders_scan(folders_report, metrics):
+    """Scans the watched paths for at most dss.SCAN_TIME_BUDGET, from where
+    the previous run stopped, one path at a time.
+    Each scanned path is written with the checkpoint in a transaction of its
+    own, and the checkpoint alone every dss.SCAN_CHECKPOINT_INTERVAL, so a
+    killed run loses at most that much of the scan. The sizes of the watched
+    paths go in FolderSizeHistory and in the report once they have all been
+    scanned.
+
+    Arguments:
+        folders_report: The Report of folders_stats, filled at the end of the
+                        pass
+        metrics: The run_metrics recorder of the run
+    """
+    deadline = time.monotonic() + dss.SCAN_TIME_BUDGET.total_seconds()
+    interval = dss.SCAN_CHECKPOINT_INTERVAL.total_seconds()
+    with db.atomic():
+        with metrics.stage('load'):
+            scan_pass = load_checkpoint()
+            if scan_pass is None:
+                full_scan = is_full_scan_due()
+                scan_run = FolderScanRun.create(date=datetime.datetime.now(), full=full_scan,
+                                                rescanned=0, reused=0)
+                top = None
+                if dss.TOP_FOLDERS:
+                    top = scanner.TopFolders(dss.TOP_FOLDERS, dss.TOP_FOLDERS_MIN_DEPTH)
+                scan_pass = ScanPass(scan_run.id, scan_run.date, full_scan,
+                                     sorted(dss.WATCHED_PATH), top)
+                save_checkpoint(scan_pass)
+            else:
+                scan_run = FolderScanRun.get(FolderScanRun.id == scan_pass.run_id)
+                # The paths added since wait for the next pass
+                scan_pass.pending = [path for path in scan_pass.pending
+                                     if path in dss.WATCHED_PATH]
+                logger.info("Resuming the folders scan of {0}, {1} paths left".format(
+                    scan_pass.date, len(scan_pass.pending) + (scan_pass.state is not None)))
+            folder_ids = load_folder_ids()
+            previous = None if scan_pass.full else load_previous_folders()
+    # Imported here, like psutil, only the scans need them
+    import throttling
+    throttle = throttling.scan_throttle(dss.WATCHED_PATH)
+    profiler = None
+    if dss.SCAN_PROFILE_PATH is not None:
+        profiler = run_metrics.Profiler(dss.SCAN_PROFILE_PATH)
+    run_id = scan_pass.run_id if dss.FOLDER_SNAPSHOTS else None
+    while not scan_pass.done and time.monotonic() < deadline:
+        if scan_pass.state is None:
+            breakdown = None
+            if dss.FOLDER_BREAKDOWN and scan_pass.full:
+                breakdown = scanner.Breakdown(dss.FOLDER_BREAKDOWN_MAX_KEYS,
+                                              [age.total_seconds()
+                                               for age in dss.FOLDER_BREAKDOWN_AGES])
+            scan_pass.state = scanner.ScanState(scan_pass.pending.pop(0),
+                                                scanner.ScanStats(breakdown))
+        state = scan_pass.state
+        run = state.run if profiler is None else profiler.wrap(state.run)
+        with metrics.stage('scan'):
+            throttling.run_with_lower_priority(run, previous, throttle=throttle,
+                                               deadline=min(deadline,
+                                                            time.monotonic() + interval))
+        with db.atomic():
+            if state.done:
+                logger.info("Scanned {path} : {stats}".format(path=state.path, stats=state.stats))
+                metrics.count_scan(state.stats)
+                with metrics.stage('write'):
+                    scanner.aggregate_sizes(state.nodes)
+                    save_folder_tree(state.nodes, folder_ids, scan_pass.date, top=scan_pass.top,
+                                     run_id=run_id)
+                    if run_id is not None:
+                        save_removed_folders(run_id, state.path, scan_pass.date)
+                    if state.stats.breakdown is not None:
+                        save_breakdown(scan_pass.run_id, state.path, state.stats.breakdown)
+                        scan_pass.breakdowns[state.path] = state.stats.breakdown
+                scan_run.rescanned += state.stats.dirs
+                scan_run.reused += state.stats.reused
+                scan_run.save()
+                scan_pass.sizes[state.path] = state.nodes[state.path].size
+                scan_pass.state = None
+            if not scan_pass.done:
+                with metrics.stage('checkpoint'):
+                    save_checkpoint(scan_pass)
+                continue
+            # The pass is complete
+            for path in sorted(scan_pass.sizes):
+                folders_report.data.append(FolderSizeHistory.create(path=path,
+                                                                    size=scan_pass.sizes[path],
+                                                                    date=scan_pass.date))
+            folders_report.details['scan_run'] = scan_run
+            if scan_pass.top is not None:
+                save_top_folders(scan_run, scan_pass.top)
+                folders_report.details['top_folders'] = scan_pass.top
+            if scan_pass.breakdowns:
+                folders_report.details['breakdowns'] = scan_pass.breakdowns
+            save_checkpoint(None)
+    if profiler is not None:
+        profiler.dump()
+    if not scan_pass.done:
+        logger.info("Folders scan suspended, {0} paths left".format(
+            len(scan_pass.pending) + (scan_pass.state is not None)))
 
 #================ Main functions ================
 def folders_stats():
     logger.info("Starting folders_stats")
-    folders_report = Report(data=[], errors=[])
+    metrics = run_metrics.start('folders_stats')
+    date_now = datetime.datetime.now()
+    folders_report = Report(data=[], errors=[], details={'metrics': metrics})
     try:
+        metrics.trace(db.get_conn())
         # Create tables if necessary
         FolderSize.create_table(fail_silently=True)
         FolderSizeHistory.create_table(fail_silently=True)
-        # Use db.atomic for performances
-        with db.atomic():
-            for path in dss.WATCHED_PATH:
-                size = folder_stats(path)
-                # Create history for the base directory
-                folder_size = FolderSizeHistory.create(path=path, size=size,
-                                                       date=date_now)
-                folder_size.save()
+        FolderScanRun.create_table(fail_silently=True)
+        TopFolderSize.create_table(fail_silently=True)
+        FolderSizeDelta.create_table(fail_silently=True)
+        FolderBreakdown.create_table(fail_silently=True)
+        ScanCheckpoint.create_table(fail_silently=True)
+        # Tables created by previous versions lack the indexes and the times
+        db.execute_sql(FOLDER_SIZE_PATH_INDEX)
+        add_missing_columns(FolderSize)
+        add_missing_indexes(FolderSizeHistory)
+        if dss.SCAN_TIME_BUDGET is not None:
+            resume_folders_scan(folders_report, metrics)
+        else:
+            with metrics.stage('load'):
+                folder_ids = load_folder_ids()
+                full_scan = is_full_scan_due()
+                previous = None if full_scan else load_previous_folders()
+                top = None
+                if dss.TOP_FOLDERS:
+                    top = scanner.TopFolders(dss.TOP_FOLDERS, dss.TOP_FOLDERS_MIN_DEPTH)
+                breakdown = None
+                if dss.FOLDER_BREAKDOWN and full_scan:
+                    breakdown = scanner.Breakdown(dss.FOLDER_BREAKDOWN_MAX_KEYS,
+                                                  [age.total_seconds()
+                                                   for age in dss.FOLDER_BREAKDOWN_AGES])
+            # The database is only locked while a tree is written, by chunks,
+            # not during the scans, so the other collectors can write
+            with db.atomic():
+                scan_run = FolderScanRun.create(date=date_now, full=full_scan, rescanned=0,
+                                                reused=0)
+            run_id = scan_run.id if dss.FOLDER_SNAPSHOTS else None
+            profiler = None
+            if dss.SCAN_PROFILE_PATH is not None:
+                profiler = run_metrics.Profiler(dss.SCAN_PROFILE_PATH)
+            results = scan_folders(dss.WATCHED_PATH, previous, breakdown, profiler)
+            results = metrics.iterate('scan', results)
+            for path, nodes, stats in results:
+                metrics.count_scan(stats)
+                with metrics.stage('write'):
+                    save_folder_tree(nodes, folder_ids, date_now, top=top, run_id=run_id)
+                    with db.atomic():
+                        if run_id is not None:
+                            save_removed_folders(run_id, path, date_now)
+                        if stats.breakdown is not None:
+                            save_breakdown(scan_run.id, path, stats.breakdown)
+                            folders_report.details.setdefault('breakdowns', {})[path] = stats.breakdown
+                        scan_run.rescanned += stats.dirs
+                        scan_run.reused += stats.reused
+                        scan_run.save()
+                        # Create history for the base directory
+                        folder_size = FolderSizeHistory.create(path=path, size=nodes[path].size,
+                                                               date=date_now)
                 folders_report.data.append(folder_size)
+            folders_report.details['scan_run'] = scan_run
+            if top is not None:
+                with db.atomic():
+                    save_top_folders(scan_run, top)
+                folders_report.details['top_folders'] = top
         logger.info("folders_stats ending")
     except Exception as e:
-        logger.error("Failed to execute disk_stats : {0} ({1})".format(e, e.__class__))
+        logger.error("Failed to execute folders_stats : {0} ({1})".format(e, e.__class__))
         folders_report.errors.append(e)
+        metrics.count('errors')
+    save_run_metrics(metrics)
     return folders_report
 
 def disk_stats():
     """Reads disk stats and saves them in the database with a timestamp
     """
+    # Imported here, only the sampling needs it
+    import psutil
     logger.info("Starting disk_stats")
-    disks_report = Report(data=[], errors=[])
+    metrics = run_metrics.start('disk_stats')
+    date_now = datetime.datetime.now()
+    disks_report = Report(data=[], errors=[], details={'metrics': metrics})
     try:
+        metrics.trace(db.get_conn())
         # Create tables if necessary
         FileSystem.create_table(fail_silently=True)
         MountPoint.create_table(fail_silently=True)
         DataPoint.create_table(fail_silently=True)
+        # Tables created by previous versions lack the indexes
+        add_missing_indexes(DataPoint)
         # Main process
-        partitions = psutil.disk_partitions(all=dss.ANALYSE_ALL_PARTITIONS)
-        for partition in partitions:
-            if partition.device not in dss.EXCLUDED_DEVICES:
-                disk_info = psutil.disk_usage(partition.mountpoint)
-                file_system = FileSystem.create_or_get(name=partition.device)[0]
-                mount_point = MountPoint.create_or_get(path=partition.mountpoint)[0]
-                file_system.save()
-                mount_point.save()
-                data_point = DataPoint.create(size=disk_info.total,
-                                              used_space=disk_info.used,
-                                              file_system=file_system,
-                                              mount_point=mount_point,
-                                              date=date_now)
-                data_point.save()
-                disks_report.data.append(data_point)
+        with metrics.stage('sample'):
+            partitions = psutil.disk_partitions(all=dss.ANALYSE_ALL_PARTITIONS)
+            samples = [(partition, psutil.disk_usage(partition.mountpoint))
+                       for partition in partitions
+                       if partition.device not in dss.EXCLUDED_DEVICES]
+        # The whole sample in one transaction and one statement batch
+        date = DataPoint.date.db_value(date_now)
+        rows = []
+        new_file_system_ids = {}
+        new_mount_point_ids = {}
+        with metrics.stage('write'), db.atomic():
+            for partition, disk_info in samples:
+                file_system = FileSystem(id=get_id(FileSystem, FileSystem.name,
+                                                   partition.device, file_system_ids,
+                                                   new_file_system_ids),
+                                         name=partition.device)
+                mount_point = MountPoint(id=get_id(MountPoint, MountPoint.path,
+                                                   partition.mountpoint, mount_point_ids,
+                                                   new_mount_point_ids),
+                                         path=partition.mountpoint)
+                rows.append((disk_info.total, disk_info.used, file_system.id,
+                             mount_point.id, date))
+                disks_report.data.append(DataPoint(size=disk_info.total,
+                                                   used_space=disk_info.used,
+                                                   file_system=file_system,
+                                                   mount_point=mount_point,
+                                                   date=date_now))
+            db.get_cursor().executemany(DATA_POINT_INSERT, rows)
+        remember_ids(file_system_ids, new_file_system_ids)
+        remember_ids(mount_point_ids, new_mount_point_ids)
         logger.info("disk_stats ended")
     except Exception as e:
-        logger.error("Failed to execute folders_stats : {0} ({1})".format(e, e.__class__))
+        logger.error("Failed to execute disk_stats : {0} ({1})".format(e, e.__class__))
         disks_report.errors.append(e)
+        metrics.count('errors')
+    save_run_metrics(metrics)
     return disks_report
 
-if __name__ == "__main__":
+def main(profile=False, profile_dump=None):
+    """Runs every collector once
+
+    Arguments:
+        profile: Record the run metrics, even if dss.RUN_METRICS is False, and
+                 print them
+        profile_dump: The file to write the cProfile stats of the folders scan
+                      to
+    """
+    # Imported here, it needs the models of this module
+    import retention
+    if profile:
+        dss.RUN_METRICS = True
+    if profile_dump is not None:
+        dss.SCAN_PROFILE_PATH = profile_dump
+    init_database()
+    setup_logging()
     disks_report = disk_stats()
     folders_report = folders_stats()
-    send_reports(disks_report, folders_report)
+    reports_metrics = send_reports(disks_report, folders_report)
+    if dss.EMAIL_OUTBOX_PATH is not None:
+        # The collectors are done, send the queued mails now
+        create_mail_carrier().distribuer()
+    if dss.AGENT_INGEST_URL is not None:
+        # Imported here, only needed by the agents
+        import agent
+        try:
+            agent.spool(disks_report, folders_report)
+        except OSError as e:
+            logger.error("Failed to spool the records : {0}".format(e))
+        agent.push()
+    retention.rollup()
+    retention.vacuum()
+    if dss.EXPORTER_TEXTFILE_PATH is not None:
+        # Imported here, only needed for the exporter
+        import exporter
+        cache = exporter.MetricsCache()
+        cache.update(disks_report, folders_report, (reports_metrics,))
+    if profile:
+        for metrics in (disks_report.details['metrics'], folders_report.details['metrics'],
+                        reports_metrics):
+            print(metrics)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Runs every disk_stats collector once")
+    parser.add_argument('--profile', action='store_true',
+                        help="Record and print the time spent in each stage of the run")
+    parser.add_argument('--profile-dump', metavar='FILE',
+                        help="Write the cProfile stats of the folders scan to FILE")
+    args = parser.parse_args()
+    # Run from the disk_stats module shared with the other modules rather than
+    # from __main__, so they all use the same database
+    import disk_stats as disk_stats_module
+    disk_stats_module.main(args.profile, args.profile_dump)
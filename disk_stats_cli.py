@@ -0,0 +1,165 @@
+import sys
+import argparse
+import datetime
+import importlib.util
+
+# Nothing heavy is imported at the top: each command imports the modules it
+# needs, after the settings are loaded.
+
+#================ Settings ================
+def load_settings(path):
+    """Loads a settings file in place of disk_stats_settings.py, for all the
+    modules imported after.
+    The file can start with `from disk_stats_settings import *` to only
+    change some of the settings.
+
+    Arguments:
+        path: The path of the settings file
+    Returns:
+        module: The settings
+    """
+    spec = importlib.util.spec_from_file_location('disk_stats_settings', path)
+    settings = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(settings)
+    # Registered once run, so that its own import gets the default settings
+    sys.modules['disk_stats_settings'] = settings
+    return settings
+
+#================ Commands ================
+def latest_reports():
+    """Builds the reports of the collectors from the latest records
+
+    Returns:
+        (disk_stats.Report, disk_stats.Report): The disks and folders reports
+    """
+    import disk_stats
+    import queries
+    disks_report = disk_stats.Report(data=[], errors=[], details={})
+    for name, path, point in queries.latest_usage():
+        disks_report.data.append(disk_stats.DataPoint(date=point.date, used_space=point.used_space,
+                                                      size=point.size,
+                                                      file_system=disk_stats.FileSystem(name=name),
+                                                      mount_point=disk_stats.MountPoint(path=path)))
+    folders_report = disk_stats.Report(data=[], errors=[], details={})
+    for path, point in queries.latest_folder_sizes():
+        folders_report.data.append(disk_stats.FolderSizeHistory(path=path, size=point.size,
+                                                                date=point.date))
+    return disks_report, folders_report
+
+def disk_command(args):
+    import disk_stats
+    disk_stats.init_database()
+    disk_stats.setup_logging()
+    disks_report = disk_stats.disk_stats()
+    return 1 if disks_report.errors else 0
+
+def folders_command(args):
+    import disk_stats
+    import disk_stats_settings as dss
+    if args.profile_dump is not None:
+        dss.SCAN_PROFILE_PATH = args.profile_dump
+    disk_stats.init_database()
+    disk_stats.setup_logging()
+    folders_report = disk_stats.folders_stats()
+    return 1 if folders_report.errors else 0
+
+def report_command(args):
+    import disk_stats
+    import queries
+    import disk_stats_settings as dss
+    disk_stats.init_database()
+    queries.migrate_database()
+    if args.send:
+        disk_stats.setup_logging()
+        disk_stats.send_reports(*latest_reports())
+        return 0
+    date_now = datetime.datetime.now()
+    lines = disk_stats.report_lines(*latest_reports(), start=date_now - dss.REPORTS_INTERVAL,
+                                    date_now=date_now)
+    print("\n".join(lines) if lines else "Nothing recorded yet")
+    return 0
+
+def query_command(args):
+    import disk_stats
+    import queries
+    disk_stats.init_database()
+    # Creates the tables the collectors did not yet
+    queries.migrate_database()
+    if args.what == 'usage':
+        for name, path, point in queries.latest_usage():
+            # The pseudo file systems have no size
+            percentage = 100*point.used_space/point.size if point.size else 0
+            print("{0}\t{1}\t{2}\t{3}\t{4:.0f}%".format(name, path,
+                                                       disk_stats.sizeof_fmt(point.used_space),
+                                                       disk_stats.sizeof_fmt(point.size),
+                                                       percentage))
+        return 0
+    if args.what == 'folders':
+        for path, point in queries.latest_folder_sizes():
+            print("{0}\t{1}".format(path, disk_stats.sizeof_fmt(point.size)))
+        return 0
+    if args.name is None:
+        print("The {0} query needs --name".format(args.what), file=sys.stderr)
+        return 2
+    end = datetime.datetime.now()
+    start = end - datetime.timedelta(hours=args.hours)
+    if args.what == 'device':
+        series = queries.usage_series(args.name, start, end)
+    else:
+        series = queries.folder_series(args.name, start, end)
+    for point in series:
+        print("\t".join(str(value) for value in point))
+    return 0
+
+def alerts_command(args):
+    import alerts
+    alerts.main(args.once)
+    return 0
+
+#================ Main ================
+def main(argv=None):
+    """Runs a command
+
+    Arguments:
+        argv: The command line arguments, those of the process if None
+    Returns:
+        int: The exit status
+    """
+    parser = argparse.ArgumentParser(description="Collects and reports the usage of the disks "
+                                                 "and the size of the watched folders")
+    parser.add_argument('--settings', metavar='FILE',
+                        help="Use the settings of FILE in place of disk_stats_settings.py")
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    command = commands.add_parser('disk', help="Record the usage of the disks")
+    command.set_defaults(function=disk_command)
+    command = commands.add_parser('folders', help="Scan and record the watched folders")
+    command.add_argument('--profile-dump', metavar='FILE',
+                         help="Write the cProfile stats of the scan to FILE")
+    command.set_defaults(function=folders_command)
+    command = commands.add_parser('report', help="Print the report of the latest records")
+    command.add_argument('--send', action='store_true',
+                         help="Send the alerts and the report when due instead")
+    command.set_defaults(function=report_command)
+    command = commands.add_parser('query', help="Print the recorded history")
+    command.add_argument('what', nargs='?', default='usage',
+                         choices=('usage', 'folders', 'device', 'folder'),
+                         help="The latest usage of the disks or size of the folders, or the "
+                              "history of a device or a folder (default: usage)")
+    command.add_argument('--name', help="The device or the folder")
+    command.add_argument('--hours', type=float, default=24,
+                         help="The length of the history, in hours (default: 24)")
+    command.set_defaults(function=query_command)
+    command = commands.add_parser('alerts', help="Run the alert engine")
+    command.add_argument('--once', action='store_true',
+                         help="Evaluate the rules once and print the alerts firing")
+    command.set_defaults(function=alerts_command)
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    if args.settings is not None:
+        load_settings(args.settings)
+    return args.function(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+import time
+import signal
+import logging
+import threading
+import disk_stats
+import retention
+import agent
+import exporter
+import io_stats
+import alerts
+# Settings
+import disk_stats_settings as dss
+
+logger = logging.getLogger()
+
+#================ Scheduler ================
+class Collector(object):
+    """A function run at a regular interval by the Scheduler
+
+    Attributes:
+        name: The name of the collector, for the logs
+        function: The function to run, without arguments
+        interval: The time between two runs, in seconds
+        next_run: The time.monotonic() of the next run
+        thread: The thread of the current run, None when not running
+    """
+    def __init__(self, name, function, interval, delay=0):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.next_run = time.monotonic() + delay
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def _run(self):
+        try:
+            self.function()
+        except Exception as e:
+            logger.error("Collector {name} failed : {e} ({cls})".format(name=self.name, e=e,
+                                                                       cls=e.__class__))
+        finally:
+            # Give the connection back to the pool
+            disk_stats.db.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+class Scheduler(object):
+    """Runs each collector in its own thread at its own interval. A collector
+    still running when its next run is due skips that run, so the runs of a
+    collector never overlap.
+    """
+    def __init__(self):
+        self.collectors = []
+        self._stop = threading.Event()
+
+    def add(self, name, function, interval, delay=None):
+        """Adds a collector
+
+        Arguments:
+            name: The name of the collector
+            function: The function to run
+            interval: The time between two runs, a datetime.timedelta
+            delay: The time before its first run, a datetime.timedelta, None
+                   to run it immediately
+        """
+        self.collectors.append(Collector(name, function, interval.total_seconds(),
+                                         delay.total_seconds() if delay is not None else 0))
+
+    def stop(self, *args):
+        """Stops scheduling new runs. Can be used as a signal handler.
+        """
+        self._stop.set()
+
+    def run(self):
+        """Runs the collectors until stop is called, then waits for the
+        running ones at most dss.DAEMON_SHUTDOWN_TIMEOUT
+        """
+        while not self._stop.is_set():
+            now = time.monotonic()
+            for collector in self.collectors:
+                if collector.next_run > now:
+                    continue
+                if collector.running:
+                    logger.warning("Collector {0} still running, skipping this run".format(collector.name))
+                else:
+                    collector.start()
+                # Stay on the grid of the interval without piling up late runs
+                while collector.next_run <= now:
+                    collector.next_run += collector.interval
+            next_run = min(collector.next_run for collector in self.collectors)
+            self._stop.wait(max(0, next_run - time.monotonic()))
+        deadline = time.monotonic() + dss.DAEMON_SHUTDOWN_TIMEOUT.total_seconds()
+        for collector in self.collectors:
+            if collector.running:
+                logger.info("Waiting for collector {0}".format(collector.name))
+                collector.thread.join(max(0, deadline - time.monotonic()))
+                if collector.running:
+                    logger.warning("Collector {0} still running at shutdown".format(collector.name))
+
+#================ Collectors ================
+class LatestReports(object):
+    """Keeps the last report of each collector for the reporting collector,
+    the metrics cache of the exporter up to date, and spools the records for
+    the ingest service in agent mode
+    """
+    def __init__(self, cache=None):
+        self.disks_report = disk_stats.Report(data=[], errors=[], details={})
+        self.folders_report = disk_stats.Report(data=[], errors=[], details={})
+        self.cache = cache
+
+    def collect_disks(self):
+        self.disks_report = disk_stats.disk_stats()
+        if self.cache is not None:
+            self.cache.update(disks_report=self.disks_report)
+        if dss.AGENT_INGEST_URL is not None:
+            agent.spool(disks_report=self.disks_report)
+
+    def collect_folders(self):
+        self.folders_report = disk_stats.folders_stats()
+        if self.cache is not None:
+            self.cache.update(folders_report=self.folders_report)
+        if dss.AGENT_INGEST_URL is not None:
+            agent.spool(folders_report=self.folders_report)
+
+    def send(self):
+        metrics = disk_stats.send_reports(self.disks_report, self.folders_report)
+        if self.cache is not None:
+            self.cache.update(metrics=(metrics,))
+
+def rollup():
+    retention.rollup()
+    retention.vacuum()
+
+def main():
+    disk_stats.init_database(pooled=True)
+    disk_stats.setup_logging()
+    logger.info("Starting disk_stats daemon")
+    cache = None
+    server = None
+    if dss.EXPORTER_PORT is not None or dss.EXPORTER_TEXTFILE_PATH is not None:
+        cache = exporter.MetricsCache()
+        try:
+            cache.load()
+        except Exception as e:
+            logger.error("Failed to load the latest samples : {0} ({1})".format(e, e.__class__))
+        finally:
+            disk_stats.db.close()
+        if dss.EXPORTER_PORT is not None:
+            server = exporter.serve(cache)
+    reports = LatestReports(cache)
+    scheduler = Scheduler()
+    scheduler.add('disk_stats', reports.collect_disks, dss.DISK_STATS_INTERVAL)
+    scheduler.add('folders_stats', reports.collect_folders, dss.FOLDERS_STATS_INTERVAL)
+    scheduler.add('send_reports', reports.send, dss.SEND_REPORTS_INTERVAL)
+    scheduler.add('rollup', rollup, dss.ROLLUP_INTERVAL, dss.ROLLUP_START_DELAY)
+    scheduler.add('vacuum', lambda: retention.vacuum(full=True), dss.VACUUM_INTERVAL,
+                  dss.VACUUM_START_DELAY)
+    if dss.IO_STATS:
+        sampler = io_stats.IOSampler()
+        scheduler.add('io_stats', sampler.sample, dss.IO_STATS_INTERVAL)
+        scheduler.add('io_flush', lambda: io_stats.flush(sampler), dss.IO_FLUSH_INTERVAL)
+    if dss.AGENT_INGEST_URL is not None:
+        scheduler.add('push', agent.push, dss.AGENT_PUSH_INTERVAL)
+    if dss.ALERT_ENGINE:
+        scheduler.add('alerts', alerts.AlertEngine().tick, dss.ALERT_INTERVAL)
+    if dss.EMAIL_OUTBOX_PATH is not None:
+        disk_stats.mail_carrier = disk_stats.create_mail_carrier()
+        disk_stats.mail_carrier.start()
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    scheduler.run()
+    if dss.IO_STATS:
+        # Write the last samples
+        io_stats.flush(sampler)
+        disk_stats.db.close()
+    if server is not None:
+        server.shutdown()
+    if disk_stats.mail_carrier is not None:
+        # The queued mails stay in the outbox for the next start
+        disk_stats.mail_carrier.arreter()
+        disk_stats.mail_carrier.join(dss.DAEMON_SHUTDOWN_TIMEOUT.total_seconds())
+    disk_stats.db.close_all()
+    logger.info("disk_stats daemon stopped")
+
+if __name__ == "__main__":
+    main()
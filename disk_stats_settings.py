@@ -8,6 +8,17 @@ LOG_FILE_PATH = os.path.join('/', 'var', 'log', 'disk_stats.log')
 
 #-------------- Database settings --------------
 DATABASE_PATH = None
+# Apply SQLITE_TUNING_PRAGMAS to every connection. With the write-ahead log the
+# reports and queries no longer block the collectors writing, and the commits
+# sync less often (the last ones can be lost on a power failure, never
+# corrupted). The database then comes with its -wal and -shm files.
+SQLITE_TUNING = False
+SQLITE_TUNING_PRAGMAS = (('journal_mode', 'wal'),
+                         ('synchronous', 'normal'),
+                         # In KiB when negative
+                         ('cache_size', -16000),
+                         # Wait for the lock instead of failing at once, in ms
+                         ('busy_timeout', 5000))
 
 #-------------- Analyse settings --------------
 ANALYSE_ALL_PARTITIONS = True
@@ -19,6 +30,107 @@ WATCHED_PATH = {
                }
 # The to use to store the size of all files in a folder
 FILE_VIRTUAL_FOLDER_NAME = '<files>'
+# The number of folders rows written to the database in one statement batch
+FOLDER_SIZE_CHUNK_SIZE = 1000
+# The number of threads scanning the folders, 1 to scan them one at a time
+SCAN_WORKERS = 1
+# The maximum number of folders read at the same time on a device
+SCAN_WORKERS_PER_DEVICE = 4
+# Do not list again the folders unchanged since the previous scan (those
+# holding files with several links are always listed)
+INCREMENTAL_SCAN = False
+# With incremental scans, list every folder once every FULL_SCAN_EVERY runs to
+# catch the files growing in place
+FULL_SCAN_EVERY = 10
+# The number of largest folders, and of folders which grew the most since the
+# previous scan, listed in the report and kept for each scan, 0 to disable
+TOP_FOLDERS = 10
+# The folders less deep below their watched path are left out of these lists,
+# 0 to include the watched paths themselves
+TOP_FOLDERS_MIN_DEPTH = 1
+
+# Record, at each scan, the folders whose size changed by more than
+# FOLDER_SNAPSHOT_MIN_CHANGE bytes since their previous record, so that the
+# whole tree of any past scan can be rebuilt (within that change)
+FOLDER_SNAPSHOTS           = False
+FOLDER_SNAPSHOT_MIN_CHANGE = 1024*1024
+
+# Count the bytes and files of each watched path by owner, group, extension
+# and age at the full scans (the incremental ones do not list every file).
+# Each of them keeps its FOLDER_BREAKDOWN_MAX_KEYS largest keys, the others
+# are added up as 'other', so the memory stays bounded.
+FOLDER_BREAKDOWN          = False
+FOLDER_BREAKDOWN_MAX_KEYS = 1000
+# The upper limits of the age buckets, from the last modification
+FOLDER_BREAKDOWN_AGES     = (datetime.timedelta(days = 1),
+                             datetime.timedelta(days = 7),
+                             datetime.timedelta(days = 30),
+                             datetime.timedelta(days = 365))
+# The number of keys by owner, group, extension listed in the report
+FOLDER_BREAKDOWN_REPORTED = 5
+
+# Scan the folders for at most SCAN_TIME_BUDGET by run, None for no limit.
+# The next run resumes the scan from a checkpoint saved in the database with
+# each watched path written and every SCAN_CHECKPOINT_INTERVAL, so a killed
+# run loses at most that much. The watched paths are then scanned one at a
+# time, SCAN_WORKERS is ignored, and their sizes recorded once all of them
+# have been scanned.
+SCAN_TIME_BUDGET         = None
+SCAN_CHECKPOINT_INTERVAL = datetime.timedelta(minutes = 5)
+
+#-------------- Scan throttling settings --------------
+# The maximum rates of folders read and of stat calls of the scans, None for
+# no limit
+SCAN_MAX_DIRS_PER_SEC  = None
+SCAN_MAX_STATS_PER_SEC = None
+# Pause the scans, for a time doubled at each check up to SCAN_MAX_BACKOFF,
+# while the CPUs wait for I/O more than this fraction of their time, or while
+# a scanned disk is busy more than this fraction of its time. None to ignore.
+SCAN_MAX_IOWAIT        = None
+SCAN_MAX_DISK_BUSY     = None
+SCAN_THROTTLE_CHECK_INTERVAL = datetime.timedelta(seconds = 1)
+SCAN_MAX_BACKOFF       = datetime.timedelta(seconds = 10)
+# Added to the nice value of the scanner threads, which also lowers their I/O
+# priority on Linux. None to keep it.
+SCAN_NICE              = None
+# 'idle' or 'best-effort' (at SCAN_IOPRIO_LEVEL, from 0 to 7) to set the I/O
+# class of the scanner threads, None to keep it
+SCAN_IOPRIO_CLASS      = None
+SCAN_IOPRIO_LEVEL      = 7
+
+#-------------- I/O settings --------------
+# Sample the I/O counters of the disks, from disk_stats_daemon.py only
+IO_STATS = False
+# The disks of the counters not sampled, a regular expression on their name
+IO_EXCLUDED_DISKS = r'^(loop|ram|zram)\d+$'
+# The samples kept in memory when the database can not be written
+IO_MAX_BUFFERED = 100000
+
+#-------------- Run metrics settings --------------
+# Record the duration of each stage of every run, and what it did, in the
+# run metrics tables
+RUN_METRICS = False
+# Write the cProfile stats of each folders scan to this file (None to not
+# profile). Only the serial scans are profiled, with SCAN_WORKERS at 1.
+SCAN_PROFILE_PATH = None
+
+#-------------- Retention settings --------------
+# The data points older than RAW_RETENTION are summarized by hour, the hours
+# older than HOURLY_RETENTION are summarized by day, the days older than
+# DAILY_RETENTION are deleted (None to keep them forever)
+RAW_RETENTION            = datetime.timedelta(days = 7)
+HOURLY_RETENTION         = datetime.timedelta(days = 90)
+DAILY_RETENTION          = None
+# Move the data points of the past hours to compact blocks (a row by device
+# and by hour) until they are summarized. Saves most of the space of the
+# recent history, the queries decode the blocks.
+PACK_DATA_POINTS         = False
+# The I/O samples older than IO_RETENTION are deleted (None to keep them
+# forever)
+IO_RETENTION             = datetime.timedelta(days = 30)
+# The maximum number of free pages given back to the file system after each
+# rollup
+INCREMENTAL_VACUUM_PAGES = 1000
 
 #-------------- Alerts and reports settings --------------
 USED_PERCENTAGE_FOR_ALERT = 80
@@ -26,6 +138,105 @@ SEND_ALERTS               = False
 ALERTS_INTERVAL           = datetime.timedelta(days = 1)
 SEND_REPORTS              = False
 REPORTS_INTERVAL          = datetime.timedelta(days = 1)
+# Alert when a device, or a watched folder, is projected to fill its device
+# within FORECAST_HOURS_FOR_ALERT at its fastest growth over one of the
+# FORECAST_WINDOWS (needs numpy)
+FORECAST_ALERTS           = False
+FORECAST_HOURS_FOR_ALERT  = 48
+FORECAST_WINDOWS          = (datetime.timedelta(hours = 6),
+                             datetime.timedelta(days = 1),
+                             datetime.timedelta(days = 7))
+# The minimum number of measurements in a window to compute a growth
+FORECAST_MIN_POINTS       = 3
+
+#-------------- Alert engine settings --------------
+# Sample the mounts with statvfs every ALERT_INTERVAL and evaluate
+# ALERT_RULES on them, in disk_stats_daemon.py or `disk_stats_cli.py alerts`.
+# The alerts are mailed when they fire and clear if SEND_ALERTS is True.
+ALERT_ENGINE         = False
+ALERT_INTERVAL       = datetime.timedelta(seconds = 5)
+# The mount points to sample, those of every partition if empty
+ALERT_MOUNTS         = set()
+# The partitions are listed again every ALERT_MOUNTS_REFRESH for the new mounts
+ALERT_MOUNTS_REFRESH = datetime.timedelta(minutes = 5)
+# Each rule has :
+#   name: its name in the alerts
+#   metric: 'used_percent', 'free_bytes', 'inodes_percent', or 'growth', the
+#           bytes written by hour over its 'window' (10 minutes by default)
+#   above or below: the threshold firing the alert
+#   clear: the value the metric must go back past to clear the alert, the
+#          threshold by default
+#   duration: how long the threshold must stay crossed before the alert
+#             fires, 0 by default
+#   mounts, devices: fnmatch patterns of the mount points and devices the
+#                    rule applies to, all by default
+ALERT_RULES          = ({'name': 'full', 'metric': 'used_percent', 'above': 90, 'clear': 85,
+                         'duration': datetime.timedelta(minutes = 1)},
+                        {'name': 'filling', 'metric': 'growth', 'above': 10*1024**3,
+                         'clear': 5*1024**3, 'window': datetime.timedelta(minutes = 10)})
+
+#-------------- Daemon settings --------------
+# Time between two runs of each collector when running disk_stats_daemon.py
+DISK_STATS_INTERVAL      = datetime.timedelta(minutes = 1)
+FOLDERS_STATS_INTERVAL   = datetime.timedelta(days = 1)
+SEND_REPORTS_INTERVAL    = datetime.timedelta(hours = 1)
+ROLLUP_INTERVAL          = datetime.timedelta(hours = 1)
+VACUUM_INTERVAL          = datetime.timedelta(days = 7)
+# The I/O counters are read every IO_STATS_INTERVAL and the samples written
+# every IO_FLUSH_INTERVAL
+IO_STATS_INTERVAL        = datetime.timedelta(seconds = 10)
+IO_FLUSH_INTERVAL        = datetime.timedelta(minutes = 5)
+# Time given to the running collectors to end on SIGTERM
+DAEMON_SHUTDOWN_TIMEOUT  = datetime.timedelta(seconds = 30)
+# One connection by collector
+DAEMON_MAX_CONNECTIONS   = 9
+# The daemon always uses the write-ahead log, and a collector waits at most
+# DAEMON_BUSY_TIMEOUT for the others to write (unless SQLITE_TUNING_PRAGMAS
+# sets them)
+DAEMON_BUSY_TIMEOUT      = datetime.timedelta(minutes = 2)
+# Time after the start of the daemon before the first rollup and vacuum, so
+# that they do not run with the first runs of the other collectors
+ROLLUP_START_DELAY       = datetime.timedelta(minutes = 10)
+VACUUM_START_DELAY       = datetime.timedelta(hours = 6)
+
+#-------------- Exporter settings --------------
+# Serve the latest samples and run metrics in the Prometheus text format on
+# this port, from disk_stats_daemon.py (None to not serve them)
+EXPORTER_PORT           = None
+EXPORTER_ADDRESS        = ''
+# Also write them to this file after each run, for the textfile collector of
+# node_exporter (None to not write them)
+EXPORTER_TEXTFILE_PATH  = None
+
+#-------------- Agent settings --------------
+# Push the records of the collectors to the ingest service of ingest.py at
+# this URL, as 'http://stats.domain.tld:9200/', None to keep them local
+AGENT_INGEST_URL       = None
+# The name of this host in the ingest database, the host name if None
+AGENT_HOST_NAME        = None
+# Must match INGEST_TOKEN of the ingest service
+AGENT_TOKEN            = None
+# The records wait there until they are pushed, and the oldest batches are
+# dropped beyond AGENT_MAX_SPOOLED
+AGENT_SPOOL_PATH       = os.path.join('/', 'var', 'spool', 'disk_stats')
+AGENT_MAX_SPOOLED      = 10000
+AGENT_BATCHES_PER_PUSH = 50
+AGENT_TIMEOUT          = datetime.timedelta(seconds = 30)
+# Time between two pushes of disk_stats_daemon.py, disk_stats.py pushes at the
+# end of each run
+AGENT_PUSH_INTERVAL    = datetime.timedelta(minutes = 5)
+
+#-------------- Ingest settings --------------
+# The database of ingest.py, holding the records of every agent
+INGEST_DATABASE_PATH    = None
+INGEST_PORT             = 9200
+INGEST_ADDRESS          = ''
+# The agents must send this token, None to take every request
+INGEST_TOKEN            = None
+INGEST_MAX_REQUEST_SIZE = 64*1024*1024
+# The consolidated report, sent every REPORTS_INTERVAL, lists the hosts
+# silent for longer
+INGEST_SILENT_AFTER     = datetime.timedelta(hours = 2)
 
 #-------------- Email settings --------------
 EMAIL_SERVER    = 'server.tld'
@@ -33,10 +244,35 @@ EMAIL_FROM      = 'server_stats@domain.tld'
 EMAIL_TO        = 'some.email@domain.tld'
 EMAIL_USER_NAME = 'user@domain.tld'
 EMAIL_PASSWORD  = 'passwd'
+# None for the default SMTP port
+EMAIL_PORT      = None
+# Directory where the mails are queued and sent in the background, retrying
+# the failed ones. None to send them at once, and lose them on failure.
+EMAIL_OUTBOX_PATH      = None
+# Number of mails sent on one connection in a row
+EMAIL_BATCH_SIZE       = 20
+# A failed mail is retried after EMAIL_RETRY_DELAY, then twice longer after
+# each failure up to EMAIL_RETRY_MAX_DELAY, and dropped after
+# EMAIL_MAX_ATTEMPTS failures
+EMAIL_RETRY_DELAY      = datetime.timedelta(minutes = 1)
+EMAIL_RETRY_MAX_DELAY  = datetime.timedelta(hours = 1)
+EMAIL_MAX_ATTEMPTS     = 10
 
 #-------------- Reports settings --------------
 DISK_ALERT_STRING           = "The device {device} (on {mount_point}) is used at {use_percentage}%"
 DISK_ALERT_SUBJECT          = "Disk usage alerts"
+DISK_FORECAST_ALERT_STRING  = "The device {device} (on {mount_point}) is projected full in {hours} hours"
+FOLDER_FORECAST_ALERT_STRING = "The folder {folder} grows by {rate}/h and is projected to fill {mount_point} in {hours} hours"
 DISK_REPORT_ERROR_STRING    = "disk_stats failed with error {error}"
 FOLDER_REPORT_ERRROR_STRING = "folder_stats failed with error {error}"
+FOLDER_REPORT_SCAN_STRING   = "{scan} scan : {rescanned} folders scanned, {reused} reused from the previous scan"
+FOLDER_REPORT_LARGEST_STRING = "The {count} largest folders :"
+FOLDER_REPORT_GROWING_STRING = "The {count} folders which grew the most since the previous scan :"
+FOLDER_REPORT_BREAKDOWN_STRING = "{folder} by {dimension} :"
 REPORT_SUBJECT              = "Disk stats report"
+HOST_ALERT_STRING           = "The device {device} (on {mount_point}) of {host} is used at {use_percentage}%"
+HOST_SILENT_STRING          = "{host} has not pushed anything since {last_seen}"
+INGEST_REPORT_SUBJECT       = "Disk stats consolidated report"
+ALERT_ENGINE_SUBJECT        = "Disk alerts"
+ALERT_FIRED_STRING          = "{rule} : the {metric} of {device} (on {mount_point}) is at {value}"
+ALERT_CLEARED_STRING        = "{rule} cleared : the {metric} of {device} (on {mount_point}) is back at {value}"
@@ -0,0 +1,182 @@
+import os
+import time
+import logging
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+import run_metrics
+# Settings
+import disk_stats_settings as dss
+
+logger = logging.getLogger()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#================ Prometheus text format ================
+def escape(value):
+    """Escapes a label value
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_metric(lines, name, help_text, samples):
+    """Adds a gauge and its samples to the lines of an exposition
+
+    Arguments:
+        lines: The lines of the exposition
+        name: The name of the metric
+        help_text: Its description
+        samples: The (labels OrderedDict, value) of each sample
+    """
+    if not samples:
+        return
+    lines.append('# HELP {0} {1}'.format(name, help_text))
+    lines.append('# TYPE {0} gauge'.format(name))
+    for labels, value in samples:
+        label_text = ','.join('{0}="{1}"'.format(label, escape(label_value))
+                              for label, label_value in labels.items())
+        lines.append('{0}{{{1}}} {2!r}'.format(name, label_text, float(value)))
+
+def timestamp(date):
+    return time.mktime(date.timetuple()) + date.microsecond/1e6
+
+#================ Cache ================
+class MetricsCache(object):
+    """The latest samples of the collectors, rendered in the Prometheus text
+    format once per update so that a scrape only sends bytes.
+
+    Attributes:
+        disks: The (size, used space, date) by (device, mount point)
+        folders: The (size, date) by path
+        runs: The last enabled run_metrics.RunRecorder of each collector
+        text: The rendered exposition, bytes
+    """
+    def __init__(self):
+        self.disks = OrderedDict()
+        self.folders = OrderedDict()
+        self.runs = OrderedDict()
+        self._lock = threading.Lock()
+        self.text = b''
+
+    def load(self):
+        """Fills the cache from the database, until the collectors run
+        """
+        # Imported here, the exporter itself never reads the database
+        import queries
+        with self._lock:
+            for device, mount_point, point in queries.latest_usage():
+                self.disks[(device, mount_point)] = (point.size, point.used_space, point.date)
+            for path, point in queries.latest_folder_sizes():
+                if path in dss.WATCHED_PATH:
+                    self.folders[path] = (point.size, point.date)
+            self._render()
+
+    def update(self, disks_report=None, folders_report=None, metrics=()):
+        """Replaces the cached samples with those of the collectors reports.
+        The samples of a failed run are only added to the previous ones.
+
+        Arguments:
+            disks_report: The report of disk_stats.disk_stats
+            folders_report: The report of disk_stats.folders_stats
+            metrics: Other run_metrics recorders, as the one of send_reports
+        """
+        with self._lock:
+            if disks_report is not None:
+                if not disks_report.errors:
+                    self.disks.clear()
+                for data_point in disks_report.data:
+                    self.disks[(data_point.file_system.name, data_point.mount_point.path)] = \
+                        (data_point.size, data_point.used_space, data_point.date)
+                metrics = tuple(metrics) + (disks_report.details.get('metrics'),)
+            if folders_report is not None:
+                if not folders_report.errors:
+                    self.folders.clear()
+                for folder in folders_report.data:
+                    self.folders[folder.path] = (folder.size, folder.date)
+                metrics = tuple(metrics) + (folders_report.details.get('metrics'),)
+            for recorder in metrics:
+                if recorder is not None and recorder.enabled:
+                    self.runs[recorder.collector] = recorder
+            self._render()
+        if dss.EXPORTER_TEXTFILE_PATH is not None:
+            self.write_textfile(dss.EXPORTER_TEXTFILE_PATH)
+
+    def _render(self):
+        lines = []
+        disks = [(OrderedDict((('device', device), ('mount_point', mount_point))), values)
+                 for (device, mount_point), values in self.disks.items()]
+        render_metric(lines, 'disk_stats_size_bytes', "Size of the file system",
+                      [(labels, size) for labels, (size, used, date) in disks])
+        render_metric(lines, 'disk_stats_used_bytes', "Space used on the file system",
+                      [(labels, used) for labels, (size, used, date) in disks])
+        render_metric(lines, 'disk_stats_sample_timestamp_seconds', "Date of the measurement",
+                      [(labels, timestamp(date)) for labels, (size, used, date) in disks])
+        folders = [(OrderedDict((('path', path),)), values)
+                   for path, values in self.folders.items()]
+        render_metric(lines, 'disk_stats_folder_size_bytes', "Size of the watched folder",
+                      [(labels, size) for labels, (size, date) in folders])
+        render_metric(lines, 'disk_stats_folder_timestamp_seconds', "Date of the measurement",
+                      [(labels, timestamp(date)) for labels, (size, date) in folders])
+        runs = [(OrderedDict((('collector', collector),)), recorder)
+                for collector, recorder in self.runs.items()]
+        render_metric(lines, 'disk_stats_run_timestamp_seconds', "Start of the last run",
+                      [(labels, timestamp(recorder.date)) for labels, recorder in runs])
+        render_metric(lines, 'disk_stats_run_wall_seconds', "Duration of the last run",
+                      [(labels, recorder.wall_time) for labels, recorder in runs])
+        render_metric(lines, 'disk_stats_run_cpu_seconds', "CPU time of the last run",
+                      [(labels, recorder.cpu_time) for labels, recorder in runs])
+        render_metric(lines, 'disk_stats_run_stage_wall_seconds', "Duration of a stage of the last run",
+                      [(OrderedDict((('collector', collector), ('stage', stage))), wall)
+                       for collector, recorder in self.runs.items()
+                       for stage, (wall, cpu) in recorder.stages.items()])
+        for counter in run_metrics.COUNTERS:
+            render_metric(lines, 'disk_stats_run_{0}'.format(counter),
+                          "{0} of the last run".format(counter.replace('_', ' ').capitalize()),
+                          [(labels, recorder.counters[counter]) for labels, recorder in runs])
+        self.text = ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def write_textfile(self, path):
+        """Writes the exposition for the textfile collector of node_exporter,
+        which must never read a partial file
+        """
+        temporary = path + '.tmp'
+        try:
+            with open(temporary, 'wb') as f:
+                f.write(self.text)
+            os.replace(temporary, path)
+        except OSError as e:
+            logger.error("Failed to write the metrics to {path} : {e}".format(path=path, e=e))
+
+#================ HTTP server ================
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the text of the cache of the server on any path
+    """
+    def do_GET(self):
+        text = self.server.cache.text
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        logger.debug("Exporter : " + format % args)
+
+class MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cache):
+        HTTPServer.__init__(self, address, MetricsHandler)
+        self.cache = cache
+
+def serve(cache):
+    """Starts serving a cache on dss.EXPORTER_ADDRESS and dss.EXPORTER_PORT
+    in a thread
+
+    Returns:
+        MetricsServer: To shutdown
+    """
+    server = MetricsServer((dss.EXPORTER_ADDRESS, dss.EXPORTER_PORT), cache)
+    threading.Thread(target=server.serve_forever, name='exporter', daemon=True).start()
+    logger.info("Serving the metrics on port {0}".format(server.server_address[1]))
+    return server
@@ -0,0 +1,208 @@
+import datetime
+import numpy
+from collections import namedtuple
+import blocks
+from disk_stats import db, DataPoint, DataPointBlock, FileSystem, MountPoint, FolderSizeHistory
+# Settings
+import disk_stats_settings as dss
+
+# Reads the dates as seconds since the epoch, much faster than parsing them
+EPOCH_SQL = '(julianday("date") - 2440587.5)*86400.0'
+EPOCH = datetime.datetime(1970, 1, 1)
+
+#================ Result types ================
+# The projection of a device, on one of its mount points
+#   device: The name of the file system
+#   mount_point: The path of the mount point
+#   rate: The fastest growth over the windows, in bytes by second
+#   hours: The hours left before the device is full at that rate
+DeviceForecast = namedtuple('DeviceForecast', ('device', 'mount_point', 'rate', 'hours'))
+# The projection of a watched folder
+#   folder: The path of the folder
+#   mount_point: The path of the mount point holding the folder
+#   rate: The fastest growth over the windows, in bytes by second
+#   hours: The hours left before the folder fills its device at that rate
+FolderForecast = namedtuple('FolderForecast', ('folder', 'mount_point', 'rate', 'hours'))
+
+#================ Computations ================
+def fit_growth(series, times, values, now, windows, min_points):
+    """Fits the growth rate of every series over every window, in a single
+    vectorized pass by window.
+
+    Arguments:
+        series: numpy array of the series index of each sample, from 0
+        times: numpy array of the time of each sample, in seconds
+        values: numpy array of the value of each sample
+        now: The time the windows end at, in seconds
+        windows: The durations of the windows, in seconds
+        min_points: The minimum number of samples to fit a series
+    Returns:
+        numpy array: The least squares slope of each series (rows) over each
+                     window (columns), in units by second, NaN when a series
+                     has too few samples in a window
+    """
+    count = int(series.max()) + 1 if len(series) else 0
+    slopes = numpy.full((count, len(windows)), numpy.nan)
+    # Centered on now, for the precision of the sums
+    times = times - now
+    for column, window in enumerate(windows):
+        mask = times >= -window
+        s, t, v = series[mask], times[mask], values[mask]
+        n = numpy.bincount(s, minlength=count)
+        sum_t = numpy.bincount(s, t, minlength=count)
+        sum_v = numpy.bincount(s, v, minlength=count)
+        sum_tt = numpy.bincount(s, t*t, minlength=count)
+        sum_tv = numpy.bincount(s, t*v, minlength=count)
+        denominator = n*sum_tt - sum_t*sum_t
+        valid = (n >= min_points) & (denominator > 0)
+        slopes[valid, column] = ((n*sum_tv - sum_t*sum_v)[valid])/denominator[valid]
+    return slopes
+
+def hours_to_full(slopes, free):
+    """Projects when each series runs out of space at its fastest growth
+
+    Arguments:
+        slopes: The result of fit_growth, in bytes by second
+        free: numpy array of the free space of each series, in bytes
+    Returns:
+        (numpy array, numpy array): The fastest growth rate and the hours left
+                                    of each series, inf when not growing
+    """
+    rates = numpy.nanmax(numpy.where(numpy.isnan(slopes), -numpy.inf, slopes), axis=1)
+    hours = numpy.full(len(rates), numpy.inf)
+    growing = rates > 0
+    hours[growing] = free[growing]/rates[growing]/3600
+    return rates, hours
+
+def block_rows(start):
+    """Reads the packed data points since a date, as the rows of the devices
+    query of forecast
+
+    Arguments:
+        start: The oldest date, a datetime.datetime
+    Returns:
+        list: The (mount point id, time in seconds, used space, size, file
+              system id) of each point
+    """
+    if not DataPointBlock.table_exists():
+        return []
+    start_us = blocks.to_microseconds(start)
+    query = (DataPointBlock.select(DataPointBlock.mount_point, DataPointBlock.file_system,
+                                   DataPointBlock.data)
+                           .where(DataPointBlock.date >= start.replace(minute=0, second=0,
+                                                                       microsecond=0)))
+    rows = []
+    for mount_point_id, file_system_id, data in db.execute_sql(*query.sql()):
+        times, used_spaces, sizes = blocks.decode_columns(data)
+        rows.extend((mount_point_id, time/1e6, used_space, size, file_system_id)
+                    for time, used_space, size in zip(times, used_spaces, sizes)
+                    if time >= start_us)
+    return rows
+
+def load_series(query, params, extra_rows=()):
+    """Reads a history query in numpy arrays
+
+    Arguments:
+        query: The SQL query, selecting the key of the series, the time of the
+               sample in seconds, then the values
+        params: The parameters of the query
+        extra_rows: Rows read elsewhere, with the same columns as the query
+    Returns:
+        (list, numpy array, numpy array, numpy array): The key of each series,
+        then the series index, time and values (one column by value) of each
+        sample
+    """
+    cursor = db.execute_sql(query, params)
+    rows = cursor.fetchall()
+    rows.extend(extra_rows)
+    if not rows:
+        return ([], numpy.empty(0, dtype=int), numpy.empty(0),
+                numpy.empty((0, len(cursor.description) - 2)))
+    columns = list(zip(*rows))
+    keys, series = numpy.unique(numpy.array(columns[0]), return_inverse=True)
+    times = numpy.array(columns[1], dtype=float)
+    values = numpy.array(columns[2:], dtype=float).T
+    return keys.tolist(), series, times, values
+
+def last_samples(series, times):
+    """Returns the index of the last sample of each series
+
+    Arguments:
+        series: numpy array of the series index of each sample
+        times: numpy array of the time of each sample
+    Returns:
+        numpy array
+    """
+    order = numpy.lexsort((times, series))
+    ordered = series[order]
+    return order[numpy.r_[numpy.flatnonzero(ordered[1:] != ordered[:-1]), len(order) - 1]] \
+           if len(order) else order
+
+#================ Main functions ================
+def forecast(now=None):
+    """Projects when every device, and every watched folder, fills its device
+    from the growth over each of dss.FORECAST_WINDOWS
+
+    Arguments:
+        now: The end of the windows, datetime.datetime.now() if None
+    Returns:
+        (list, list): The DeviceForecast and FolderForecast of the series with
+                      enough history
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    windows = [window.total_seconds() for window in dss.FORECAST_WINDOWS]
+    now_seconds = (now - EPOCH).total_seconds()
+    start = now - max(dss.FORECAST_WINDOWS)
+    # Devices, by mount point
+    query = ('SELECT "mount_point_id", {epoch}, "used_space", "size", "file_system_id" '
+             'FROM "{table}" WHERE "date" >= ?').format(epoch=EPOCH_SQL,
+                                                      table=DataPoint._meta.db_table)
+    keys, series, times, values = load_series(query, (start,), block_rows(start))
+    slopes = fit_growth(series, times, values[:, 0], now_seconds, windows,
+                        dss.FORECAST_MIN_POINTS)
+    last = last_samples(series, times)
+    free = values[last, 1] - values[last, 0]
+    rates, hours = hours_to_full(slopes, free)
+    devices = dict(FileSystem.select(FileSystem.id, FileSystem.name).tuples())
+    mount_points = dict(MountPoint.select(MountPoint.id, MountPoint.path).tuples())
+    device_forecasts = []
+    free_by_mount_point = {}
+    file_system_ids = values[last, 2].astype(int)
+    for mount_point_id, file_system_id, rate, hours_left, free_space in zip(keys, file_system_ids,
+                                                                           rates, hours, free):
+        free_by_mount_point[mount_points[mount_point_id]] = free_space
+        if numpy.isfinite(rate):
+            device_forecasts.append(DeviceForecast(devices[file_system_id],
+                                                   mount_points[mount_point_id],
+                                                   float(rate), float(hours_left)))
+    # Watched folders, against the free space of their mount point
+    query = ('SELECT "path", {epoch}, "size" FROM "{table}" '
+             'WHERE "date" >= ?').format(epoch=EPOCH_SQL,
+                                         table=FolderSizeHistory._meta.db_table)
+    keys, series, times, values = load_series(query, (start,))
+    slopes = fit_growth(series, times, values[:, 0], now_seconds, windows,
+                        dss.FORECAST_MIN_POINTS)
+    folder_mount_points = [mount_point_of(path, free_by_mount_point) for path in keys]
+    free = numpy.array([free_by_mount_point.get(mount_point, numpy.inf)
+                        for mount_point in folder_mount_points])
+    rates, hours = hours_to_full(slopes, free)
+    folder_forecasts = [FolderForecast(path, mount_point, float(rate), float(hours_left))
+                        for path, mount_point, rate, hours_left
+                        in zip(keys, folder_mount_points, rates, hours)
+                        if numpy.isfinite(rate)]
+    return device_forecasts, folder_forecasts
+
+def mount_point_of(path, mount_points):
+    """Finds the mount point holding a path
+
+    Arguments:
+        path: The path
+        mount_points: The known mount points paths
+    Returns:
+        str: The longest mount point containing the path, None if none does
+    """
+    candidates = [mount_point for mount_point in mount_points
+                  if path == mount_point or
+                  path.startswith(mount_point.rstrip('/') + '/')]
+    return max(candidates, key=len) if candidates else None
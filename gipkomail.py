@@ -28,14 +28,46 @@ Version 2.3 2020-09-20
 
     La fonction envoyer_message retourne le retour de la fonction smtp.sendmail.
 
+Version 2.4 2026-10-17
+
+    Ajouté ConnexionSMTP, une connexion authentifiée réutilisée d'un message à l'autre, et la boîte d'envoi :
+    BoiteEnvoi met les messages en file dans un répertoire, Facteur les envoie par lots en tâche de fond et
+    réessaie les envois ratés avec un délai croissant.
+
+Version 2.5 2026-10-17
+
+    Les pièces jointes ne sont plus chargées en mémoire : le message est écrit morceau par morceau dans un
+    fichier (ecrire_message) puis envoyé de même sur la connexion SMTP. Une grosse PJ ne coûte donc plus
+    plusieurs fois sa taille en RAM.
+    Les PJ texte peuvent être compressées en gzip à la volée, et une taille maximale peut être donnée :
+    au-delà, la PJ est tronquée ou remplacée par une note.
+
 """
 import os
+import re
+import io
+import json
+import time
+import uuid
+import zlib
+import fcntl
+import base64
 import smtplib
+import tempfile
+import threading
+import mimetypes
+from email.generator import BytesGenerator
 #   from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
-from email import encoders
+
+#   Les PJ sont lues par blocs de BLOC octets. Multiple de 57, la taille d'une ligne de base64 de 76 caractères.
+BLOC = 57 * 1024
+#   Au-delà de cette taille un message en préparation passe de la mémoire à un fichier temporaire
+TAILLE_MESSAGE_EN_MEMOIRE = 1024 * 1024
+#   Les extensions des fichiers texte que mimetypes ne connaît pas forcément
+EXTENSIONS_TEXTE = ('.log', '.txt', '.csv', '.json', '.xml', '.sql')
 
 
 #   ------------------------------------------------------------------------------------------------------------------
@@ -71,14 +103,42 @@ def verif_adresses(adresses):
 
 
 #   ------------------------------------------------------------------------------------------------------------------
-def envoyer_message(serveur, sender, to, subject, contenu_texte=None, smtp_user=None, smtp_pwd=None,
-                    contenu_html=None, cc=None, bcc=None, files=None, port=None):
-    #   1 - quelques vérifications
+def verif_serveur(serveur, smtp_user=None, port=None):
     #       Le serveur DOIT être un str...
     if type(serveur).__name__ != 'str':
         raise ValueError('Paramètre "server" incorrect. Doit être une chaine de caractères')
 
-    #       ...comme l'expéditeur, ...
+    #       S'il est spécifié, le smtp_user doit lui aussi être un str
+    if smtp_user is not None and type(smtp_user).__name__ != 'str':
+        raise ValueError('Paramètre "smtp_user" incorrect. Doit être une chaine de caractères')
+
+    #       S'il est spécifié, le port doir être un entier
+    if port is not None and type(port).__name__ != 'int':
+        raise ValueError('Paramètre "port" incorrect. Doit être un entier')
+
+
+#   ------------------------------------------------------------------------------------------------------------------
+def est_un_texte(f):
+    type_mime = mimetypes.guess_type(f)[0]
+    if type_mime is not None:
+        return type_mime.startswith('text/')
+    return os.path.splitext(f)[1].lower() in EXTENSIONS_TEXTE
+
+
+#   ------------------------------------------------------------------------------------------------------------------
+def construire_message(sender, to, subject, contenu_texte=None, contenu_html=None, cc=None, bcc=None, files=None,
+                       compresser=False, taille_max=None, depassement='tronquer'):
+    """
+    Vérifie les arguments et construit le message, sans le contenu des pièces jointes : chacune est
+    remplacée par un marqueur que ecrire_message remplace à son tour par le fichier encodé.
+    compresser : compresse en gzip les PJ texte.
+    taille_max : la taille maximale d'une PJ, en octets (avant compression). Au-delà, selon depassement,
+    la PJ est 'tronquer' (seul le début du fichier est joint) ou remplacée par une 'note'. Dans les deux
+    cas, une partie texte du message le signale.
+    Retourne le message, la liste de tous les destinataires (to, cc et bcc) pour l'enveloppe et les PJ
+    sous forme d'un dictionnaire {marqueur: (chemin, compresser, nombre d'octets à lire)}.
+    """
+    #       L'expéditeur DOIT être un str, ...
     if type(sender).__name__ != 'str':
         raise ValueError('Paramètre "sender" incorrect. Doit être une chaine de caractères')
 
@@ -94,18 +154,13 @@ def envoyer_message(serveur, sender, to, subject, contenu_texte=None, smtp_user=
     if contenu_html is not None and type(contenu_html).__name__ != 'str':
         raise ValueError('Paramètre "contenu_html" incorrect. Doit être une chaine de caractères')
 
-    #       S'il est spécifié, le smtp_user doit lui aussi être un str
-    if smtp_user is not None and type(smtp_user).__name__ != 'str':
-        raise ValueError('Paramètre "smtp_user" incorrect. Doit être une chaine de caractères')
-
-    #       S'il est spécifié, le port doir être un entier
-    if port is not None and type(port).__name__ != 'int':
-        raise ValueError('Paramètre "port" incorrect. Doit être un entier')
-
     #   L'argument "files" doit être une liste de str
     if files is not None and type(files).__name__ != 'list':
         raise ValueError('Paramètre "files" incorrect. Doit être une liste')
 
+    if depassement not in ('tronquer', 'note'):
+        raise ValueError('Paramètre "depassement" incorrect. Doit être "tronquer" ou "note"')
+
     #   Allez, on vérifie aussi l'existence des éventuelles PJ
     for f in files or []:
         if type(f).__name__ != 'str':
@@ -144,14 +199,33 @@ def envoyer_message(serveur, sender, to, subject, contenu_texte=None, smtp_user=
 
     msg['Subject'] = subject
 
+    pieces = {}
     for f in files or []:
-        part = MIMEBase('application', "octet-stream")
-        part.set_payload(open(f, "rb").read())
-        encoders.encode_base64(part)
-        part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(f))
+        nom = os.path.basename(f)
+        taille = os.path.getsize(f)
+        if taille_max is not None and taille > taille_max:
+            if depassement == 'note':
+                note = 'Le fichier %s (%d octets) dépasse la taille maximale de %d octets, il n\'est pas joint.'
+                msg.attach(MIMEText((note % (nom, taille, taille_max)).encode('utf-8'), 'plain', 'utf-8'))
+                continue
+            note = 'Le fichier %s (%d octets) dépasse la taille maximale de %d octets, seul son début est joint.'
+            msg.attach(MIMEText((note % (nom, taille, taille_max)).encode('utf-8'), 'plain', 'utf-8'))
+            taille = taille_max
+
+        compresser_f = compresser and est_un_texte(f)
+        if compresser_f:
+            part = MIMEBase('application', "gzip")
+            nom += '.gz'
+        else:
+            part = MIMEBase('application', "octet-stream")
+        #   Le contenu sera écrit par ecrire_message, déjà encodé
+        marqueur = 'PJ-%s' % uuid.uuid4().hex
+        part.set_payload(marqueur)
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header('Content-Disposition', 'attachment; filename="%s"' % nom)
         msg.attach(part)
+        pieces[marqueur] = (f, compresser_f, taille)
 
-    addr_from = sender
     addr_to = []
 
     if liste_to:
@@ -163,27 +237,449 @@ def envoyer_message(serveur, sender, to, subject, contenu_texte=None, smtp_user=
     if liste_bcc:
         addr_to += liste_bcc
 
-    if port is None:
-        s = smtplib.SMTP(serveur)
-    else:
-        s = smtplib.SMTP(serveur, port)
-
-    if smtp_user is not None:
-        if smtp_pwd is None:
-            """
-            Juste pour que ça ne plante pas sur AttributeError: 'NoneType' object has no attribute 'encode'.
-            Dans le pire de cas on aura un "535, 5.7.8 Error: authentication failed", mais après tout on peut
-            imaginer un serveur smtp avec un code utilisateur sans mot de passe...
-            """
-            smtp_pwd = ''
-        s.starttls()
-        s.login(smtp_user, smtp_pwd)
-
-    rep = s.sendmail(addr_from, addr_to, msg.as_string())
-    s.quit()
+    return msg, addr_to, pieces
+
+
+#   ------------------------------------------------------------------------------------------------------------------
+def lire_piece(f, compresser, taille):
+    """
+    Générateur des blocs d'une PJ, ses taille premiers octets éventuellement compressés en gzip.
+    """
+    #   wbits à 31 : format gzip plutôt que zlib
+    compresseur = zlib.compressobj(9, zlib.DEFLATED, 31) if compresser else None
+    with open(f, 'rb') as fichier:
+        while taille > 0:
+            bloc = fichier.read(min(BLOC, taille))
+            if not bloc:
+                break
+            taille -= len(bloc)
+            yield compresseur.compress(bloc) if compresseur else bloc
+    if compresseur:
+        yield compresseur.flush()
+
+
+#   ------------------------------------------------------------------------------------------------------------------
+def ecrire_message(fichier, msg, pieces):
+    """
+    Écrit dans fichier (binaire) le message de construire_message, en encodant les PJ en base64 bloc par
+    bloc : la mémoire utilisée ne dépend pas de la taille des PJ.
+    """
+    #   Le message sans les PJ est petit, on le génère en entier
+    squelette = io.BytesIO()
+    BytesGenerator(squelette, mangle_from_=False).flatten(msg)
+    if not pieces:
+        fichier.write(squelette.getvalue())
+        return
+    morceaux = re.split(b'(' + b'|'.join(re.escape(m.encode('ascii')) for m in pieces) + b')',
+                        squelette.getvalue())
+    for morceau in morceaux:
+        piece = pieces.get(morceau.decode('ascii', 'replace'))
+        if piece is None:
+            fichier.write(morceau)
+            continue
+        #   Les blocs compressés n'ont pas une taille multiple de 57 : on garde le reste pour le bloc suivant
+        reste = b''
+        for bloc in lire_piece(*piece):
+            reste += bloc
+            coupure = len(reste) - len(reste) % 57
+            if coupure:
+                fichier.write(base64.encodebytes(reste[:coupure]))
+                reste = reste[coupure:]
+        if reste:
+            fichier.write(base64.encodebytes(reste))
+
+
+#   ------------------------------------------------------------------------------------------------------------------
+def envoyer_message(serveur, sender, to, subject, contenu_texte=None, smtp_user=None, smtp_pwd=None,
+                    contenu_html=None, cc=None, bcc=None, files=None, port=None, compresser=False,
+                    taille_max=None, depassement='tronquer'):
+    #   1 - quelques vérifications
+    verif_serveur(serveur, smtp_user, port)
+    msg, addr_to, pieces = construire_message(sender, to, subject, contenu_texte, contenu_html, cc, bcc, files,
+                                              compresser, taille_max, depassement)
+
+    #   Le message passe par un fichier temporaire s'il est gros, pour être envoyé par morceaux
+    with tempfile.SpooledTemporaryFile(TAILLE_MESSAGE_EN_MEMOIRE) as fichier:
+        ecrire_message(fichier, msg, pieces)
+        fichier.seek(0)
+        connexion = ConnexionSMTP(serveur, port, smtp_user, smtp_pwd)
+        try:
+            rep = connexion.envoyer(sender, addr_to, fichier)
+        finally:
+            connexion.fermer()
     return rep
 
 
+#   ------------------------------------------------------------------------------------------------------------------
+class ConnexionSMTP(object):
+    """
+    Une connexion SMTP ouverte (et authentifiée) au premier envoi puis réutilisée pour les suivants.
+    Elle est rouverte si le serveur l'a fermée entre temps, ou si elle n'a pas servi depuis
+    delai_inactivite secondes : la plupart des serveurs coupent les connexions inactives au bout de
+    quelques minutes, autant ne pas attendre de le découvrir au milieu d'un envoi.
+    """
+    def __init__(self, serveur, port=None, smtp_user=None, smtp_pwd=None, delai_inactivite=60):
+        verif_serveur(serveur, smtp_user, port)
+        self.serveur = serveur
+        self.port = port
+        self.smtp_user = smtp_user
+        self.smtp_pwd = smtp_pwd
+        self.delai_inactivite = delai_inactivite
+        self.smtp = None
+        self.derniere_utilisation = 0
+
+    def ouvrir(self):
+        if self.port is None:
+            s = smtplib.SMTP(self.serveur)
+        else:
+            s = smtplib.SMTP(self.serveur, self.port)
+
+        try:
+            if self.smtp_user is not None:
+                smtp_pwd = self.smtp_pwd
+                if smtp_pwd is None:
+                    """
+                    Juste pour que ça ne plante pas sur AttributeError: 'NoneType' object has no attribute 'encode'.
+                    Dans le pire de cas on aura un "535, 5.7.8 Error: authentication failed", mais après tout on peut
+                    imaginer un serveur smtp avec un code utilisateur sans mot de passe...
+                    """
+                    smtp_pwd = ''
+                s.starttls()
+                s.login(self.smtp_user, smtp_pwd)
+        except:
+            s.close()
+            raise
+
+        self.smtp = s
+
+    def fermer(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                #   Déjà fermée par le serveur, tant pis
+                self.smtp.close()
+            self.smtp = None
+
+    def _envoyer_fichier(self, addr_from, addr_to, fichier):
+        """
+        Comme smtp.sendmail, mais le message est lu ligne par ligne dans un fichier binaire et envoyé par
+        morceaux au lieu d'être chargé en entier.
+        """
+        s = self.smtp
+        s.ehlo_or_helo_if_needed()
+        code, reponse = s.mail(addr_from)
+        if code != 250:
+            if code == 421:
+                s.close()
+            else:
+                s.rset()
+            raise smtplib.SMTPSenderRefused(code, reponse, addr_from)
+
+        refuses = {}
+        for adresse in addr_to:
+            code, reponse = s.rcpt(adresse)
+            if code not in (250, 251):
+                refuses[adresse] = (code, reponse)
+            if code == 421:
+                s.close()
+                raise smtplib.SMTPRecipientsRefused(refuses)
+        if len(refuses) == len(addr_to):
+            s.rset()
+            raise smtplib.SMTPRecipientsRefused(refuses)
+
+        s.putcmd('data')
+        code, reponse = s.getreply()
+        if code != 354:
+            s.rset()
+            raise smtplib.SMTPDataError(code, reponse)
+        tampon = []
+        taille_tampon = 0
+        for ligne in fichier:
+            ligne = ligne.rstrip(b'\r\n')
+            #   Un point en début de ligne est doublé (RFC 5321, 4.5.2)
+            if ligne.startswith(b'.'):
+                ligne = b'.' + ligne
+            tampon.append(ligne)
+            taille_tampon += len(ligne) + 2
+            if taille_tampon >= BLOC:
+                s.send(b'\r\n'.join(tampon) + b'\r\n')
+                tampon = []
+                taille_tampon = 0
+        tampon.append(b'.')
+        s.send(b'\r\n'.join(tampon) + b'\r\n')
+        code, reponse = s.getreply()
+        if code != 250:
+            if code == 421:
+                s.close()
+            else:
+                s.rset()
+            raise smtplib.SMTPDataError(code, reponse)
+        return refuses
+
+    def envoyer(self, addr_from, addr_to, message):
+        """
+        Envoie un message déjà construit, str, bytes ou fichier binaire (envoyé par morceaux depuis sa
+        position courante), et retourne le retour de smtp.sendmail.
+        """
+        if hasattr(message, 'read'):
+            debut = message.tell()
+            envoi = lambda: self._envoyer_fichier(addr_from, addr_to, message)
+        else:
+            debut = None
+            envoi = lambda: self.smtp.sendmail(addr_from, addr_to, message)
+
+        if self.smtp is not None and time.monotonic() - self.derniere_utilisation > self.delai_inactivite:
+            self.fermer()
+
+        if self.smtp is None:
+            self.ouvrir()
+            deja_ouverte = False
+        else:
+            deja_ouverte = True
+
+        try:
+            rep = envoi()
+        except smtplib.SMTPServerDisconnected:
+            self.smtp.close()
+            self.smtp = None
+            if not deja_ouverte:
+                raise
+            #   Fermée par le serveur depuis le dernier envoi : on réessaie une fois sur une nouvelle connexion
+            self.ouvrir()
+            if debut is not None:
+                message.seek(debut)
+            rep = envoi()
+
+        self.derniere_utilisation = time.monotonic()
+        return rep
+
+
+#   ------------------------------------------------------------------------------------------------------------------
+class BoiteEnvoi(object):
+    """
+    Une file de messages sur disque, dans le répertoire "chemin".
+    Chaque message est un fichier .eml accompagné d'un .json pour l'enveloppe et les tentatives d'envoi.
+    Les fichiers sont écrits sous un nom temporaire puis renommés : un message n'apparaît dans la file
+    qu'une fois complet, même si le programme est tué pendant l'écriture.
+    Les messages abandonnés après trop d'échecs sont déplacés dans le sous-répertoire "abandonnes".
+    """
+    def __init__(self, chemin):
+        self.chemin = chemin
+        self.chemin_abandonnes = os.path.join(chemin, 'abandonnes')
+        os.makedirs(self.chemin_abandonnes, exist_ok=True)
+
+    def _ecrire(self, chemin, contenu):
+        """
+        contenu : des bytes, ou une fonction écrivant le contenu dans le fichier qu'elle reçoit
+        """
+        temporaire = chemin + '.tmp'
+        with open(temporaire, 'wb') as f:
+            if callable(contenu):
+                contenu(f)
+            else:
+                f.write(contenu)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporaire, chemin)
+
+    def _ecrire_enveloppe(self, identifiant, enveloppe):
+        self._ecrire(os.path.join(self.chemin, identifiant + '.json'), json.dumps(enveloppe).encode('utf-8'))
+
+    def ajouter(self, sender, to, subject, contenu_texte=None, contenu_html=None, cc=None, bcc=None, files=None,
+                compresser=False, taille_max=None, depassement='tronquer'):
+        """
+        Construit le message et le met dans la file. Mêmes arguments que envoyer_message, sans le serveur.
+        Les PJ sont encodées tout de suite : elles peuvent changer ou disparaître avant l'envoi.
+        Retourne l'identifiant du message.
+        """
+        msg, addr_to, pieces = construire_message(sender, to, subject, contenu_texte, contenu_html, cc, bcc, files,
+                                                  compresser, taille_max, depassement)
+        #   Le préfixe horaire garde les messages dans l'ordre d'arrivée
+        identifiant = '%020d-%s' % (time.time() * 1e6, uuid.uuid4().hex)
+        #   Le message d'abord : une enveloppe sans message serait envoyée vide
+        self._ecrire(os.path.join(self.chemin, identifiant + '.eml'),
+                     lambda f: ecrire_message(f, msg, pieces))
+        self._ecrire_enveloppe(identifiant, {'from': sender, 'to': addr_to, 'tentatives': 0,
+                                             'prochain_essai': 0, 'erreur': None})
+        return identifiant
+
+    def a_envoyer(self, maintenant=None, limite=None):
+        """
+        Retourne, dans l'ordre d'arrivée, les (identifiant, enveloppe) des messages dont l'envoi est dû.
+        """
+        if maintenant is None:
+            maintenant = time.time()
+        messages = []
+        for nom in sorted(os.listdir(self.chemin)):
+            if not nom.endswith('.json'):
+                continue
+            identifiant = nom[:-len('.json')]
+            try:
+                with open(os.path.join(self.chemin, nom), 'rb') as f:
+                    enveloppe = json.loads(f.read().decode('utf-8'))
+            except FileNotFoundError:
+                #   Envoyé entre temps
+                continue
+            if enveloppe['prochain_essai'] <= maintenant:
+                messages.append((identifiant, enveloppe))
+                if limite is not None and len(messages) >= limite:
+                    break
+        return messages
+
+    def prochain_essai(self):
+        """
+        Retourne l'heure (time.time()) du prochain envoi dû, None si la file est vide.
+        """
+        dates = []
+        for identifiant, enveloppe in self.a_envoyer(float('inf')):
+            dates.append(enveloppe['prochain_essai'])
+        return min(dates) if dates else None
+
+    def ouvrir(self, identifiant):
+        """
+        Retourne le fichier du message, ouvert en binaire.
+        """
+        return open(os.path.join(self.chemin, identifiant + '.eml'), 'rb')
+
+    def envoye(self, identifiant):
+        #   L'enveloppe d'abord, pour ne jamais renvoyer un message déjà parti
+        os.remove(os.path.join(self.chemin, identifiant + '.json'))
+        os.remove(os.path.join(self.chemin, identifiant + '.eml'))
+
+    def echec(self, identifiant, enveloppe, erreur, prochain_essai=None):
+        """
+        Note l'échec d'un envoi. Le message est réessayé à prochain_essai, ou abandonné si None.
+        """
+        enveloppe['tentatives'] += 1
+        enveloppe['erreur'] = str(erreur)
+        if prochain_essai is None:
+            for extension in ('.eml', '.json'):
+                os.replace(os.path.join(self.chemin, identifiant + extension),
+                           os.path.join(self.chemin_abandonnes, identifiant + extension))
+            self._ecrire(os.path.join(self.chemin_abandonnes, identifiant + '.json'),
+                         json.dumps(enveloppe).encode('utf-8'))
+        else:
+            enveloppe['prochain_essai'] = prochain_essai
+            self._ecrire_enveloppe(identifiant, enveloppe)
+
+    def verrouiller(self):
+        """
+        Prend le verrou de la boîte pour la vider, sans attendre.
+        Retourne le fichier du verrou à fermer pour le rendre, None si un autre processus l'a déjà.
+        """
+        verrou = open(os.path.join(self.chemin, '.verrou'), 'w')
+        try:
+            fcntl.flock(verrou, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            verrou.close()
+            return None
+        return verrou
+
+
+#   ------------------------------------------------------------------------------------------------------------------
+class Facteur(threading.Thread):
+    """
+    Vide une BoiteEnvoi en tâche de fond, par lots de taille_lot messages envoyés sur la même connexion.
+    Un envoi raté est réessayé après delai secondes, puis un délai doublé à chaque nouvel échec, sans dépasser
+    delai_max. Le message est abandonné après tentatives_max échecs.
+    Sans message à envoyer, le facteur repasse toutes les intervalle secondes, ou dès qu'on le réveille.
+
+    Pour un envoi sans thread (un script lancé par cron par exemple), appeler directement distribuer().
+    """
+    def __init__(self, boite, connexion, taille_lot=20, delai=60, delai_max=3600, tentatives_max=10,
+                 intervalle=60, journal=None):
+        threading.Thread.__init__(self, name='facteur', daemon=True)
+        self.boite = boite
+        self.connexion = connexion
+        self.taille_lot = taille_lot
+        self.delai = delai
+        self.delai_max = delai_max
+        self.tentatives_max = tentatives_max
+        self.intervalle = intervalle
+        #   Un logging.Logger, pour garder une trace des échecs
+        self.journal = journal
+        #   L'heure (time.time()) avant laquelle ne pas repasser, après une panne du serveur
+        self.reprise = 0
+        self._reveil = threading.Event()
+        self._arret = threading.Event()
+
+    def _echec(self, identifiant, enveloppe, erreur):
+        if enveloppe['tentatives'] + 1 >= self.tentatives_max:
+            prochain_essai = None
+        else:
+            prochain_essai = time.time() + min(self.delai * 2 ** enveloppe['tentatives'], self.delai_max)
+        if self.journal is not None:
+            self.journal.warning('Envoi du message %s raté (%s), %s' % (
+                identifiant, erreur, 'abandonné' if prochain_essai is None else 'sera réessayé'))
+        self.boite.echec(identifiant, enveloppe, erreur, prochain_essai)
+        return prochain_essai
+
+    def distribuer(self):
+        """
+        Envoie les messages dus, lot par lot, et retourne le nombre de messages envoyés.
+        S'arrête au premier problème de connexion : les messages suivants attendront le prochain passage.
+        """
+        verrou = self.boite.verrouiller()
+        if verrou is None:
+            return 0
+        envoyes = 0
+        try:
+            while not self._arret.is_set():
+                lot = self.boite.a_envoyer(limite=self.taille_lot)
+                if not lot:
+                    break
+                for identifiant, enveloppe in lot:
+                    try:
+                        with self.boite.ouvrir(identifiant) as message:
+                            self.connexion.envoyer(enveloppe['from'], enveloppe['to'], message)
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                            smtplib.SMTPDataError) as e:
+                        #   Le serveur refuse ce message, pas les suivants
+                        self._echec(identifiant, enveloppe, e)
+                    except (smtplib.SMTPException, OSError) as e:
+                        #   Le serveur est injoignable : toute la file attend, pas seulement ce message
+                        self.connexion.fermer()
+                        self.reprise = self._echec(identifiant, enveloppe, e) or time.time() + self.delai
+                        return envoyes
+                    else:
+                        self.boite.envoye(identifiant)
+                        envoyes += 1
+        finally:
+            verrou.close()
+        return envoyes
+
+    def reveiller(self):
+        """
+        Fait passer le facteur tout de suite, après l'ajout d'un message par exemple.
+        """
+        self._reveil.set()
+
+    def arreter(self):
+        self._arret.set()
+        self._reveil.set()
+
+    def run(self):
+        while not self._arret.is_set():
+            self._reveil.clear()
+            try:
+                self.distribuer()
+            except Exception as e:
+                if self.journal is not None:
+                    self.journal.error('Erreur du facteur : %s (%s)' % (e, e.__class__))
+            prochain_essai = self.boite.prochain_essai()
+            if prochain_essai is not None:
+                prochain_essai = max(prochain_essai, self.reprise)
+            attente = self.intervalle
+            if prochain_essai is not None:
+                attente = min(attente, max(0, prochain_essai - time.time()))
+            #   Sans rien à envoyer, inutile de garder la connexion ouverte
+            if prochain_essai is None or attente > self.connexion.delai_inactivite:
+                self.connexion.fermer()
+            self._reveil.wait(attente)
+        self.connexion.fermer()
+
+
 #   ------------------------------------------------------------------------------------------------------------------
 def EnvoyerMessage(serveur, sender, destinataire, subject, contenuTexte, smtp_user=None, smtp_pwd=None,
                    contenuHTML=None, listeCopies=None, listeBCC=None, files=None):
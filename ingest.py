@@ -0,0 +1,366 @@
+import gzip
+import json
+import peewee
+import logging
+import argparse
+import datetime
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import disk_stats
+# Settings
+import disk_stats_settings as dss
+
+logger = logging.getLogger()
+
+HOST_DISK_REPORT_SEPARATOR = "+"+"-"*24+"+"+"-"*20+"+"+"-"*30+"+"+"-"*10+"+"+"-"*10+"+"+"-"*5+"+"
+HOST_DISK_REPORT_STRING = "|{host: <24}|{device: <20}|{mount_point: <30}|{used_space: >10}|{size: >10}|{use: >5}|"
+HOST_FOLDER_REPORT_SEPARATOR = "+"+"-"*24+"+"+"-"*50+"+"+"-"*10+"+"
+HOST_FOLDER_REPORT_STRING = "|{host: <24}|{folder: <50}|{size: >10}|"
+
+BATCH_INSERT = ('INSERT OR IGNORE INTO "server_stats_ingestedbatch" '
+                '("batch_id", "host_id", "date", "records") VALUES (?, ?, ?, ?)')
+HOST_DATA_POINT_INSERT = ('INSERT INTO "server_stats_hostdatapoint" '
+                          '("host_id", "date", "device", "mount_point", "size", "used_space") '
+                          'VALUES (?, ?, ?, ?, ?, ?)')
+HOST_FOLDER_SIZE_INSERT = ('INSERT INTO "server_stats_hostfoldersize" '
+                           '("host_id", "date", "path", "size") VALUES (?, ?, ?, ?)')
+LATEST_DISKS_SQL = ('SELECT "h"."name", "p"."device", "p"."mount_point", "p"."used_space", "p"."size" '
+                    'FROM "server_stats_hostdatapoint" AS "p" '
+                    'JOIN "server_stats_host" AS "h" ON "h"."id" = "p"."host_id" '
+                    'JOIN (SELECT "host_id", "device", "mount_point", MAX("date") AS "last_date" '
+                    '      FROM "server_stats_hostdatapoint" GROUP BY "host_id", "device", "mount_point") AS "l" '
+                    'ON "l"."host_id" = "p"."host_id" AND "l"."device" = "p"."device" '
+                    'AND "l"."mount_point" = "p"."mount_point" AND "l"."last_date" = "p"."date" '
+                    'ORDER BY "h"."name", "p"."device"')
+LATEST_FOLDERS_SQL = ('SELECT "h"."name", "f"."path", "f"."size" '
+                      'FROM "server_stats_hostfoldersize" AS "f" '
+                      'JOIN "server_stats_host" AS "h" ON "h"."id" = "f"."host_id" '
+                      'JOIN (SELECT "host_id", "path", MAX("date") AS "last_date" '
+                      '      FROM "server_stats_hostfoldersize" GROUP BY "host_id", "path") AS "l" '
+                      'ON "l"."host_id" = "f"."host_id" AND "l"."path" = "f"."path" '
+                      'AND "l"."last_date" = "f"."date" '
+                      'ORDER BY "h"."name", "f"."path"')
+
+#================ Database info ================
+# Initialized by init_database, apart from the database of the collectors
+db = peewee.Proxy()
+# Serializes the writes of the request threads
+write_lock = threading.Lock()
+
+#================ Models ================
+class Host(peewee.Model):
+    """Stores a host pushing its records
+
+    Attributes:
+        name: The name of the host
+        last_seen: The date of its last batch
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    name = peewee.CharField(db_column='name', max_length=255, unique=True)
+    last_seen = peewee.DateTimeField(db_column='last_seen')
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_host'
+
+class IngestedBatch(peewee.Model):
+    """Stores the batches already loaded, so that a batch sent again is
+    ignored
+
+    Attributes:
+        batch_id: The id given to the batch by its host
+        host: The host (Foreign key on Host)
+        date: The date the batch was loaded
+        records: The number of records of the batch
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    batch_id = peewee.CharField(db_column='batch_id', max_length=64, unique=True)
+    host = peewee.ForeignKeyField(db_column='host_id', rel_model=Host)
+    date = peewee.DateTimeField(db_column='date')
+    records = peewee.IntegerField(db_column='records')
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_ingestedbatch'
+
+class HostDataPoint(peewee.Model):
+    """Stores the usage of a device of a host, as DataPoint does
+
+    Attributes:
+        host: The host (Foreign key on Host)
+        date: The date of the measurement
+        device: The name of the file system
+        mount_point: The path of the mount point
+        size: The size of the file system
+        used_space: The space used on the file system
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    host = peewee.ForeignKeyField(db_column='host_id', rel_model=Host)
+    date = peewee.DateTimeField(db_column='date')
+    device = peewee.CharField(db_column='device', max_length=256)
+    mount_point = peewee.CharField(db_column='mount_point', max_length=256)
+    size = peewee.BigIntegerField(db_column='size')
+    used_space = peewee.BigIntegerField(db_column='used_space')
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_hostdatapoint'
+        indexes = ((('host', 'device', 'mount_point', 'date'), False),
+                   (('date',), False))
+
+class HostFolderSize(peewee.Model):
+    """Stores the size of a watched folder of a host, as FolderSizeHistory
+    does
+
+    Attributes:
+        host: The host (Foreign key on Host)
+        date: The date of the measurement
+        path: The path of the folder
+        size: The size of the folder
+    """
+    id = peewee.PrimaryKeyField(db_column='id')
+    host = peewee.ForeignKeyField(db_column='host_id', rel_model=Host)
+    date = peewee.DateTimeField(db_column='date')
+    path = peewee.CharField(db_column='path', max_length=256)
+    size = peewee.BigIntegerField(db_column='size')
+
+    class Meta:
+        database = db
+        db_table = 'server_stats_hostfoldersize'
+        indexes = ((('host', 'path', 'date'), False),)
+
+MODELS = (Host, IngestedBatch, HostDataPoint, HostFolderSize)
+
+#================ Setup functions ================
+def init_database(path=None):
+    """Opens the database at dss.INGEST_DATABASE_PATH and creates its tables.
+    Each thread gets its own connection.
+    """
+    pragmas = dss.SQLITE_TUNING_PRAGMAS if dss.SQLITE_TUNING else None
+    db.initialize(peewee.SqliteDatabase(path or dss.INGEST_DATABASE_PATH, pragmas=pragmas))
+    for model in MODELS:
+        model.create_table(fail_silently=True)
+    db.close()
+
+#================ Ingestion ================
+def check_batch(batch):
+    """Raises ValueError if a batch does not have the expected fields
+    """
+    if not isinstance(batch, dict):
+        raise ValueError("A batch must be an object")
+    for field, kind in (('id', str), ('host', str), ('date', str), ('data_points', list),
+                        ('folders', list)):
+        if not isinstance(batch.get(field), kind):
+            raise ValueError("The field {0} of a batch is missing or invalid".format(field))
+    if any(not isinstance(row, list) or len(row) != 5 for row in batch['data_points']) or \
+       any(not isinstance(row, list) or len(row) != 3 for row in batch['folders']):
+        raise ValueError("Invalid records in the batch {0}".format(batch['id']))
+
+def host_id(name, date):
+    """Returns the id of a host, creating its row if it is new, and updates
+    the date it was last seen
+    """
+    updated = Host.update(last_seen=date).where(Host.name == name).execute()
+    if not updated:
+        return Host.insert(name=name, last_seen=date).execute()
+    return Host.select(Host.id).where(Host.name == name).scalar()
+
+def ingest(batches, date_now=None):
+    """Loads batches in the database, in one transaction. The batches already
+    loaded are skipped.
+
+    Arguments:
+        batches: The batches of agent.make_batch
+        date_now: The date of the reception
+    Returns:
+        (int, int): The number of batches loaded and skipped
+    """
+    for batch in batches:
+        check_batch(batch)
+    date_now = date_now or datetime.datetime.now()
+    date = IngestedBatch.date.db_value(date_now)
+    loaded = 0
+    with write_lock, db.atomic():
+        cursor = db.get_cursor()
+        for batch in batches:
+            batch_host_id = host_id(batch['host'], date_now)
+            cursor.execute(BATCH_INSERT, (batch['id'], batch_host_id, date,
+                                          len(batch['data_points']) + len(batch['folders'])))
+            if not cursor.rowcount:
+                continue
+            cursor.executemany(HOST_DATA_POINT_INSERT,
+                               ((batch_host_id,) + tuple(row) for row in batch['data_points']))
+            cursor.executemany(HOST_FOLDER_SIZE_INSERT,
+                               ((batch_host_id,) + tuple(row) for row in batch['folders']))
+            loaded += 1
+    return loaded, len(batches) - loaded
+
+#================ HTTP server ================
+class IngestHandler(BaseHTTPRequestHandler):
+    """Takes the batches of the agents posted on any path
+    """
+    def _answer(self, code, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if dss.INGEST_TOKEN is not None and \
+           self.headers.get('Authorization') != 'Bearer {0}'.format(dss.INGEST_TOKEN):
+            self._answer(401, {'error': "Invalid token"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > dss.INGEST_MAX_REQUEST_SIZE:
+                self._answer(413, {'error': "Request too large"})
+                return
+            body = self.rfile.read(length)
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            batches = json.loads(body.decode('utf-8'))['batches']
+            if not isinstance(batches, list):
+                raise ValueError("batches must be a list")
+            for batch in batches:
+                check_batch(batch)
+        except (OSError, ValueError, KeyError, TypeError, EOFError) as e:
+            self._answer(400, {'error': str(e)})
+            return
+        try:
+            loaded, duplicates = ingest(batches)
+        except Exception as e:
+            logger.error("Failed to ingest {0} batches : {1} ({2})".format(len(batches), e,
+                                                                          e.__class__))
+            self._answer(500, {'error': str(e)})
+            return
+        finally:
+            # Each request has its own thread, and so its own connection
+            if not db.is_closed():
+                db.close()
+        self._answer(200, {'loaded': loaded, 'duplicates': duplicates})
+
+    def log_message(self, format, *args):
+        logger.debug("Ingest : " + format % args)
+
+class IngestServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve():
+    """Starts taking the batches on dss.INGEST_ADDRESS and dss.INGEST_PORT
+    in a thread
+
+    Returns:
+        IngestServer: To shutdown
+    """
+    server = IngestServer((dss.INGEST_ADDRESS, dss.INGEST_PORT), IngestHandler)
+    threading.Thread(target=server.serve_forever, name='ingest', daemon=True).start()
+    logger.info("Taking the batches on port {0}".format(server.server_address[1]))
+    return server
+
+#================ Consolidated report ================
+def report_text(date_now=None):
+    """Formats the latest usage of the devices and folders of every host
+
+    Returns:
+        str: None if no host pushed anything yet
+    """
+    date_now = date_now or datetime.datetime.now()
+    lines = []
+    disks = db.execute_sql(LATEST_DISKS_SQL).fetchall()
+    if disks:
+        lines.append(HOST_DISK_REPORT_SEPARATOR)
+        lines.append(HOST_DISK_REPORT_STRING.format(host="host", device="device",
+                                                    mount_point="mount point",
+                                                    used_space="used space", size="size",
+                                                    use="use"))
+        lines.append(HOST_DISK_REPORT_SEPARATOR)
+        for host, device, mount_point, used_space, size in disks:
+            use = "{0:.0f}%".format(100*used_space/size) if size else "-"
+            lines.append(HOST_DISK_REPORT_STRING.format(host=host, device=device,
+                                                        mount_point=mount_point,
+                                                        used_space=disk_stats.sizeof_fmt(used_space),
+                                                        size=disk_stats.sizeof_fmt(size),
+                                                        use=use))
+        lines.append(HOST_DISK_REPORT_SEPARATOR)
+        lines.append("")
+        on_alert = [(host, device, mount_point, int(100*used_space/size))
+                    for host, device, mount_point, used_space, size in disks
+                    if size and 100*used_space/size >= dss.USED_PERCENTAGE_FOR_ALERT]
+        for host, device, mount_point, use_percentage in on_alert:
+            lines.append(dss.HOST_ALERT_STRING.format(host=host, device=device,
+                                                      mount_point=mount_point,
+                                                      use_percentage=use_percentage))
+        if on_alert:
+            lines.append("")
+    folders = db.execute_sql(LATEST_FOLDERS_SQL).fetchall()
+    if folders:
+        lines.append(HOST_FOLDER_REPORT_SEPARATOR)
+        lines.append(HOST_FOLDER_REPORT_STRING.format(host="host", folder="folder", size="size"))
+        lines.append(HOST_FOLDER_REPORT_SEPARATOR)
+        for host, path, size in folders:
+            lines.append(HOST_FOLDER_REPORT_STRING.format(host=host, folder=path,
+                                                          size=disk_stats.sizeof_fmt(size)))
+        lines.append(HOST_FOLDER_REPORT_SEPARATOR)
+        lines.append("")
+    silent = (Host.select(Host.name, Host.last_seen)
+                  .where(Host.last_seen < date_now - dss.INGEST_SILENT_AFTER)
+                  .order_by(Host.name))
+    for host in silent:
+        lines.append(dss.HOST_SILENT_STRING.format(host=host.name, last_seen=host.last_seen))
+    if not lines:
+        return None
+    return "\n".join(lines)
+
+def send_report():
+    """Sends the consolidated report of every host
+    """
+    try:
+        text = report_text()
+        if text is not None:
+            disk_stats.send_mail(dss.INGEST_REPORT_SUBJECT, text)
+    except Exception as e:
+        logger.error("Failed to send the consolidated report : {0} ({1})".format(e, e.__class__))
+    finally:
+        if not db.is_closed():
+            db.close()
+
+#================ Main functions ================
+def main(report=False):
+    """Takes the batches of the agents and sends the consolidated report every
+    dss.REPORTS_INTERVAL, until SIGTERM
+
+    Arguments:
+        report: Only print the consolidated report
+    """
+    init_database()
+    if report:
+        print(report_text() or "No host pushed any record yet")
+        return
+    # Imported here, only the service needs it
+    import signal
+    disk_stats.setup_logging()
+    logger.info("Starting disk_stats ingest service")
+    server = serve()
+    if dss.EMAIL_OUTBOX_PATH is not None:
+        disk_stats.mail_carrier = disk_stats.create_mail_carrier()
+        disk_stats.mail_carrier.start()
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+    while not stop.wait(dss.REPORTS_INTERVAL.total_seconds()):
+        send_report()
+    server.shutdown()
+    if disk_stats.mail_carrier is not None:
+        disk_stats.mail_carrier.arreter()
+        disk_stats.mail_carrier.join(dss.DAEMON_SHUTDOWN_TIMEOUT.total_seconds())
+    logger.info("disk_stats ingest service stopped")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Takes the records pushed by the disk_stats "
+                                                 "agents of several hosts")
+    parser.add_argument('--report', action='store_true',
+                        help="Print the consolidated report and exit")
+    main(report=parser.parse_args().report)
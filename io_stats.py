@@ -0,0 +1,189 @@
+import os
+import re
+import time
+import psutil
+import logging
+import datetime
+import threading
+from collections import deque, namedtuple
+import disk_stats
+from disk_stats import db, FileSystem, MountPoint, IODisk, IOSample
+# Settings
+import disk_stats_settings as dss
+
+logger = logging.getLogger()
+
+IO_SAMPLE_INSERT = ('INSERT INTO "server_stats_iosample" ("disk_id", "date", "duration", '
+                    '"read_bytes", "write_bytes", "read_ops", "write_ops", "utilization", '
+                    '"read_latency", "write_latency") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+# The rates of a disk between two readings of its counters, as stored in
+# IOSample, with the name of the disk in place of its id
+IORate = namedtuple('IORate', ('disk', 'date', 'duration', 'read_bytes', 'write_bytes',
+                               'read_ops', 'write_ops', 'utilization', 'read_latency',
+                               'write_latency'))
+
+#================ Tool functions ================
+def disk_partitions():
+    """Finds the file system and mount point of each disk of the counters
+
+    Returns:
+        dict: The (device, mount point) of the partitions by disk name, the
+              first mount point of a device is kept
+    """
+    partitions = {}
+    for partition in psutil.disk_partitions(all=dss.ANALYSE_ALL_PARTITIONS):
+        if not partition.device.startswith('/dev/'):
+            continue
+        # The counters know /dev/mapper/vg-lv as dm-0
+        name = os.path.basename(os.path.realpath(partition.device))
+        partitions.setdefault(name, (partition.device, partition.mountpoint))
+    return partitions
+
+def rates(name, before, after, date, duration):
+    """Computes the rates of a disk between two readings of its counters
+
+    Arguments:
+        name: The name of the disk
+        before: The first psutil counters of the disk
+        after: The second ones
+        date: The date of the second reading
+        duration: The time between the readings, in seconds
+    Returns:
+        IORate: None if the disk was idle, or if its counters were reset
+    """
+    read_count = after.read_count - before.read_count
+    write_count = after.write_count - before.write_count
+    read_bytes = after.read_bytes - before.read_bytes
+    write_bytes = after.write_bytes - before.write_bytes
+    if min(read_count, write_count, read_bytes, write_bytes) < 0:
+        return None
+    if not (read_count or write_count):
+        return None
+    utilization = None
+    busy_time = getattr(after, 'busy_time', None)
+    if busy_time is not None:
+        # In milliseconds, and counted by several queues on some disks
+        utilization = min(1.0, (busy_time - before.busy_time)/1000.0/duration)
+    read_latency = (after.read_time - before.read_time)/read_count if read_count else None
+    write_latency = (after.write_time - before.write_time)/write_count if write_count else None
+    return IORate(name, date, duration, int(read_bytes/duration), int(write_bytes/duration),
+                  read_count/duration, write_count/duration, utilization, read_latency,
+                  write_latency)
+
+#================ Sampler ================
+class IOSampler(object):
+    """Reads the I/O counters of the disks at each sample and keeps the rates
+    in memory until they are flushed to the database. The idle disks get no
+    sample.
+
+    Attributes:
+        buffer: The IORate not flushed yet, the oldest are dropped beyond
+                dss.IO_MAX_BUFFERED
+        disks: The (IODisk id, file system id, mount point id) by disk name
+    """
+    def __init__(self):
+        self.buffer = deque(maxlen=dss.IO_MAX_BUFFERED)
+        self.disks = {}
+        self._previous = None
+        self._lock = threading.Lock()
+        self._excluded = re.compile(dss.IO_EXCLUDED_DISKS) if dss.IO_EXCLUDED_DISKS else None
+
+    def sample(self):
+        """Reads the counters and buffers the rates since the previous sample
+
+        Returns:
+            int: The number of rates buffered
+        """
+        now = time.monotonic()
+        date = datetime.datetime.now()
+        counters = psutil.disk_io_counters(perdisk=True) or {}
+        previous, self._previous = self._previous, (now, counters)
+        if previous is None or now <= previous[0]:
+            return 0
+        duration = now - previous[0]
+        samples = []
+        for name, after in counters.items():
+            before = previous[1].get(name)
+            if before is None or (self._excluded is not None and self._excluded.match(name)):
+                continue
+            rate = rates(name, before, after, date, duration)
+            if rate is not None:
+                samples.append(rate)
+        with self._lock:
+            self.buffer.extend(samples)
+        return len(samples)
+
+    def _disk_id(self, name, partitions, new_file_system_ids, new_mount_point_ids):
+        """Returns the IODisk id of a disk, creating or updating its row if it
+        is new or was mounted elsewhere. The ids of the file systems and mount
+        points found are added to new_file_system_ids and new_mount_point_ids,
+        as disk_stats.get_id does.
+        """
+        device, path = partitions.get(name, (None, None))
+        file_system_id = (disk_stats.get_id(FileSystem, FileSystem.name, device,
+                                            disk_stats.file_system_ids, new_file_system_ids)
+                          if device is not None else None)
+        mount_point_id = (disk_stats.get_id(MountPoint, MountPoint.path, path,
+                                            disk_stats.mount_point_ids, new_mount_point_ids)
+                          if path is not None else None)
+        known = self.disks.get(name)
+        if known is None:
+            disk_id = IODisk.select(IODisk.id).where(IODisk.name == name).scalar()
+            if disk_id is None:
+                disk_id = IODisk.insert(name=name, file_system=file_system_id,
+                                        mount_point=mount_point_id).execute()
+                known = (disk_id, file_system_id, mount_point_id)
+            else:
+                known = (disk_id, None, None)
+        if known[1:] != (file_system_id, mount_point_id):
+            (IODisk.update(file_system=file_system_id, mount_point=mount_point_id)
+                   .where(IODisk.id == known[0]).execute())
+        self.disks[name] = (known[0], file_system_id, mount_point_id)
+        return known[0]
+
+    def flush(self):
+        """Writes the buffered rates in the database, in one transaction. They
+        stay buffered if it fails.
+
+        Returns:
+            int: The number of rates written
+        """
+        with self._lock:
+            samples = list(self.buffer)
+            self.buffer.clear()
+        if not samples:
+            return 0
+        try:
+            for model in (FileSystem, MountPoint, IODisk, IOSample):
+                model.create_table(fail_silently=True)
+            partitions = disk_partitions()
+            new_file_system_ids = {}
+            new_mount_point_ids = {}
+            with db.atomic():
+                disk_ids = {name: self._disk_id(name, partitions, new_file_system_ids,
+                                                new_mount_point_ids)
+                            for name in set(sample.disk for sample in samples)}
+                to_date = IOSample.date.db_value
+                db.get_cursor().executemany(IO_SAMPLE_INSERT,
+                                            ((disk_ids[sample.disk], to_date(sample.date))
+                                             + tuple(sample[2:]) for sample in samples))
+            disk_stats.remember_ids(disk_stats.file_system_ids, new_file_system_ids)
+            disk_stats.remember_ids(disk_stats.mount_point_ids, new_mount_point_ids)
+        except Exception:
+            # The ids of the rolled back rows are gone
+            self.disks.clear()
+            with self._lock:
+                self.buffer.extendleft(reversed(samples))
+            raise
+        return len(samples)
+
+#================ Main functions ================
+def flush(sampler):
+    """Flushes a sampler, logging the errors
+    """
+    try:
+        count = sampler.flush()
+        logger.debug("io_stats flushed {0} samples".format(count))
+    except Exception as e:
+        logger.error("Failed to flush io_stats : {0} ({1})".format(e, e.__class__))
@@ -0,0 +1,403 @@
+import os
+import peewee
+import datetime
+import itertools
+from collections import namedtuple, OrderedDict
+import blocks
+import disk_stats
+import retention
+from disk_stats import (DataPoint, HourlyDataPoint, DailyDataPoint, DataPointBlock, FileSystem,
+                        MountPoint, FolderSize, FolderSizeHistory, FolderSizeDelta, FolderScanRun,
+                        IODisk, IOSample)
+
+#================ Result types ================
+# A disk usage measurement, or the mean of the measurements of a step or of a
+# summarized period
+#   date: datetime.datetime, the date of the measurement or of the step start
+#   used_space: int, the space used on the file system
+#   size: int, the size of the file system
+UsagePoint = namedtuple('UsagePoint', ('date', 'used_space', 'size'))
+# A folder size measurement
+#   date: datetime.datetime, the date of the measurement
+#   size: int, the size of the folder
+FolderPoint = namedtuple('FolderPoint', ('date', 'size'))
+# The I/O throughput of a disk between two readings of its counters
+#   date: datetime.datetime, the date of the second reading
+#   duration, read_bytes, write_bytes, read_ops, write_ops, utilization,
+#   read_latency, write_latency: as in IOSample
+IOPoint = namedtuple('IOPoint', ('date', 'duration', 'read_bytes', 'write_bytes', 'read_ops',
+                                 'write_ops', 'utilization', 'read_latency', 'write_latency'))
+# The I/O of a disk over a time range, the idle time included
+#   disk: str, the name of the disk in the kernel counters
+#   device: str, the file system on the disk, None if not mounted
+#   mount_point: str, its mount point, None if not mounted
+#   read_bytes, write_bytes: float, the mean bytes read and written by second
+#   utilization: float, the mean fraction of the time the disk was busy
+#   max_utilization: float, the highest utilization of a sample
+IOSummary = namedtuple('IOSummary', ('disk', 'device', 'mount_point', 'read_bytes',
+                                     'write_bytes', 'utilization', 'max_utilization'))
+# The change of a folder between two folders scans
+#   path: str, the path of the folder
+#   before: int, its size at the first scan, None if it did not exist
+#   after: int, its size at the second scan, None if it was gone
+FolderChange = namedtuple('FolderChange', ('path', 'before', 'after'))
+
+# The size of every folder at a scan, from its last delta up to the scan,
+# NULL if it had none or was gone: (run id, root path, first sub path, last
+# sub path excluded)
+FOLDER_TREE_SQL = ('SELECT "f"."path", '
+                   '(SELECT "size" FROM "server_stats_foldersizedelta" '
+                   ' WHERE "folder_id" = "f"."id" AND "run_id" <= ? '
+                   ' ORDER BY "run_id" DESC LIMIT 1) '
+                   'FROM "server_stats_foldersize" AS "f" '
+                   'WHERE "f"."path" = ? OR ("f"."path" >= ? AND "f"."path" < ?) '
+                   'ORDER BY "f"."path"')
+# Only the folders with a delta between two scans can differ: (first run
+# excluded, second run, first run, second run, root path, first sub path,
+# last sub path excluded)
+FOLDER_TREE_DIFF_SQL = ('SELECT "f"."path", '
+                        '(SELECT "size" FROM "server_stats_foldersizedelta" '
+                        ' WHERE "folder_id" = "c"."folder_id" AND "run_id" <= ? '
+                        ' ORDER BY "run_id" DESC LIMIT 1), '
+                        '(SELECT "size" FROM "server_stats_foldersizedelta" '
+                        ' WHERE "folder_id" = "c"."folder_id" AND "run_id" <= ? '
+                        ' ORDER BY "run_id" DESC LIMIT 1) '
+                        'FROM (SELECT DISTINCT "folder_id" FROM "server_stats_foldersizedelta" '
+                        '      WHERE "run_id" > ? AND "run_id" <= ?) AS "c" '
+                        'JOIN "server_stats_foldersize" AS "f" ON "f"."id" = "c"."folder_id" '
+                        'WHERE "f"."path" = ? OR ("f"."path" >= ? AND "f"."path" < ?)')
+
+# The summary tables, coarsest first, and the period of their rows
+SUMMARY_PERIODS = ((DailyDataPoint, datetime.timedelta(days=1)),
+                   (HourlyDataPoint, datetime.timedelta(hours=1)))
+
+#================ Migration ================
+def migrate_database():
+    """Creates the history tables and the indexes used by the queries, for
+    databases created by previous versions.
+    """
+    for model in (FileSystem, MountPoint, DataPoint, HourlyDataPoint, DailyDataPoint,
+                  DataPointBlock, FolderSize, FolderSizeHistory, FolderScanRun, FolderSizeDelta,
+                  IODisk, IOSample):
+        model.create_table(fail_silently=True)
+    disk_stats.add_missing_columns(FolderSize)
+    disk_stats.add_missing_indexes(DataPoint)
+    disk_stats.add_missing_indexes(FolderSizeHistory)
+
+#================ Queries ================
+# The results are streamed : rows are read from the database cursor as they
+# are consumed, no list of models is built.
+def _stream(query, date_field):
+    """Iterates the rows of a query directly from the cursor
+
+    Arguments:
+        query: The peewee query, selecting the date first
+        date_field: The field of the date, to convert it
+    Yields:
+        tuple: The rows, with the date as a datetime.datetime
+    """
+    to_date = date_field.python_value
+    for row in disk_stats.db.execute_sql(*query.sql()):
+        yield (to_date(row[0]),) + tuple(row[1:])
+
+def _mean_by_step(points, start, step):
+    """Averages consecutive usage points by step
+
+    Arguments:
+        points: The UsagePoint, by date
+        start: The start of the first step, a datetime.datetime
+        step: The duration of a step, a datetime.timedelta
+    Yields:
+        UsagePoint: The mean of the points of each step not empty, dated at
+                    the start of the step
+    """
+    step_seconds = step.total_seconds()
+    current = None
+    count = used_space = size = 0
+    for point in points:
+        index = int((point.date - start).total_seconds()//step_seconds)
+        if index != current:
+            if count:
+                yield UsagePoint(start + current*step, used_space//count, size//count)
+            current = index
+            count = used_space = size = 0
+        count += 1
+        used_space += point.used_space
+        size += point.size
+    if count:
+        yield UsagePoint(start + current*step, used_space//count, size//count)
+
+def _usage_tables(start, end, step=None):
+    """Splits a time range between the tables holding its data. retention.rollup
+    moves the old data points to the coarser tables, so the oldest part is in
+    the daily summaries, then comes the hourly ones, then the blocks of packed
+    data points, then the data points.
+    With a step of a day or more, the daily summaries are read as far as they
+    go, and with a step of an hour or more the hourly ones: the finer tables
+    are only read for the part they do not cover yet.
+
+    Arguments:
+        start: The start of the range, included
+        end: The end of the range, excluded
+        step: The duration of the steps the points are averaged by, None for
+              every point
+    Returns:
+        list: The (model, used space field, start, end) of each part of the
+              range, by date
+    """
+    raw_start = retention.min_date(DataPoint) or end
+    block_start = min(retention.min_date(DataPointBlock) or raw_start, raw_start)
+    hourly_start = min(retention.min_date(HourlyDataPoint) or block_start, block_start)
+    # The start of each table, then the end of the range
+    bounds = [start, hourly_start, block_start, raw_start, end]
+    for index, (model, period) in enumerate(SUMMARY_PERIODS):
+        if step is None or step < period:
+            continue
+        last = retention.max_date(model)
+        if last is None:
+            continue
+        covered = last + period
+        for finer in range(index + 1, len(bounds) - 1):
+            bounds[finer] = max(bounds[finer], covered)
+    tables = ((DailyDataPoint, DailyDataPoint.avg_used_space),
+              (HourlyDataPoint, HourlyDataPoint.avg_used_space),
+              (DataPointBlock, None),
+              (DataPoint, DataPoint.used_space))
+    return [(model, used_space, max(start, table_start), min(end, table_end))
+            for (model, used_space), table_start, table_end in zip(tables, bounds, bounds[1:])
+            if max(start, table_start) < min(end, table_end)]
+
+def _block_rows(field_name, value, start, end):
+    """Streams the packed data points of a time range
+
+    Arguments:
+        field_name: The field of DataPointBlock to filter on
+        value: Its value
+        start: The start of the range, included
+        end: The end of the range, excluded
+    Yields:
+        tuple: The (date, used space, size) of the points, by date
+    """
+    query = (DataPointBlock.select(DataPointBlock.date, DataPointBlock.data)
+                           .where(getattr(DataPointBlock, field_name) == value,
+                                  DataPointBlock.date >= retention.truncate_hour(start),
+                                  DataPointBlock.date < end)
+                           .order_by(DataPointBlock.date))
+    # Late data points can give several blocks for the same hour
+    for date, hour_blocks in itertools.groupby(_stream(query, DataPointBlock.date),
+                                               lambda row: row[0]):
+        points = itertools.chain.from_iterable(blocks.decode(data) for _, data in hour_blocks)
+        for point in sorted(points):
+            if start <= point[0] < end:
+                yield point
+
+def _usage_series(field_name, value, start, end, step):
+    def table_rows(model, used_space, table_start, table_end):
+        if model is DataPointBlock:
+            return _block_rows(field_name, value, table_start, table_end)
+        query = (model.select(model.date, used_space, model.size)
+                      .where(getattr(model, field_name) == value,
+                             model.date >= table_start, model.date < table_end)
+                      .order_by(model.date))
+        return _stream(query, model.date)
+
+    rows = itertools.chain.from_iterable(itertools.starmap(table_rows,
+                                                           _usage_tables(start, end, step)))
+    points = (UsagePoint(*row) for row in rows)
+    if step is None:
+        return points
+    return _mean_by_step(points, start, step)
+
+def usage_series(device, start, end, step=None):
+    """Streams the usage of a file system over a time range
+
+    Arguments:
+        device: str, the name of the file system, as in FileSystem.name
+        start: datetime.datetime, the start of the range, included
+        end: datetime.datetime, the end of the range, excluded
+        step: datetime.timedelta, average the measurements by steps of this
+              duration, None to get every measurement
+    Returns:
+        iterator of UsagePoint, by date. The summarized periods give their
+        mean used space.
+    """
+    file_system = FileSystem.select(FileSystem.id).where(FileSystem.name == device)
+    return _usage_series('file_system', file_system, start, end, step)
+
+def mount_point_series(mount_point, start, end, step=None):
+    """Streams the usage of the file system on a mount point over a time
+    range
+
+    Arguments:
+        mount_point: str, the path of the mount point, as in MountPoint.path
+        start: datetime.datetime, the start of the range, included
+        end: datetime.datetime, the end of the range, excluded
+        step: datetime.timedelta, average the measurements by steps of this
+              duration, None to get every measurement
+    Returns:
+        iterator of UsagePoint, by date. The summarized periods give their
+        mean used space.
+    """
+    mount_point = MountPoint.select(MountPoint.id).where(MountPoint.path == mount_point)
+    return _usage_series('mount_point', mount_point, start, end, step)
+
+def folder_series(path, start, end):
+    """Streams the size of a watched folder over a time range
+
+    Arguments:
+        path: str, the path of the folder, as in dss.WATCHED_PATH
+        start: datetime.datetime, the start of the range, included
+        end: datetime.datetime, the end of the range, excluded
+    Returns:
+        iterator of FolderPoint, by date
+    """
+    query = (FolderSizeHistory.select(FolderSizeHistory.date, FolderSizeHistory.size)
+                              .where(FolderSizeHistory.path == path,
+                                     FolderSizeHistory.date >= start,
+                                     FolderSizeHistory.date < end)
+                              .order_by(FolderSizeHistory.date))
+    return (FolderPoint(*row) for row in _stream(query, FolderSizeHistory.date))
+
+def latest_usage():
+    """Returns the last measurement of every file system on every mount point
+
+    Returns:
+        list of (str, str, UsagePoint): The name of the file system, the path
+        of the mount point and the measurement
+    """
+    latest = (DataPoint.select(DataPoint.file_system, DataPoint.mount_point,
+                               peewee.fn.MAX(DataPoint.date).alias('last_date'))
+                       .group_by(DataPoint.file_system, DataPoint.mount_point)
+                       .alias('latest'))
+    query = (DataPoint.select(DataPoint.date, DataPoint.used_space, DataPoint.size,
+                              FileSystem.name, MountPoint.path)
+                      .join(FileSystem).switch(DataPoint)
+                      .join(MountPoint).switch(DataPoint)
+                      .join(latest, on=((DataPoint.file_system == latest.c.file_system_id) &
+                                        (DataPoint.mount_point == latest.c.mount_point_id) &
+                                        (DataPoint.date == latest.c.last_date))))
+    return [(name, path, UsagePoint(date, used_space, size))
+            for date, used_space, size, name, path in _stream(query, DataPoint.date)]
+
+def latest_folder_sizes():
+    """Returns the last measurement of every watched folder
+
+    Returns:
+        list of (str, FolderPoint): The path of the folder and the measurement
+    """
+    query = (FolderSizeHistory.select(peewee.fn.MAX(FolderSizeHistory.date),
+                                      FolderSizeHistory.size, FolderSizeHistory.path)
+                              .group_by(FolderSizeHistory.path))
+    # SQLite takes the other columns from the row holding the MAX
+    return [(path, FolderPoint(date, size))
+            for date, size, path in _stream(query, FolderSizeHistory.date)]
+
+def io_series(device, start, end):
+    """Streams the I/O samples of the disk holding a file system over a time
+    range. The idle periods have no sample.
+
+    Arguments:
+        device: str, the name of the file system, as in FileSystem.name
+        start: datetime.datetime, the start of the range, included
+        end: datetime.datetime, the end of the range, excluded
+    Returns:
+        iterator of IOPoint, by date
+    """
+    disks = (IODisk.select(IODisk.id).join(FileSystem)
+                   .where(FileSystem.name == device))
+    query = (IOSample.select(IOSample.date, IOSample.duration, IOSample.read_bytes,
+                             IOSample.write_bytes, IOSample.read_ops, IOSample.write_ops,
+                             IOSample.utilization, IOSample.read_latency,
+                             IOSample.write_latency)
+                     .where(IOSample.disk << disks, IOSample.date >= start,
+                            IOSample.date < end)
+                     .order_by(IOSample.date))
+    return (IOPoint(*row) for row in _stream(query, IOSample.date))
+
+def io_summary(start, end):
+    """Sums up the I/O of every disk over a time range
+
+    Arguments:
+        start: datetime.datetime, the start of the range, included
+        end: datetime.datetime, the end of the range, excluded
+    Returns:
+        list of IOSummary, of the disks with samples in the range
+    """
+    seconds = (end - start).total_seconds()
+    # The rates weighted by the duration of their sample give the volumes
+    query = (IODisk.select(IODisk.name, FileSystem.name, MountPoint.path,
+                           peewee.fn.SUM(IOSample.read_bytes*IOSample.duration),
+                           peewee.fn.SUM(IOSample.write_bytes*IOSample.duration),
+                           peewee.fn.SUM(IOSample.utilization*IOSample.duration),
+                           peewee.fn.MAX(IOSample.utilization))
+                   .join(IOSample).switch(IODisk)
+                   .join(FileSystem, peewee.JOIN.LEFT_OUTER).switch(IODisk)
+                   .join(MountPoint, peewee.JOIN.LEFT_OUTER)
+                   .where(IOSample.date >= start, IOSample.date < end)
+                   .group_by(IODisk.id)
+                   .order_by(IODisk.name))
+    return [IOSummary(disk, device, mount_point, read_bytes/seconds, write_bytes/seconds,
+                      utilization/seconds if utilization is not None else None,
+                      max_utilization)
+            for disk, device, mount_point, read_bytes, write_bytes, utilization, max_utilization
+            in disk_stats.db.execute_sql(*query.sql())]
+
+#================ Folder snapshots ================
+def _path_range(root):
+    """Returns the root of a tree and the bounds of the paths below it, for
+    FOLDER_TREE_SQL and FOLDER_TREE_DIFF_SQL
+    """
+    if root is None:
+        return ('', '', '\U0010ffff')
+    root = root.rstrip(os.sep) or os.sep
+    prefix = root.rstrip(os.sep) + os.sep
+    # The paths starting with root/ sort before root0
+    return (root, prefix, prefix[:-1] + chr(ord(os.sep) + 1))
+
+def scan_run_at(date):
+    """Finds the last folders scan at a date
+
+    Arguments:
+        date: datetime.datetime
+    Returns:
+        int: The id of the FolderScanRun, None if there was no scan yet
+    """
+    return (FolderScanRun.select(FolderScanRun.id)
+                         .where(FolderScanRun.date <= date)
+                         .order_by(FolderScanRun.id.desc())
+                         .scalar())
+
+def folder_tree(run_id, root=None):
+    """Rebuilds the size of every folder as of a scan, from the recorded
+    deltas (dss.FOLDER_SNAPSHOTS). The sizes are within
+    dss.FOLDER_SNAPSHOT_MIN_CHANGE of the measured ones.
+
+    Arguments:
+        run_id: int, the id of the FolderScanRun
+        root: str, only rebuild this folder and its sub folders, None for
+              every folder
+    Returns:
+        OrderedDict: The sizes by path, by path
+    """
+    cursor = disk_stats.db.execute_sql(FOLDER_TREE_SQL, (run_id,) + _path_range(root))
+    return OrderedDict(row for row in cursor if row[1] is not None)
+
+def folder_tree_diff(run_before, run_after, root=None):
+    """Lists the folders whose size changed between two scans, without
+    rebuilding the trees
+
+    Arguments:
+        run_before: int, the id of the first FolderScanRun
+        run_after: int, the id of the second FolderScanRun, after the first
+        root: str, only compare this folder and its sub folders, None for
+              every folder
+    Returns:
+        list of FolderChange, the largest changes first
+    """
+    params = (run_before, run_after, run_before, run_after) + _path_range(root)
+    changes = [FolderChange(*row)
+               for row in disk_stats.db.execute_sql(FOLDER_TREE_DIFF_SQL, params)
+               if row[1] != row[2]]
+    changes.sort(key=lambda change: abs((change.after or 0) - (change.before or 0)),
+                 reverse=True)
+    return changes
@@ -0,0 +1,240 @@
+import peewee
+import sqlite3
+import datetime
+import logging
+import itertools
+import blocks
+import disk_stats
+from disk_stats import (db, DataPoint, HourlyDataPoint, DailyDataPoint, DataPointBlock,
+                        IOSample)
+# Settings
+import disk_stats_settings as dss
+
+logger = logging.getLogger()
+
+#================ Rollup queries ================
+# Summarizes the rows of a period in a single row by file system and mount
+# point, the last values are taken from the row with the latest date
+ROLLUP_SQL = ('INSERT INTO "{target}" ("file_system_id", "mount_point_id", "date", "count", '
+              '"min_used_space", "max_used_space", "avg_used_space", "used_space", "size") '
+              'SELECT g."file_system_id", g."mount_point_id", ?, g."count", g."min_used_space", '
+              'g."max_used_space", g."avg_used_space", s."used_space", s."size" '
+              'FROM (SELECT "file_system_id", "mount_point_id", {count} AS "count", '
+              '{min_used_space} AS "min_used_space", {max_used_space} AS "max_used_space", '
+              '{avg_used_space} AS "avg_used_space", MAX("date") AS "last_date" '
+              'FROM "{source}" WHERE "date" >= ? AND "date" < ? '
+              'GROUP BY "file_system_id", "mount_point_id") AS g '
+              'JOIN "{source}" AS s ON s."file_system_id" = g."file_system_id" '
+              'AND s."mount_point_id" = g."mount_point_id" AND s."date" = g."last_date" '
+              'GROUP BY g."file_system_id", g."mount_point_id"')
+RAW_ROLLUP_SQL = ROLLUP_SQL.format(target=HourlyDataPoint._meta.db_table,
+                                   source=DataPoint._meta.db_table,
+                                   count='COUNT(*)',
+                                   min_used_space='MIN("used_space")',
+                                   max_used_space='MAX("used_space")',
+                                   avg_used_space='CAST(AVG("used_space") AS INTEGER)')
+HOURLY_ROLLUP_SQL = ROLLUP_SQL.format(target=DailyDataPoint._meta.db_table,
+                                      source=HourlyDataPoint._meta.db_table,
+                                      count='SUM("count")',
+                                      min_used_space='MIN("min_used_space")',
+                                      max_used_space='MAX("max_used_space")',
+                                      avg_used_space='CAST(SUM("avg_used_space"*"count")/SUM("count") AS INTEGER)')
+DELETE_SQL = 'DELETE FROM "{source}" WHERE "date" >= ? AND "date" < ?'
+# The data points of a period, grouped for the blocks
+PACK_SELECT_SQL = ('SELECT "file_system_id", "mount_point_id", "date", "used_space", "size" '
+                   'FROM "server_stats_datapoint" WHERE "date" >= ? AND "date" < ? '
+                   'ORDER BY "file_system_id", "mount_point_id", "date"')
+BLOCK_INSERT_SQL = ('INSERT INTO "server_stats_datapointblock" '
+                    '("file_system_id", "mount_point_id", "date", "count", "data") '
+                    'VALUES (?, ?, ?, ?, ?)')
+BLOCK_SELECT_SQL = ('SELECT "file_system_id", "mount_point_id", "data" '
+                    'FROM "server_stats_datapointblock" WHERE "date" = ? '
+                    'ORDER BY "file_system_id", "mount_point_id"')
+HOURLY_INSERT_SQL = ('INSERT INTO "server_stats_hourlydatapoint" ("file_system_id", '
+                     '"mount_point_id", "date", "count", "min_used_space", "max_used_space", '
+                     '"avg_used_space", "used_space", "size") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+#================ Tool functions ================
+def min_date(model, after=None):
+    """Returns the oldest date of a table
+
+    Arguments:
+        model: The model of the table, with a date field
+        after: Only look at the dates after this one, included
+    Returns:
+        datetime.datetime: None if the table is empty
+    """
+    query = model.select(peewee.fn.MIN(model.date))
+    if after is not None:
+        query = query.where(model.date >= after)
+    value = query.scalar()
+    return model.date.python_value(value) if value is not None else None
+
+def max_date(model):
+    """Returns the latest date of a table
+
+    Arguments:
+        model: The model of the table, with a date field
+    Returns:
+        datetime.datetime: None if the table is empty
+    """
+    value = model.select(peewee.fn.MAX(model.date)).scalar()
+    return model.date.python_value(value) if value is not None else None
+
+def truncate_hour(date):
+    return date.replace(minute=0, second=0, microsecond=0)
+
+def truncate_day(date):
+    return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def roll(source, rollup_sql, retention, truncate, period):
+    """Summarizes the rows of a table older than its retention, one period
+    per transaction, and deletes them.
+    Only whole periods are summarized, and the write lock is never held for
+    more than one period of rows.
+
+    Arguments:
+        source: The model of the table to summarize
+        rollup_sql: The query summarizing a period in the next table
+        retention: The age of the rows to summarize, a datetime.timedelta
+        truncate: The function giving the start of the period of a date
+        period: The duration of a period, a datetime.timedelta
+    Returns:
+        int: The number of periods summarized
+    """
+    cutoff = truncate(datetime.datetime.now() - retention)
+    delete_sql = DELETE_SQL.format(source=source._meta.db_table)
+    periods = 0
+    oldest = min_date(source)
+    while oldest is not None and oldest < cutoff:
+        start = truncate(oldest)
+        end = start + period
+        with db.atomic():
+            db.execute_sql(rollup_sql, (start, start, end))
+            db.execute_sql(delete_sql, (start, end))
+        periods += 1
+        oldest = min_date(source, after=end)
+    return periods
+
+def pack(cutoff):
+    """Moves the data points of every hour before cutoff to blocks, one hour
+    per transaction, a block by file system and mount point.
+
+    Arguments:
+        cutoff: The end of the last hour to pack, a datetime.datetime
+    Returns:
+        int: The number of hours packed
+    """
+    to_date = DataPoint.date.python_value
+    hours = 0
+    oldest = min_date(DataPoint)
+    while oldest is not None and oldest < cutoff:
+        start = truncate_hour(oldest)
+        end = start + datetime.timedelta(hours=1)
+        with db.atomic():
+            rows = []
+            points = db.execute_sql(PACK_SELECT_SQL, (start, end))
+            for (file_system_id, mount_point_id), group in itertools.groupby(points,
+                                                                            lambda row: row[:2]):
+                group = list(group)
+                data = blocks.encode([to_date(row[2]) for row in group],
+                                     [row[3] for row in group], [row[4] for row in group])
+                rows.append((file_system_id, mount_point_id, DataPointBlock.date.db_value(start),
+                             len(group), sqlite3.Binary(data)))
+            db.get_cursor().executemany(BLOCK_INSERT_SQL, rows)
+            db.execute_sql(DELETE_SQL.format(source=DataPoint._meta.db_table), (start, end))
+        hours += 1
+        oldest = min_date(DataPoint, after=end)
+    return hours
+
+def roll_blocks(retention):
+    """Summarizes the blocks older than a retention by hour, as roll does
+    for the data points, and deletes them
+
+    Arguments:
+        retention: The age of the blocks to summarize, a datetime.timedelta
+    Returns:
+        int: The number of hours summarized
+    """
+    cutoff = truncate_hour(datetime.datetime.now() - retention)
+    hours = 0
+    oldest = min_date(DataPointBlock)
+    while oldest is not None and oldest < cutoff:
+        start = truncate_hour(oldest)
+        with db.atomic():
+            rows = []
+            block_rows = db.execute_sql(BLOCK_SELECT_SQL, (DataPointBlock.date.db_value(start),))
+            # Late data points can give several blocks for the same hour
+            for key, group in itertools.groupby(block_rows, lambda row: row[:2]):
+                points = sorted(itertools.chain.from_iterable(blocks.decode(row[2])
+                                                              for row in group))
+                used_spaces = [point[1] for point in points]
+                rows.append(key + (HourlyDataPoint.date.db_value(start), len(points),
+                                   min(used_spaces), max(used_spaces),
+                                   sum(used_spaces)//len(points), points[-1][1], points[-1][2]))
+            db.get_cursor().executemany(HOURLY_INSERT_SQL, rows)
+            DataPointBlock.delete().where(DataPointBlock.date == start).execute()
+        hours += 1
+        oldest = min_date(DataPointBlock, after=start + datetime.timedelta(hours=1))
+    return hours
+
+#================ Main functions ================
+def rollup():
+    """Summarizes the data points older than dss.RAW_RETENTION by hour, then
+    the hours older than dss.HOURLY_RETENTION by day, and deletes the days
+    older than dss.DAILY_RETENTION.
+    With dss.PACK_DATA_POINTS, the data points of the past hours are moved to
+    blocks until they are summarized.
+    """
+    logger.info("Starting rollup")
+    try:
+        for model in (HourlyDataPoint, DailyDataPoint, DataPointBlock):
+            model.create_table(fail_silently=True)
+        # The periods are found with the index on the date
+        disk_stats.add_missing_indexes(DataPoint)
+        hours = roll(DataPoint, RAW_ROLLUP_SQL, dss.RAW_RETENTION, truncate_hour,
+                     datetime.timedelta(hours=1))
+        hours += roll_blocks(dss.RAW_RETENTION)
+        packed = 0
+        if dss.PACK_DATA_POINTS:
+            packed = pack(truncate_hour(datetime.datetime.now()))
+        days = roll(HourlyDataPoint, HOURLY_ROLLUP_SQL, dss.HOURLY_RETENTION, truncate_day,
+                    datetime.timedelta(days=1))
+        deleted = 0
+        if dss.DAILY_RETENTION is not None:
+            cutoff = datetime.datetime.now() - dss.DAILY_RETENTION
+            deleted = DailyDataPoint.delete().where(DailyDataPoint.date < cutoff).execute()
+        io_deleted = 0
+        if dss.IO_RETENTION is not None and IOSample.table_exists():
+            cutoff = datetime.datetime.now() - dss.IO_RETENTION
+            io_deleted = IOSample.delete().where(IOSample.date < cutoff).execute()
+        logger.info("rollup ended : {hours} hours and {days} days summarized, "
+                    "{deleted} old days and {io_deleted} old I/O samples deleted, "
+                    "{packed} hours packed".format(hours=hours, days=days, deleted=deleted,
+                                                   io_deleted=io_deleted, packed=packed))
+    except Exception as e:
+        logger.error("Failed to execute rollup : {0} ({1})".format(e, e.__class__))
+
+def vacuum(full=False):
+    """Gives the free pages of the database back to the file system.
+    A full vacuum rebuilds the database file and switches it to incremental
+    auto vacuum, otherwise at most dss.INCREMENTAL_VACUUM_PAGES pages are
+    freed.
+    A database created without auto vacuum gets a full vacuum the first time,
+    incremental_vacuum does nothing on it.
+
+    Arguments:
+        full: Run VACUUM instead of incremental_vacuum
+    """
+    try:
+        if not full and not db.execute_sql('PRAGMA auto_vacuum').fetchone()[0]:
+            full = True
+        if full:
+            logger.info("Starting vacuum")
+            db.execute_sql('PRAGMA auto_vacuum = INCREMENTAL')
+            db.execute_sql('VACUUM')
+            logger.info("vacuum ended")
+        else:
+            db.execute_sql('PRAGMA incremental_vacuum({0:d})'.format(dss.INCREMENTAL_VACUUM_PAGES))
+    except Exception as e:
+        logger.error("Failed to vacuum the database : {0} ({1})".format(e, e.__class__))
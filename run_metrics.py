@@ -0,0 +1,188 @@
+import time
+import cProfile
+import datetime
+from collections import OrderedDict
+# Settings
+import disk_stats_settings as dss
+
+# The counters of a run, all at 0 when the run starts
+COUNTERS = ('dirs', 'files', 'bytes', 'scandir_calls', 'stat_calls',
+            'db_statements', 'mails', 'errors')
+
+#================ Recorders ================
+class Stage(object):
+    """Adds the wall and CPU time spent in a with block to a stage of a run
+    """
+    __slots__ = ('times', 'wall', 'cpu')
+
+    def __init__(self, times):
+        self.times = times
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.times[0] += time.perf_counter() - self.wall
+        self.times[1] += time.process_time() - self.cpu
+        return False
+
+class RunRecorder(object):
+    """Times the stages of a collector run and counts what it did.
+    The CPU times are those of the whole process, the scanner threads
+    included.
+
+    Attributes:
+        collector: The name of the collector
+        date: The start of the run
+        stages: The [wall time, CPU time] of each stage, in seconds, in the
+                order they first ran
+        counters: The value of each of COUNTERS
+        wall_time: The wall time of the whole run, set by stop
+        cpu_time: The CPU time of the whole run, set by stop
+    """
+    enabled = True
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.date = datetime.datetime.now()
+        self.stages = OrderedDict()
+        self.counters = OrderedDict((counter, 0) for counter in COUNTERS)
+        self.wall_time = None
+        self.cpu_time = None
+        self._connection = None
+        self._start = (time.perf_counter(), time.process_time())
+
+    def stage(self, name):
+        """Returns a context manager timing a stage. A stage can be timed
+        several times, the times add up.
+        """
+        return Stage(self.stages.setdefault(name, [0.0, 0.0]))
+
+    def iterate(self, name, iterable):
+        """Times each step of an iterable as a stage, to time a generator
+        without the work done by the caller between two steps
+        """
+        iterator = iter(iterable)
+        stage = self.stage(name)
+        while True:
+            with stage:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, counter, value=1):
+        self.counters[counter] += value
+
+    def count_scan(self, stats):
+        """Adds the counters of a scanner.ScanStats, and its throttled time as
+        the wall time of a 'throttled' stage
+        """
+        for counter in ('dirs', 'files', 'bytes', 'scandir_calls', 'stat_calls', 'errors'):
+            self.counters[counter] += getattr(stats, counter)
+        if stats.throttled:
+            self.stages.setdefault('throttled', [0.0, 0.0])[0] += stats.throttled
+
+    def trace(self, connection):
+        """Counts the statements executed on a sqlite3 connection until stop
+        """
+        self._connection = connection
+        connection.set_trace_callback(self._statement)
+
+    def _statement(self, statement):
+        self.counters['db_statements'] += 1
+
+    def stop(self):
+        self.wall_time = time.perf_counter() - self._start[0]
+        self.cpu_time = time.process_time() - self._start[1]
+        if self._connection is not None:
+            self._connection.set_trace_callback(None)
+            self._connection = None
+
+    def __str__(self):
+        lines = ["{collector} : {wall:.3f}s wall, {cpu:.3f}s CPU".format(collector=self.collector,
+                                                                        wall=self.wall_time or 0,
+                                                                        cpu=self.cpu_time or 0)]
+        for name, (wall, cpu) in self.stages.items():
+            lines.append("  {name: <12} {wall:9.3f}s wall {cpu:9.3f}s CPU".format(name=name,
+                                                                               wall=wall, cpu=cpu))
+        lines.append("  " + ", ".join("{0} {1}".format(value, counter)
+                                      for counter, value in self.counters.items() if value))
+        return "\n".join(lines)
+
+class NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+class NullRecorder(object):
+    """Does nothing, used when the run metrics are disabled
+    """
+    enabled = False
+    _stage = NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def iterate(self, name, iterable):
+        return iterable
+
+    def count(self, counter, value=1):
+        pass
+
+    def count_scan(self, stats):
+        pass
+
+    def trace(self, connection):
+        pass
+
+    def stop(self):
+        pass
+
+NULL_RECORDER = NullRecorder()
+
+def start(collector):
+    """Starts recording a collector run
+
+    Arguments:
+        collector: The name of the collector
+    Returns:
+        RunRecorder: NULL_RECORDER if dss.RUN_METRICS is False
+    """
+    if not dss.RUN_METRICS:
+        return NULL_RECORDER
+    return RunRecorder(collector)
+
+#================ Profiling ================
+class Profiler(object):
+    """Profiles the calls of functions with cProfile, in the threads running
+    them, such as the scan threads of throttling.run_with_lower_priority.
+    The calls must not overlap.
+
+    Attributes:
+        path: The file to write the stats to, readable with pstats
+    """
+    def __init__(self, path):
+        self.path = path
+        self._profile = cProfile.Profile()
+
+    def wrap(self, function):
+        """Returns function, profiled in the thread calling it
+        """
+        def profiled(*args, **kwargs):
+            self._profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._profile.disable()
+        return profiled
+
+    def dump(self):
+        self._profile.dump_stats(self.path)
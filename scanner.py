@@ -0,0 +1,702 @@
+import os
+import stat
+import time
+import heapq
+import queue
+import bisect
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger()
+
+#================ Scan results ================
+class ScanStats(object):
+    """Counters gathered while scanning a tree
+
+    Attributes:
+        dirs: The number of directories listed
+        files: The number of non directory entries counted
+        bytes: The total size of the counted entries
+        hardlinks_skipped: The number of entries skipped because their inode
+                           was already counted
+        other_fs_skipped: The number of directories skipped because they are
+                          on another file system
+        errors: The number of entries that could not be read
+        reused: The number of unchanged directories taken from the previous
+                scan instead of being listed
+        scandir_calls: The number of os.scandir calls
+        stat_calls: The number of stat calls (one at most per entry)
+        throttled: The time the scan was paused by its throttle, in seconds,
+                   summed over the scanner threads
+        elapsed: The duration of the scan, in seconds
+        breakdown: The Breakdown of the counted files, None to not count them
+    """
+    def __init__(self, breakdown=None):
+        self.dirs = 0
+        self.files = 0
+        self.bytes = 0
+        self.hardlinks_skipped = 0
+        self.other_fs_skipped = 0
+        self.errors = 0
+        self.reused = 0
+        self.scandir_calls = 0
+        self.stat_calls = 0
+        self.throttled = 0.0
+        self.elapsed = 0.0
+        self.breakdown = breakdown
+
+    def merge(self, other):
+        """Adds the counters of another ScanStats, except the duration
+        """
+        for name in ('dirs', 'files', 'bytes', 'hardlinks_skipped',
+                     'other_fs_skipped', 'errors', 'reused', 'scandir_calls',
+                     'stat_calls', 'throttled'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        if self.breakdown is not None and other.breakdown is not None:
+            self.breakdown.merge(other.breakdown)
+
+    @property
+    def files_per_sec(self):
+        if not self.elapsed:
+            return 0.0
+        return self.files/self.elapsed
+
+    @property
+    def syscalls(self):
+        return self.scandir_calls + self.stat_calls
+
+    def __str__(self):
+        return ("{dirs} dirs, {files} files, {bytes} bytes in {elapsed:.2f}s "
+                "({files_per_sec:.0f} files/s, {scandir_calls} scandir, "
+                "{stat_calls} stat, {reused} reused, {errors} errors, "
+                "{throttled:.2f}s throttled)").format(files_per_sec=self.files_per_sec,
+                                                              **self.__dict__)
+
+class Breakdown(object):
+    """The bytes and number of files by owner, group, extension and age of
+    the files of a scan.
+
+    Each dimension keeps at most 2*max_keys keys: beyond, only the max_keys
+    largest are kept and the others are added up under OTHER, so the memory
+    does not depend on the tree. The counts of a key can then be partly in
+    OTHER.
+
+    Attributes:
+        max_keys: The number of keys kept by dimension
+        age_limits: The upper limits of the age buckets, in seconds, sorted
+        now: The time the ages are measured from
+        counters: The [bytes, files] by key, by dimension in DIMENSIONS
+    """
+    DIMENSIONS = ('uid', 'gid', 'extension', 'age')
+    OTHER = 'other'
+    # Longer extensions are rather parts of a name
+    MAX_EXTENSION_LENGTH = 16
+
+    def __init__(self, max_keys, age_limits, now=None):
+        self.max_keys = max_keys
+        self.age_limits = sorted(age_limits)
+        self.now = time.time() if now is None else now
+        self.counters = OrderedDict((dimension, {}) for dimension in self.DIMENSIONS)
+        self._age_labels = self.age_labels(self.age_limits)
+
+    @staticmethod
+    def age_labels(age_limits):
+        """Names the age buckets of some sorted limits, as '<1d', '1d-7d',
+        '>7d'
+        """
+        def duration(seconds):
+            if seconds % 86400 == 0:
+                return '{0}d'.format(int(seconds//86400))
+            return '{0}h'.format(int(seconds//3600))
+        if not age_limits:
+            return ['all']
+        labels = ['<{0}'.format(duration(age_limits[0]))]
+        labels.extend('{0}-{1}'.format(duration(low), duration(high))
+                      for low, high in zip(age_limits, age_limits[1:]))
+        labels.append('>{0}'.format(duration(age_limits[-1])))
+        return labels
+
+    def empty(self):
+        """Returns an empty Breakdown with the same settings
+        """
+        return Breakdown(self.max_keys, self.age_limits, self.now)
+
+    def _count(self, dimension, key, size, files=1):
+        counters = self.counters[dimension]
+        counter = counters.get(key)
+        if counter is None:
+            counters[key] = [size, files]
+            if len(counters) > 2*self.max_keys:
+                self._prune(counters)
+        else:
+            counter[0] += size
+            counter[1] += files
+
+    def _prune(self, counters):
+        """Keeps the max_keys largest keys of a dimension and adds the others
+        to OTHER
+        """
+        other = counters.pop(self.OTHER, [0, 0])
+        kept = sorted(counters.items(), key=lambda item: item[1][0], reverse=True)
+        for key, (size, files) in kept[self.max_keys:]:
+            other[0] += size
+            other[1] += files
+        counters.clear()
+        counters.update(kept[:self.max_keys])
+        counters[self.OTHER] = other
+
+    def add(self, name, entry_stat):
+        """Counts a file
+
+        Arguments:
+            name: The name of the file
+            entry_stat: Its stat result
+        """
+        size = entry_stat.st_size
+        self._count('uid', entry_stat.st_uid, size)
+        self._count('gid', entry_stat.st_gid, size)
+        dot = name.rfind('.')
+        extension = name[dot + 1:].lower() if 0 < dot < len(name) - 1 else ''
+        if len(extension) > self.MAX_EXTENSION_LENGTH:
+            extension = self.OTHER
+        self._count('extension', extension, size)
+        bucket = bisect.bisect_right(self.age_limits, self.now - entry_stat.st_mtime)
+        self._count('age', self._age_labels[bucket], size)
+
+    def merge(self, other):
+        """Adds the counters of another Breakdown
+        """
+        for dimension, counters in other.counters.items():
+            for key, (size, files) in counters.items():
+                self._count(dimension, key, size, files)
+
+    def top(self, dimension, count=None):
+        """Returns the largest keys of a dimension
+
+        Returns:
+            list: The (key, bytes, files), largest first, OTHER included
+        """
+        items = sorted(((key, size, files)
+                        for key, (size, files) in self.counters[dimension].items()),
+                       key=lambda item: item[1], reverse=True)
+        return items[:count] if count is not None else items
+
+class FolderNode(object):
+    """The size of a single directory, as found by the scan
+
+    Attributes:
+        path: The path of the directory
+        parent: The path of the parent directory, None for the scanned root
+        files_size: The size of the files directly in this directory
+        size: The size of the directory and all its children
+        children: The paths of the sub directories
+        mtime: The modification time of the directory, in nanoseconds
+        ctime: The change time of the directory, in nanoseconds
+        hardlinks: The number of files with several links in the directory,
+                   counted here or not
+    """
+    __slots__ = ('path', 'parent', 'files_size', 'size', 'children', 'mtime',
+                 'ctime', 'hardlinks')
+
+    def __init__(self, path, parent=None, folder_stat=None):
+        self.path = path
+        self.parent = parent
+        self.files_size = 0
+        self.size = 0
+        self.children = []
+        self.mtime = folder_stat.st_mtime_ns if folder_stat is not None else None
+        self.ctime = folder_stat.st_ctime_ns if folder_stat is not None else None
+        self.hardlinks = 0
+
+# A folder of the top lists
+#   path: The path of the folder
+#   size: Its size
+#   growth: The change of its size since the previous scan, None if it is
+#           not known
+TopFolder = namedtuple('TopFolder', ('path', 'size', 'growth'))
+
+class TopFolders(object):
+    """Keeps the largest folders, and those which grew the most, as they are
+    seen. Each list is a heap of at most count folders, so the memory does
+    not depend on the size of the trees.
+
+    Attributes:
+        count: The length of the lists
+        min_depth: The folders less deep below their scanned root are
+                   ignored, 0 to count the roots
+    """
+    def __init__(self, count, min_depth=0):
+        self.count = count
+        self.min_depth = min_depth
+        self._largest = []
+        self._growing = []
+
+    @staticmethod
+    def _push(heap, count, key, folder):
+        item = (key, folder)
+        if len(heap) < count:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    def add(self, path, depth, size, growth=None):
+        """Considers a folder for the lists
+
+        Arguments:
+            path: The path of the folder
+            depth: Its depth below the scanned root
+            size: Its size
+            growth: The change of its size since the previous scan, None if
+                    it is not known
+        """
+        if depth < self.min_depth or self.count <= 0:
+            return
+        folder = TopFolder(path, size, growth)
+        self._push(self._largest, self.count, size, folder)
+        if growth is not None and growth > 0:
+            self._push(self._growing, self.count, growth, folder)
+
+    def largest(self):
+        """Returns the largest folders, largest first
+        """
+        return [folder for _, folder in sorted(self._largest, reverse=True)]
+
+    def fastest_growing(self):
+        """Returns the folders which grew the most, fastest first
+        """
+        return [folder for _, folder in sorted(self._growing, reverse=True)]
+
+# What is known of a directory from the previous scan
+#   mtime, ctime: The times of the directory when it was listed
+#   files_size: The size of its files
+#   children: The paths of its sub directories
+#   hardlinks: The number of its files with several links, None if unknown
+PreviousFolder = namedtuple('PreviousFolder', ('mtime', 'ctime', 'files_size', 'children',
+                                               'hardlinks'))
+
+#================ Scan functions ================
+def list_folder(path, root_dev, stats, count_hardlinks_once=True, one_file_system=True):
+    """Lists a single directory, without descending in its children.
+
+    Arguments:
+        path: The path of the directory
+        root_dev: The device of the scanned root
+        stats: The ScanStats to update
+        count_hardlinks_once: Set the files with several links apart
+        one_file_system: Skip the sub directories on another device
+    Returns:
+        (list, int, list): The (path, stat) of the sub directories, the size
+                           of the files and the ((device, inode), size,
+                           (name, stat) for the breakdown or None) of the
+                           files with several links, in listing order
+    """
+    folders = []
+    files_size = 0
+    hardlinks = []
+    breakdown = stats.breakdown
+    stats.dirs += 1
+    try:
+        stats.scandir_calls += 1
+        for entry in os.scandir(path):
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                # The stat result is cached by the DirEntry, one call at most
+                # per entry
+                entry_stat = entry.stat(follow_symlinks=False)
+                stats.stat_calls += 1
+            except OSError as e:
+                logger.warning("Cannot stat {0} : {1}".format(entry.path, e))
+                stats.errors += 1
+                continue
+            if is_dir:
+                if one_file_system and entry_stat.st_dev != root_dev:
+                    stats.other_fs_skipped += 1
+                    continue
+                folders.append((entry.path, entry_stat))
+                continue
+            if count_hardlinks_once and entry_stat.st_nlink > 1 and \
+               not stat.S_ISLNK(entry_stat.st_mode):
+                hardlinks.append(((entry_stat.st_dev, entry_stat.st_ino),
+                                  entry_stat.st_size,
+                                  (entry.name, entry_stat) if breakdown is not None else None))
+                continue
+            stats.files += 1
+            stats.bytes += entry_stat.st_size
+            files_size += entry_stat.st_size
+            if breakdown is not None:
+                breakdown.add(entry.name, entry_stat)
+    except OSError as e:
+        logger.warning("Cannot list {0} : {1}".format(path, e))
+        stats.errors += 1
+    return folders, files_size, hardlinks
+
+def reuse_folder(path, previous_folder, root_dev, stats, one_file_system=True):
+    """Takes the content of an unchanged directory from the previous scan.
+    Only the sub directories are stat'ed, to know if they changed.
+
+    Arguments:
+        path: The path of the directory
+        previous_folder: The PreviousFolder of the directory
+        root_dev: The device of the scanned root
+        stats: The ScanStats to update
+        one_file_system: Skip the sub directories on another device
+    Returns:
+        (list, int, list): Same as list_folder, None if a sub directory is
+                           gone and the directory must be listed
+    """
+    folders = []
+    for folder_path in previous_folder.children:
+        try:
+            folder_stat = os.lstat(folder_path)
+            stats.stat_calls += 1
+        except OSError:
+            return None
+        if not stat.S_ISDIR(folder_stat.st_mode):
+            return None
+        if one_file_system and folder_stat.st_dev != root_dev:
+            stats.other_fs_skipped += 1
+            continue
+        folders.append((folder_path, folder_stat))
+    stats.reused += 1
+    return folders, previous_folder.files_size, []
+
+def read_folder(node, root_dev, stats, previous=None, count_hardlinks_once=True,
+                one_file_system=True):
+    """Lists a directory, or reuses the previous scan if it did not change
+    since. A directory with files with several links is always listed: the
+    size it got at the previous scan depends on the links seen before it.
+
+    Arguments:
+        node: The FolderNode of the directory
+        root_dev: The device of the scanned root
+        stats: The ScanStats to update
+        previous: The PreviousFolder by path, None to list every directory
+        count_hardlinks_once: Set the files with several links apart
+        one_file_system: Skip the sub directories on another device
+    Returns:
+        (list, int, list): Same as list_folder
+    """
+    previous_folder = previous.get(node.path) if previous else None
+    if previous_folder is not None and node.mtime == previous_folder.mtime and \
+       node.ctime == previous_folder.ctime and previous_folder.hardlinks == 0:
+        result = reuse_folder(node.path, previous_folder, root_dev, stats,
+                              one_file_system)
+        if result is not None:
+            return result
+    return list_folder(node.path, root_dev, stats, count_hardlinks_once,
+                       one_file_system)
+
+def count_hardlinks(node, hardlinks, seen_inodes, stats):
+    """Adds to a folder the files with several links not seen yet
+
+    Arguments:
+        node: The FolderNode containing the files
+        hardlinks: The ((device, inode), size, entry) of the files
+        seen_inodes: The (device, inode) already counted, updated
+        stats: The ScanStats to update
+    """
+    node.hardlinks = len(hardlinks)
+    for inode, size, entry in hardlinks:
+        if inode in seen_inodes:
+            stats.hardlinks_skipped += 1
+            continue
+        seen_inodes.add(inode)
+        stats.files += 1
+        stats.bytes += size
+        node.files_size += size
+        if entry is not None and stats.breakdown is not None:
+            stats.breakdown.add(*entry)
+
+class ScanState(object):
+    """The progress of the scan of a folder, which can be stopped between two
+    directories and resumed later, even by another process since it pickles.
+
+    Attributes:
+        path: The path of the scanned folder
+        root_dev: Its device
+        nodes: The FolderNode of every directory found so far by path,
+               parents before their children. Only the listed ones have
+               their files_size.
+        stack: The paths of the directories found but not listed yet
+        seen_inodes: The (device, inode) of the files with several links
+                     already counted
+        stats: The ScanStats of the scan so far
+    """
+    def __init__(self, path, stats=None):
+        self.path = path
+        self.stats = stats if stats is not None else ScanStats()
+        root_stat = os.lstat(path)
+        self.stats.stat_calls += 1
+        self.root_dev = root_stat.st_dev
+        self.nodes = OrderedDict([(path, FolderNode(path, folder_stat=root_stat))])
+        self.stack = [path]
+        self.seen_inodes = set()
+
+    @property
+    def done(self):
+        return not self.stack
+
+    def __getstate__(self):
+        # Pickled as columns, much faster than a million FolderNode. The
+        # children are found again from the parents.
+        state = self.__dict__.copy()
+        nodes = list(self.nodes.values())
+        state['nodes'] = ([node.path for node in nodes],
+                          [node.parent for node in nodes],
+                          [node.files_size for node in nodes],
+                          [node.mtime for node in nodes],
+                          [node.ctime for node in nodes],
+                          [node.hardlinks for node in nodes])
+        return state
+
+    def __setstate__(self, state):
+        columns = state.pop('nodes')
+        self.__dict__.update(state)
+        self.nodes = OrderedDict()
+        for path, parent, files_size, mtime, ctime, hardlinks in zip(*columns):
+            node = self.nodes[path] = FolderNode(path, parent)
+            node.files_size = files_size
+            node.mtime = mtime
+            node.ctime = ctime
+            node.hardlinks = hardlinks
+            if parent is not None:
+                self.nodes[parent].children.append(path)
+
+    def run(self, previous=None, count_hardlinks_once=True, one_file_system=True,
+            throttle=None, deadline=None):
+        """Lists the directories found until there are none left
+
+        Arguments:
+            previous, count_hardlinks_once, one_file_system, throttle: As in
+                scan_folder
+            deadline: The time.monotonic() time to stop at, None to list
+                      everything
+        Returns:
+            bool: Whether the scan is done
+        """
+        start = time.perf_counter()
+        stats = self.stats
+        nodes = self.nodes
+        stack = self.stack
+        while stack:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            node = nodes[stack.pop()]
+            dirs, stat_calls = stats.dirs, stats.stat_calls
+            folders, node.files_size, hardlinks = read_folder(node, self.root_dev, stats,
+                                                              previous,
+                                                              count_hardlinks_once,
+                                                              one_file_system)
+            if throttle is not None:
+                stats.throttled += throttle.pace(stats.dirs - dirs, stats.stat_calls - stat_calls)
+            count_hardlinks(node, hardlinks, self.seen_inodes, stats)
+            for folder_path, folder_stat in folders:
+                nodes[folder_path] = FolderNode(folder_path, node.path, folder_stat)
+                node.children.append(folder_path)
+                stack.append(folder_path)
+        stats.elapsed += time.perf_counter() - start
+        return not stack
+
+def scan_folder(path, stats=None, previous=None, count_hardlinks_once=True,
+                one_file_system=True, throttle=None):
+    """Computes the size of a folder and all its children, iteratively.
+    Symbolic links are never followed, they count for their own size.
+
+    Arguments:
+        path: The path of the folder to scan
+        stats: A ScanStats to update, a new one is created if None
+        previous: The PreviousFolder by path, the unchanged directories are
+                  not listed again
+        count_hardlinks_once: Count files with several links only once
+        one_file_system: Do not descend in folders on another file system
+        throttle: A throttling.ScanThrottle pacing the reads, None to read as
+                  fast as possible
+    Returns:
+        (dict, ScanStats): The FolderNode of every directory by path, parents
+                           before their children, and the scan statistics
+    """
+    state = ScanState(path, stats)
+    state.run(previous, count_hardlinks_once, one_file_system, throttle)
+    aggregate_sizes(state.nodes)
+    return state.nodes, state.stats
+
+def aggregate_sizes(nodes):
+    """Sums the sizes of the children into their parents
+
+    Arguments:
+        nodes: The FolderNode by path, parents before their children
+    """
+    for node in nodes.values():
+        node.size = node.files_size
+    for node in reversed(list(nodes.values())):
+        if node.parent is not None:
+            nodes[node.parent].size += node.size
+
+#================ Parallel scan ================
+class _RootScan(object):
+    """The state of a root folder during a parallel scan
+    """
+    def __init__(self, path, root_stat, breakdown=None):
+        self.path = path
+        self.root_dev = root_stat.st_dev
+        self.nodes = {path: FolderNode(path, folder_stat=root_stat)}
+        self.hardlinks = {}
+        self.stats = ScanStats(breakdown)
+        self.pending = 1
+        self.start = time.perf_counter()
+
+    def result(self):
+        """Orders the nodes like scan_folder does, so hard links are
+        attributed to the same folders, and computes the sizes
+
+        Returns:
+            (dict, ScanStats): Same as scan_folder
+        """
+        nodes = OrderedDict([(self.path, self.nodes[self.path])])
+        seen_inodes = set()
+        stack = [self.path]
+        while stack:
+            node = self.nodes[stack.pop()]
+            count_hardlinks(node, self.hardlinks.get(node.path, ()), seen_inodes,
+                            self.stats)
+            for folder_path in node.children:
+                nodes[folder_path] = self.nodes[folder_path]
+            stack.extend(node.children)
+        aggregate_sizes(nodes)
+        self.stats.elapsed = time.perf_counter() - self.start
+        return nodes, self.stats
+
+class ParallelScanner(object):
+    """Scans several folders with a pool of threads. Every directory is a
+    separate task, so the workers share the sub directories of a large root
+    instead of scanning one root each.
+
+    Attributes:
+        workers: The number of threads
+        workers_per_device: The maximum number of directories listed at the
+                            same time on a device
+        throttle: The throttling.ScanThrottle shared by the workers, None to
+                  read as fast as possible
+        on_start: A function called at the start of each worker thread
+        breakdown: A Breakdown whose settings are used for the breakdown of
+                   each root, None to not count the files by key
+    """
+    def __init__(self, workers, workers_per_device, previous=None,
+                 count_hardlinks_once=True, one_file_system=True, throttle=None,
+                 on_start=None, breakdown=None):
+        self.workers = workers
+        self.workers_per_device = workers_per_device
+        self.throttle = throttle
+        self.on_start = on_start
+        self.breakdown = breakdown
+        self.previous = previous
+        self.count_hardlinks_once = count_hardlinks_once
+        self.one_file_system = one_file_system
+        self._condition = threading.Condition()
+        # Tasks waiting to be listed, by device
+        self._tasks = {}
+        # Number of directories being listed, by device
+        self._active = {}
+        self._done = queue.Queue()
+        self._remaining_roots = 0
+        self._error = None
+
+    def scan(self, paths):
+        """Scans the folders and yields them as soon as they are complete.
+        Consuming the results in a single thread keeps the database writes in
+        a single writer while the scan goes on.
+
+        Arguments:
+            paths: The paths of the folders to scan
+        Yields:
+            (str, dict, ScanStats): The path of a root and the result of
+                                    scan_folder for it
+        """
+        roots = []
+        for path in paths:
+            root = _RootScan(path, os.lstat(path),
+                             self.breakdown.empty() if self.breakdown is not None else None)
+            root.stats.stat_calls += 1
+            roots.append(root)
+        if not roots:
+            return
+        self._remaining_roots = len(roots)
+        for root in roots:
+            self._tasks.setdefault(root.root_dev, []).append((root, root.nodes[root.path]))
+        threads = [threading.Thread(target=self._work, name="scanner-{0}".format(i),
+                                    daemon=True)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for _ in roots:
+                root = self._done.get()
+                if root is None:
+                    raise self._error
+                nodes, stats = root.result()
+                yield root.path, nodes, stats
+        finally:
+            with self._condition:
+                self._remaining_roots = 0
+                self._condition.notify_all()
+            for thread in threads:
+                thread.join()
+
+    def _next_task(self):
+        """Waits for a directory on a device with a free slot
+
+        Returns:
+            (int, _RootScan, FolderNode): The device, root and node to list,
+                                          None when the scan is over
+        """
+        with self._condition:
+            while self._remaining_roots:
+                for device, tasks in self._tasks.items():
+                    if tasks and self._active.get(device, 0) < self.workers_per_device:
+                        self._active[device] = self._active.get(device, 0) + 1
+                        root, node = tasks.pop()
+                        return device, root, node
+                self._condition.wait()
+            return None
+
+    def _work(self):
+        if self.on_start is not None:
+            self.on_start()
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            device, root, node = task
+            stats = ScanStats(root.stats.breakdown.empty()
+                              if root.stats.breakdown is not None else None)
+            try:
+                folders, files_size, hardlinks = read_folder(node, root.root_dev, stats,
+                                                             self.previous,
+                                                             self.count_hardlinks_once,
+                                                             self.one_file_system)
+                if self.throttle is not None:
+                    stats.throttled = self.throttle.pace(stats.dirs, stats.stat_calls)
+            except Exception as e:
+                with self._condition:
+                    self._error = e
+                    self._remaining_roots = 0
+                    self._condition.notify_all()
+                self._done.put(None)
+                return
+            with self._condition:
+                self._active[device] -= 1
+                root.stats.merge(stats)
+                node.files_size = files_size
+                if hardlinks:
+                    root.hardlinks[node.path] = hardlinks
+                for folder_path, folder_stat in folders:
+                    child = FolderNode(folder_path, node.path, folder_stat)
+                    root.nodes[folder_path] = child
+                    node.children.append(folder_path)
+                    self._tasks.setdefault(folder_stat.st_dev, []).append((root, child))
+                root.pending += len(folders) - 1
+                if not root.pending:
+                    self._remaining_roots -= 1
+                    self._done.put(root)
+                self._condition.notify_all()
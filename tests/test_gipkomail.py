@@ -0,0 +1,236 @@
+"""Sends the mails of gipkomail to a minimal SMTP server on localhost, which
+keeps them, and can drop the connections or refuse the recipients.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import smtplib
+import tempfile
+import unittest
+import threading
+import socketserver
+from unittest import mock
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gipkomail
+
+class SMTPStandIn(socketserver.StreamRequestHandler):
+    """Keeps the mails in server.messages. The behaviour is set on the server :
+    server.close_after_message closes the connection after each mail,
+    server.close_on_mail closes it on the MAIL command and
+    server.rcpt_code is the answer to the RCPT commands.
+    """
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.wfile.write(b'220 stand-in\r\n')
+        for line in self.rfile:
+            command = line[:4].upper()
+            if command == b'MAIL' and server.close_on_mail:
+                return
+            if command == b'RCPT':
+                with server.lock:
+                    server.recipients += 1
+                self.wfile.write('{0} rcpt\r\n'.format(server.rcpt_code).encode('ascii'))
+            elif command == b'DATA':
+                self.wfile.write(b'354 go\r\n')
+                lines = []
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+                    lines.append(data_line)
+                with server.lock:
+                    server.messages.append(b''.join(lines))
+                self.wfile.write(b'250 ok\r\n')
+                if server.close_after_message:
+                    return
+            elif command == b'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+class SMTPTest(unittest.TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('localhost', 0), SMTPStandIn)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        self.server.recipients = 0
+        self.server.messages = []
+        self.server.close_after_message = False
+        self.server.close_on_mail = False
+        self.server.rcpt_code = 250
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.port = self.server.server_address[1]
+        self.directory = tempfile.mkdtemp()
+        self.connexion = gipkomail.ConnexionSMTP('localhost', self.port)
+
+    def tearDown(self):
+        self.connexion.fermer()
+        self.stop_server()
+        shutil.rmtree(self.directory)
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def outbox(self):
+        return gipkomail.BoiteEnvoi(os.path.join(self.directory, 'outbox'))
+
+    def make_due(self, boite, identifiant):
+        """Makes a message waiting for its next attempt due now
+
+        Returns:
+            dict: Its envelope
+        """
+        with open(os.path.join(boite.chemin, identifiant + '.json'), 'rb') as f:
+            enveloppe = json.loads(f.read().decode('utf-8'))
+        enveloppe['prochain_essai'] = 0
+        boite._ecrire_enveloppe(identifiant, enveloppe)
+        return enveloppe
+
+    #================ ConnexionSMTP ================
+    def test_connection_reused(self):
+        for i in range(3):
+            self.connexion.envoyer('from@localhost', ['to@localhost'],
+                                   'Subject: {0}\r\n\r\nbody'.format(i))
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.messages), 3)
+
+    def test_file_sent_by_chunks(self):
+        path = os.path.join(self.directory, 'message.eml')
+        with open(path, 'wb') as f:
+            f.write(b'Subject: file\r\n\r\n.starts with a dot\r\n' + b'x'*100 + b'\r\n'*gipkomail.BLOC)
+        with open(path, 'rb') as f:
+            self.connexion.envoyer('from@localhost', ['to@localhost'], f)
+            self.connexion.envoyer('from@localhost', ['to@localhost'], b'Subject: bytes\r\n\r\nbody')
+        self.assertEqual(self.server.connections, 1)
+        # The stand-in keeps the doubled dot
+        self.assertIn(b'\r\n..starts with a dot\r\n', self.server.messages[0])
+
+    def test_retry_after_disconnect(self):
+        self.server.close_after_message = True
+        path = os.path.join(self.directory, 'message.eml')
+        with open(path, 'wb') as f:
+            f.write(b'Subject: file\r\n\r\nbody\r\n')
+        self.connexion.envoyer('from@localhost', ['to@localhost'], b'Subject: first\r\n\r\nbody')
+        # Closed by the server since : sent again on a new connection
+        with open(path, 'rb') as f:
+            self.connexion.envoyer('from@localhost', ['to@localhost'], f)
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertIn(b'Subject: file', self.server.messages[1])
+
+    def test_single_retry(self):
+        self.connexion.envoyer('from@localhost', ['to@localhost'], b'Subject: first\r\n\r\nbody')
+        self.connexion.fermer()
+        self.connexion.ouvrir()
+        self.server.close_on_mail = True
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            self.connexion.envoyer('from@localhost', ['to@localhost'], b'Subject: lost\r\n\r\nbody')
+        # The opened connection, then a single new one
+        self.assertEqual(self.server.connections, 3)
+        # No retry on a connection just opened
+        self.connexion.fermer()
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            self.connexion.envoyer('from@localhost', ['to@localhost'], b'Subject: lost\r\n\r\nbody')
+        self.assertEqual(self.server.connections, 4)
+        self.assertEqual(len(self.server.messages), 1)
+
+    #================ BoiteEnvoi ================
+    def test_outbox_written_atomically(self):
+        boite = self.outbox()
+        identifiant = boite.ajouter('from@localhost', 'to@localhost', 'queued', 'body')
+        self.assertEqual(sorted(os.listdir(boite.chemin)),
+                         sorted(['abandonnes', identifiant + '.eml', identifiant + '.json']))
+        # Killed while writing a message : only its temporary file is left
+        with mock.patch.object(gipkomail, 'ecrire_message', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                boite.ajouter('from@localhost', 'to@localhost', 'killed', 'body')
+        names = os.listdir(boite.chemin)
+        self.assertEqual(len([name for name in names if name.endswith('.eml.tmp')]), 1)
+        self.assertEqual(len([name for name in names if name.endswith('.eml')]), 1)
+        self.assertEqual([message for message, enveloppe in boite.a_envoyer()], [identifiant])
+
+    def test_outbox_recovered_after_restart(self):
+        boite = self.outbox()
+        first = boite.ajouter('from@localhost', 'to@localhost', 'first', 'body')
+        second = boite.ajouter('from@localhost', ['to@localhost', 'cc@localhost'], 'second', 'body')
+        # Killed between the message and its envelope
+        os.remove(os.path.join(boite.chemin, second + '.json'))
+        boite = self.outbox()
+        self.assertEqual([identifiant for identifiant, enveloppe in boite.a_envoyer()], [first])
+        facteur = gipkomail.Facteur(boite, self.connexion)
+        self.assertEqual(facteur.distribuer(), 1)
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertIn(b'Subject: first', self.server.messages[0])
+        self.assertEqual(boite.a_envoyer(), [])
+
+    def test_abandoned_after_max_attempts(self):
+        self.server.rcpt_code = 550
+        boite = self.outbox()
+        identifiant = boite.ajouter('from@localhost', 'to@localhost', 'refused', 'body')
+        facteur = gipkomail.Facteur(boite, self.connexion, delai=0, tentatives_max=3)
+        self.assertEqual(facteur.distribuer(), 0)
+        self.assertEqual(self.server.recipients, 3)
+        self.assertEqual(boite.a_envoyer(float('inf')), [])
+        self.assertEqual(sorted(os.listdir(boite.chemin_abandonnes)),
+                         [identifiant + '.eml', identifiant + '.json'])
+        with open(os.path.join(boite.chemin_abandonnes, identifiant + '.json'), 'rb') as f:
+            enveloppe = json.loads(f.read().decode('utf-8'))
+        self.assertEqual(enveloppe['tentatives'], 3)
+        self.assertIn('550', enveloppe['erreur'])
+
+    #================ Facteur ================
+    def test_backoff(self):
+        self.server.rcpt_code = 550
+        boite = self.outbox()
+        identifiant = boite.ajouter('from@localhost', 'to@localhost', 'refused', 'body')
+        facteur = gipkomail.Facteur(boite, self.connexion, delai=10, delai_max=25, tentatives_max=10)
+        delays = []
+        for i in range(4):
+            facteur.distribuer()
+            (message, enveloppe), = boite.a_envoyer(float('inf'))
+            delays.append(round(enveloppe['prochain_essai'] - time.time()))
+            self.assertEqual(boite.a_envoyer(), [])
+            self.make_due(boite, identifiant)
+        self.assertEqual(delays, [10, 20, 25, 25])
+        self.assertEqual(self.server.recipients, 4)
+
+    def test_server_down(self):
+        boite = self.outbox()
+        first = boite.ajouter('from@localhost', 'to@localhost', 'first', 'body')
+        second = boite.ajouter('from@localhost', 'to@localhost', 'second', 'body')
+        self.stop_server()
+        facteur = gipkomail.Facteur(boite, self.connexion, delai=10)
+        self.assertEqual(facteur.distribuer(), 0)
+        # The whole outbox waits, the first message counts the failure
+        self.assertAlmostEqual(facteur.reprise - time.time(), 10, delta=1)
+        enveloppes = dict(boite.a_envoyer(float('inf')))
+        self.assertEqual(enveloppes[first]['tentatives'], 1)
+        self.assertEqual(enveloppes[second]['tentatives'], 0)
+
+    def test_woken_up(self):
+        boite = self.outbox()
+        facteur = gipkomail.Facteur(boite, self.connexion, intervalle=60)
+        facteur.start()
+        try:
+            boite.ajouter('from@localhost', 'to@localhost', 'woken', 'body')
+            facteur.reveiller()
+            deadline = time.monotonic() + 10
+            while not self.server.messages and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            facteur.arreter()
+            facteur.join(10)
+        self.assertFalse(facteur.is_alive())
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertEqual(boite.a_envoyer(float('inf')), [])
+
+if __name__ == "__main__":
+    unittest.main()
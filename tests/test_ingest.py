@@ -0,0 +1,131 @@
+"""Pushes the batches of the agent to an ingest service on localhost, with
+temporary databases and spool.
+"""
+import os
+import sys
+import gzip
+import json
+import shutil
+import datetime
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import disk_stats_settings as dss
+import disk_stats
+import agent
+import ingest
+
+TOKEN = 'secret'
+
+def disks_report(device, mount_point, used_space, size):
+    date = datetime.datetime.now()
+    data_point = disk_stats.DataPoint(date=date, used_space=used_space, size=size,
+                                      file_system=disk_stats.FileSystem(name=device),
+                                      mount_point=disk_stats.MountPoint(path=mount_point))
+    return disk_stats.Report(data=[data_point], errors=[], details={})
+
+def folders_report(path, size):
+    folder = disk_stats.FolderSizeHistory(path=path, size=size, date=datetime.datetime.now())
+    return disk_stats.Report(data=[folder], errors=[], details={})
+
+class IngestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        settings = mock.patch.multiple(dss,
+                                       INGEST_DATABASE_PATH=os.path.join(self.directory,
+                                                                         'ingest.sqlite'),
+                                       INGEST_ADDRESS='127.0.0.1', INGEST_PORT=0,
+                                       INGEST_TOKEN=TOKEN, INGEST_MAX_REQUEST_SIZE=64*1024,
+                                       AGENT_INGEST_URL=None,
+                                       AGENT_SPOOL_PATH=os.path.join(self.directory, 'spool'),
+                                       AGENT_TOKEN=TOKEN, AGENT_HOST_NAME='alpha',
+                                       AGENT_BATCHES_PER_PUSH=50, AGENT_MAX_SPOOLED=100,
+                                       AGENT_TIMEOUT=datetime.timedelta(seconds=10))
+        settings.start()
+        self.addCleanup(settings.stop)
+        ingest.init_database()
+        self.server = ingest.serve()
+        dss.AGENT_INGEST_URL = 'http://127.0.0.1:{0}/'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if not ingest.db.is_closed():
+            ingest.db.close()
+        shutil.rmtree(self.directory)
+
+    def request(self, body, headers):
+        """Posts a raw body to the ingest service
+
+        Returns:
+            (int, dict): The status and the answer
+        """
+        request = urllib.request.Request(dss.AGENT_INGEST_URL, data=body, headers=headers,
+                                         method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status, json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read().decode('utf-8'))
+
+    def test_push_two_hosts(self):
+        agent.spool(disks_report('/dev/sda1', '/', 60, 100), folders_report('/srv', 2048))
+        dss.AGENT_HOST_NAME = 'beta'
+        agent.spool(disks_report('/dev/sdb1', '/data', 95, 100), folders_report('/home', 4096))
+        self.assertEqual(len(agent.spooled()), 2)
+        self.assertEqual(agent.push(), 2)
+        self.assertEqual(agent.spooled(), [])
+        self.assertEqual(ingest.HostDataPoint.select().count(), 2)
+        self.assertEqual(ingest.HostFolderSize.select().count(), 2)
+        text = ingest.report_text()
+        for value in ('alpha', 'beta', '/dev/sda1', '/dev/sdb1', '/srv', '/home'):
+            self.assertIn(value, text)
+
+    def test_batch_sent_again(self):
+        agent.spool(disks_report('/dev/sda1', '/', 60, 100), folders_report('/srv', 2048))
+        path, = agent.spooled()
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            batch = json.load(f)
+        # Taken, but the answer is lost : the batch stays spooled
+        self.assertEqual(agent.post([batch]), {'loaded': 1, 'duplicates': 0})
+        self.assertEqual(agent.push(), 1)
+        self.assertEqual(agent.spooled(), [])
+        self.assertEqual(agent.post([batch]), {'loaded': 0, 'duplicates': 1})
+        self.assertEqual(ingest.IngestedBatch.select().count(), 1)
+        self.assertEqual(ingest.HostDataPoint.select().count(), 1)
+        self.assertEqual(ingest.HostFolderSize.select().count(), 1)
+
+    def test_bad_token(self):
+        dss.AGENT_TOKEN = 'wrong'
+        agent.spool(folders_report=folders_report('/srv', 2048))
+        self.assertEqual(agent.push(), 0)
+        # Kept for the next push
+        self.assertEqual(len(agent.spooled()), 1)
+        status, answer = self.request(b'{"batches": []}', {'Content-Type': 'application/json'})
+        self.assertEqual(status, 401)
+        self.assertEqual(ingest.Host.select().count(), 0)
+
+    def test_request_too_large(self):
+        body = json.dumps({'batches': [], 'padding': 'x'*dss.INGEST_MAX_REQUEST_SIZE})
+        status, answer = self.request(body.encode('utf-8'),
+                                      {'Content-Type': 'application/json',
+                                       'Authorization': 'Bearer {0}'.format(TOKEN)})
+        self.assertEqual(status, 413)
+
+    def test_malformed_batch(self):
+        headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {0}'.format(TOKEN)}
+        for body in (b'not json', b'{"batches": {}}', b'{"other": []}',
+                     json.dumps({'batches': [{'id': 'a', 'host': 'alpha'}]}).encode('utf-8'),
+                     json.dumps({'batches': [{'id': 'a', 'host': 'alpha', 'date': '',
+                                              'data_points': [[1, 2]],
+                                              'folders': []}]}).encode('utf-8')):
+            status, answer = self.request(body, headers)
+            self.assertEqual(status, 400, body)
+            self.assertIn('error', answer)
+        self.assertEqual(ingest.IngestedBatch.select().count(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
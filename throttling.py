@@ -0,0 +1,193 @@
+import os
+import time
+import psutil
+import logging
+import threading
+# Settings
+import disk_stats_settings as dss
+
+logger = logging.getLogger()
+
+IOPRIO_CLASSES = {'idle': 'IOPRIO_CLASS_IDLE', 'best-effort': 'IOPRIO_CLASS_BE'}
+
+#================ Tool functions ================
+def disk_name(path):
+    """Finds the name of the disk holding a path, as in the psutil counters
+
+    Returns:
+        str: None if it is not found, outside Linux
+    """
+    try:
+        device = os.lstat(path).st_dev
+        block = '/sys/dev/block/{0}:{1}'.format(os.major(device), os.minor(device))
+        if not os.path.exists(block):
+            return None
+        return os.path.basename(os.path.realpath(block))
+    except OSError:
+        return None
+
+def lower_thread_priority():
+    """Lowers the priority of the calling thread by dss.SCAN_NICE and sets
+    its I/O class to dss.SCAN_IOPRIO_CLASS. On Linux both only apply to the
+    calling thread, the nice value also giving its I/O priority unless an
+    I/O class is set.
+    """
+    if dss.SCAN_NICE:
+        try:
+            os.nice(dss.SCAN_NICE)
+        except OSError as e:
+            logger.warning("Cannot lower the scan priority : {0}".format(e))
+    if dss.SCAN_IOPRIO_CLASS is not None:
+        try:
+            # The I/O priority of a Linux thread is its own, set by its id
+            thread = psutil.Process(threading.get_native_id())
+            io_class = getattr(psutil, IOPRIO_CLASSES[dss.SCAN_IOPRIO_CLASS])
+            if io_class == psutil.IOPRIO_CLASS_IDLE:
+                thread.ionice(io_class)
+            else:
+                thread.ionice(io_class, dss.SCAN_IOPRIO_LEVEL)
+        except (AttributeError, OSError, psutil.Error) as e:
+            logger.warning("Cannot set the I/O class of the scan : {0}".format(e))
+
+def run_with_lower_priority(function, *args, **kwargs):
+    """Runs a function in a thread of its own, its priority lowered by
+    lower_thread_priority, and waits for it. A nice value cannot be raised
+    back: the priority of the calling thread, often the main one, is kept.
+
+    Returns:
+        The result of the function, whose exceptions are raised again
+    """
+    if not dss.SCAN_NICE and dss.SCAN_IOPRIO_CLASS is None:
+        return function(*args, **kwargs)
+    outcome = []
+    def run():
+        lower_thread_priority()
+        try:
+            outcome.append((function(*args, **kwargs), None))
+        except BaseException as e:
+            outcome.append((None, e))
+    thread = threading.Thread(target=run, name='scan')
+    thread.start()
+    thread.join()
+    result, error = outcome[0]
+    if error is not None:
+        raise error
+    return result
+
+#================ Throttle ================
+class ScanThrottle(object):
+    """Paces the directories read by a scan, shared by all its threads.
+
+    The reads are spread to stay under a rate of directories and of stat
+    calls. Every check_interval, the I/O wait of the CPUs and the busy time
+    of the scanned disks are read: while one is above its limit, the scan
+    pauses for a backoff doubled at each check, up to max_backoff.
+
+    Attributes:
+        dirs_per_sec: The maximum rate of directories read, None for no limit
+        stats_per_sec: The maximum rate of stat calls, None for no limit
+        max_iowait: The fraction of CPU time waiting for I/O above which the
+                    scan backs off, None to ignore it
+        max_busy: The fraction of time a scanned disk is busy above which the
+                  scan backs off, None to ignore it
+        disks: The names of the scanned disks, every disk if empty
+    """
+    MIN_BACKOFF = 0.1
+    # An idle moment does not allow a burst of more than a second of reads
+    MAX_CREDIT = 1.0
+
+    def __init__(self, dirs_per_sec=None, stats_per_sec=None, max_iowait=None, max_busy=None,
+                 disks=(), check_interval=1.0, max_backoff=10.0):
+        self.dirs_per_sec = dirs_per_sec
+        self.stats_per_sec = stats_per_sec
+        self.max_iowait = max_iowait
+        self.max_busy = max_busy
+        self.disks = set(disks)
+        self.check_interval = check_interval
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+        self._next_check = self._next
+        self._backoff = 0.0
+        self._cpu_times = None
+        self._disk_times = None
+
+    def pace(self, dirs, stat_calls):
+        """Accounts for the directories just read, and sleeps as long as
+        needed before reading the next ones
+
+        Arguments:
+            dirs: The number of directories read
+            stat_calls: The number of stat calls made
+        Returns:
+            float: The time slept, in seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            cost = 0.0
+            if self.dirs_per_sec:
+                cost = dirs/self.dirs_per_sec
+            if self.stats_per_sec:
+                cost = max(cost, stat_calls/self.stats_per_sec)
+            self._next = max(self._next, now - self.MAX_CREDIT) + cost
+            if (self.max_iowait is not None or self.max_busy is not None) and \
+               now >= self._next_check:
+                self._next_check = now + self.check_interval
+                if self._overloaded():
+                    self._backoff = min(self.max_backoff,
+                                        max(self.MIN_BACKOFF, self._backoff*2))
+                    self._next = max(self._next, now) + self._backoff
+                    logger.debug("Scan backing off for {0:.1f}s".format(self._backoff))
+                else:
+                    self._backoff = 0.0
+            delay = self._next - now
+        if delay <= 0:
+            return 0.0
+        time.sleep(delay)
+        return delay
+
+    def _overloaded(self):
+        """Tells if the I/O wait or the busy time of a disk went above its
+        limit since the previous check
+        """
+        overloaded = False
+        if self.max_iowait is not None:
+            cpu_times = psutil.cpu_times()
+            previous, self._cpu_times = self._cpu_times, cpu_times
+            if previous is not None and hasattr(cpu_times, 'iowait'):
+                total = sum(cpu_times) - sum(previous)
+                if total > 0 and (cpu_times.iowait - previous.iowait)/total > self.max_iowait:
+                    overloaded = True
+        if self.max_busy is not None:
+            now = time.monotonic()
+            counters = psutil.disk_io_counters(perdisk=True) or {}
+            busy_times = {name: counter.busy_time for name, counter in counters.items()
+                          if hasattr(counter, 'busy_time') and
+                          (not self.disks or name in self.disks)}
+            previous, self._disk_times = self._disk_times, (now, busy_times)
+            if previous is not None and now > previous[0]:
+                duration = (now - previous[0])*1000
+                for name, busy_time in busy_times.items():
+                    if name in previous[1] and \
+                       (busy_time - previous[1][name])/duration > self.max_busy:
+                        overloaded = True
+                        break
+        return overloaded
+
+def scan_throttle(paths):
+    """Creates the throttle of a scan from the settings
+
+    Arguments:
+        paths: The scanned paths, to watch their disks
+    Returns:
+        ScanThrottle: None if the scans are not throttled
+    """
+    if dss.SCAN_MAX_DIRS_PER_SEC is None and dss.SCAN_MAX_STATS_PER_SEC is None and \
+       dss.SCAN_MAX_IOWAIT is None and dss.SCAN_MAX_DISK_BUSY is None:
+        return None
+    disks = set(disk_name(path) for path in paths)
+    disks.discard(None)
+    return ScanThrottle(dss.SCAN_MAX_DIRS_PER_SEC, dss.SCAN_MAX_STATS_PER_SEC,
+                        dss.SCAN_MAX_IOWAIT, dss.SCAN_MAX_DISK_BUSY, disks,
+                        dss.SCAN_THROTTLE_CHECK_INTERVAL.total_seconds(),
+                        dss.SCAN_MAX_BACKOFF.total_seconds())